@@ -1,16 +1,16 @@
 #!.venv/bin/python
 import os
-from functools import cache
+import threading
+import time
 from logging import info
-from typing import List
+from typing import Any, Callable, Dict, List
 
-import dotenv
-import uvicorn
-from fastapi import BackgroundTasks, Depends
+from fastapi import BackgroundTasks, Depends, HTTPException, Request, Response
 from fastapi.datastructures import QueryParams
 from github_webhooks import create_app
 from github_webhooks.schemas import WebhookHeaders
 
+from lib.artifacts import get_revisions, record_revision, rollback
 from lib.auth import verify_apikey
 from lib.data import (
     get_project,
@@ -18,19 +18,65 @@ from lib.data import (
     get_service,
     get_services,
     upsert_project,
+    upsert_projects,
     upsert_service,
 )
 from lib.git import update_repo
-from lib.models import PingPayload, Project, Service, WorkflowJobPayload
+from lib.jobs import (
+    Worker,
+    add_job,
+    forget_delivery,
+    get_job,
+    get_jobs,
+    get_queue_depth,
+    has_queued_job,
+    record_delivery,
+)
+from lib.metrics import CONTENT_TYPE, deploy_queue_depth, render
+from lib.models import BulkUpsert, Project, Service
+from lib.plan import get_plan
+from lib.prepull import prepull, prepull_enabled, stop_prepull
+from lib.profiling import Sampler, serving_threads
 from lib.proxy import update_proxy, write_proxies
-from lib.upstream import check_upstream, update_upstream, write_upstreams
+from lib.reconcile import RECONCILE_KEY, Reconciler, reconcile
+from lib.status import StatusCache, StatusWatcher
+from lib.trace import get_deploy, get_deploys
+from lib.upstream import (
+    check_upstream,
+    update_service,
+    update_upstream,
+    write_upstreams,
+)
+from lib.utils import load_env
+from lib.webhooks import PingPayload, WorkflowJobPayload
 
-dotenv.load_dotenv()
+load_env()
 
 
 api_token = os.environ["API_KEY"]
 app = create_app(secret_token=api_token)
 
+# when set, requests taking longer than this many milliseconds get their profile written to logs/profiles
+profile_threshold_ms = os.environ.get("API_PROFILE_THRESHOLD_MS")
+
+if profile_threshold_ms:
+
+    @app.middleware("http")
+    async def profile_request(request: Request, call_next: Callable[[Request], Any]) -> Response:
+        """
+        Sample the stacks of slow requests. Only the threads serving requests are sampled, so requests running at the
+        same time can show up in the profile, but the background threads don't.
+        """
+        sampler = Sampler(threads=serving_threads(threading.get_ident()))
+        sampler.start()
+        start = time.perf_counter()
+        try:
+            return await call_next(request)
+        finally:
+            sampler.stop()
+            if (time.perf_counter() - start) * 1000 > float(profile_threshold_ms):
+                sampler.write(f"api-{request.method}-{request.url.path}")
+
 
 def _after_config_change(project: str, service: str = None) -> None:
     """Run after a project is updated"""
@@ -38,37 +84,123 @@ def _after_config_change(project: str, service: str = None) -> None:
     # get_certs(project)
     write_proxies()
     write_upstreams()
-    update_upstream(project, service, rollout=True)
+    record_revision()
+    # only recreate and roll out the services whose config changed
+    update_upstream(project, service, rollout=True, changed_only=True)
     update_proxy()
     # reload_proxy()
 
 
-def _handle_update_upstream(project: str, service: str) -> None:
+def _after_config_changes(projects: List[str]) -> None:
+    """Run after projects are updated in bulk, rendering the config once for all of them"""
+    info(f"Config change detected in {len(projects)} projects")
+    write_proxies()
+    write_upstreams()
+    record_revision()
+    for project in projects:
+        update_upstream(project, rollout=True, changed_only=True)
+    update_proxy()
+
+
+def _handle_update_upstream(project: str, service: str, received_at: float) -> None:
     """handle incoming requests to update the upstream"""
-    update_upstream(project, service, rollout=True)
+    if service:
+        # fast path: only pull and roll out the one service that was built
+        update_service(project, service)
+    else:
+        update_upstream(project, rollout=True)
+    name = f"{project}:{service}" if service else project
+    info(f'Upstream "{name}" is healthy {time.time() - received_at:.2f}s after the request came in')
     # reload proxy's terminate service as it needs to get the new upstream
     # reload_proxy("terminate")
 
 
-def _handle_hook(project: str, background_tasks: BackgroundTasks, service: str = None) -> None:
-    """Handle incoming requests to update the upstream"""
+# the deploys that can be queued, run by whichever api worker claims them
+deploys: List[Callable[..., Any]] = [
+    _after_config_change,
+    _after_config_changes,
+    _handle_update_upstream,
+    reconcile,
+    rollback,
+    update_repo,
+]
+deploy_handlers = {fn.__name__: fn for fn in deploys}
+deploy_worker = Worker(deploy_handlers)
+# when set, a reconcile is queued every this many seconds
+reconcile_interval = float(os.environ.get("RECONCILE_INTERVAL", 0))
+reconciler = Reconciler(reconcile_interval) if reconcile_interval else None
+# the status of the upstream containers, kept up to date from the docker events stream
+status_cache = StatusCache()
+status_watcher = StatusWatcher(status_cache)
+# seconds a hook deploy waits for more events of the same project and service to merge with. By default it starts
+# right away, and only the hooks coming in while it is still queued behind another deploy merge into it.
+hook_coalesce_window = float(os.environ.get("HOOK_COALESCE_WINDOW", 0))
+# the number of queued and running deploys above which hooks are turned away
+deploy_queue_limit = int(os.environ.get("DEPLOY_QUEUE_LIMIT", 50))
+
+
+@app.on_event("startup")
+def start_deploy_worker() -> None:
+    deploy_worker.start()
+    status_watcher.start()
+    if reconciler:
+        reconciler.start()
+
+
+@app.on_event("shutdown")
+def stop_deploy_worker() -> None:
+    """Let the running deploy finish when a worker is drained, leaving the queued ones to the other workers"""
+    if reconciler:
+        reconciler.stop()
+    status_watcher.stop()
+    deploy_worker.stop()
+
+
+def _add_deploy(fn: Callable[..., Any], coalesce_key: str = None, delay: float = 0, **kwargs: Any) -> str:
+    """Queue a deploy to run in the background, returning its id"""
+    deploy_id = add_job(fn.__name__, coalesce_key=coalesce_key, delay=delay, **kwargs)
+    info(f"Scheduled deploy {deploy_id}")
+    return deploy_id
+
+
+def _check_backlog(coalesce_key: str) -> None:
+    """Turn a hook away when the deploy backlog is full, unless it merges into a queued deploy"""
+    if get_queue_depth() >= deploy_queue_limit and not has_queued_job(coalesce_key):
+        raise HTTPException(
+            status_code=429,
+            detail="Too many deploys queued",
+            headers={"Retry-After": str(int(hook_coalesce_window) or 1)},
+        )
+
+
+def _handle_hook(project: str, service: str = None) -> None:
+    """Handle incoming requests to update the upstream, merging the ones for the same project and service"""
+    # all jobs of our own repo update it once
+    coalesce_key = "hook:itsUP" if project == "itsUP" else f"hook:{project}:{service or ''}"
+    _check_backlog(coalesce_key)
     if project == "itsUP":
-        background_tasks.add_task(update_repo)
+        _add_deploy(update_repo, coalesce_key=coalesce_key, delay=hook_coalesce_window)
         return
     check_upstream(project, service)
-    background_tasks.add_task(_handle_update_upstream, project=project, service=service)
+    _add_deploy(
+        _handle_update_upstream,
+        coalesce_key=coalesce_key,
+        delay=hook_coalesce_window,
+        project=project,
+        service=service,
+        received_at=time.time(),
+    )
 
 
 @app.get("/update-upstream/{project}", response_model=None)
 @app.get("/update-upstream/{project}/{service}", response_model=None)
 def get_hook_handler(
     project: str,
-    background_tasks: BackgroundTasks,
     service: str = None,
     _: None = Depends(verify_apikey),
 ) -> None:
     """Handle requests to update the upstream"""
-    _handle_hook(project, background_tasks, service)
+    _handle_hook(project, service)
 
 
 @app.hooks.register("ping", PingPayload)
@@ -88,16 +220,30 @@ async def github_workflow_job_handler(
     background_tasks: BackgroundTasks,
 ) -> None:
     """Handle incoming github webhook requests for workflow_job events to update ourselves or an upstream"""
+    project = query_params.get("project")
+    assert project is not None
+    service = payload.workflow_job.name
+    if not record_delivery(headers.delivery):
+        info(f"Dropping redelivered webhook {headers.delivery}")
+        return
+    if payload.workflow_job.status in ["queued", "in_progress"] and prepull_enabled() and project != "itsUP":
+        # pull while CI runs, outside of the deploy queue so it never holds up a deploy
+        background_tasks.add_task(prepull, project, service, payload.workflow_job.id)
+        return
+    if payload.workflow_job.status == "completed" and prepull_enabled():
+        # the deploy pulls what the job pushed, if anything, so stop waiting for it
+        stop_prepull(project, service, payload.workflow_job.id)
     if payload.workflow_job.status == "completed" and payload.workflow_job.conclusion == "success":
-        project = query_params.get("project")
-        assert project is not None
-        service = payload.workflow_job.name
-        _handle_hook(project, background_tasks, service)
+        try:
+            _handle_hook(project, service)
+        except Exception:
+            # let github redeliver what we turned away or failed on
+            forget_delivery(headers.delivery)
+            raise
 
 
 @app.get("/projects", response_model=List[Project])
 @app.get("/projects/{project}", response_model=Project)
-@cache
 def get_projects_handler(project: str = None, _: None = Depends(verify_apikey)) -> List[Project] | Project:
     """Get the list of all or one project"""
     if project:
@@ -105,6 +251,14 @@ def get_projects_handler(project: str = None, _: None = Depends(verify_apikey))
     return get_projects()
 
 
+@app.get("/projects/{project}/status", response_model=Dict[str, Dict[str, Any]])
+def get_project_status_handler(project: str, _: None = Depends(verify_apikey)) -> Dict[str, Dict[str, Any]]:
+    """Get the status of a project's containers by service: state, health, restart count and image"""
+    if not get_project(project, throw=False):
+        raise HTTPException(status_code=404, detail=f"Project {project} not found")
+    return status_cache.get_project_status(project)
+
+
 @app.get("/projects/{project}/services", response_model=List[Service])
 @app.get("/projects/{project}/services/{service}", response_model=Service)
 def get_project_services_handler(
@@ -126,12 +280,14 @@ def get_project_services_handler(
 @app.put("/projects", tags=["Project"])
 def upsert_project_handler(
     project: Project,
-    background_tasks: BackgroundTasks,
     _: None = Depends(verify_apikey),
 ) -> None:
     """Create or update a project"""
-    upsert_project(project)
-    background_tasks.add_task(_after_config_change, project.name)
+    try:
+        upsert_project(project)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e)) from e
+    _add_deploy(_after_config_change, project=project.name)
 
 
 @app.get("/services", response_model=List[Service])
@@ -145,12 +301,99 @@ def get_services_handler(_: None = Depends(verify_apikey)) -> List[Service]:
 def upsert_service_handler(
     project: str,
     service: Service,
-    background_tasks: BackgroundTasks,
     _: None = Depends(verify_apikey),
 ) -> None:
     """Create or update a service"""
-    upsert_service(project, service)
-    background_tasks.add_task(_after_config_change, project, service.host)
+    try:
+        upsert_service(project, service)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e)) from e
+    _add_deploy(_after_config_change, project=project, service=service.host)
+
+
+@app.post("/bulk", tags=["Project", "Service"], response_model=Dict[str, Any])
+def bulk_upsert_handler(bulk: BulkUpsert, _: None = Depends(verify_apikey)) -> Dict[str, Any]:
+    """Create or update projects and services at once: they are validated together and deployed with one job"""
+    try:
+        projects = upsert_projects(bulk.projects, [(s.project, s.service) for s in bulk.services])
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e)) from e
+    if not projects:
+        return {"id": None, "projects": []}
+    return {"id": _add_deploy(_after_config_changes, projects=projects), "projects": projects}
+
+
+@app.get("/status", response_model=Dict[str, Dict[str, Any]])
+def get_status_handler(_: None = Depends(verify_apikey)) -> Dict[str, Dict[str, Any]]:
+    """Get the status of all upstream containers by service: state, health, restart count and image"""
+    return status_cache.get_status()
+
+
+@app.get("/plan", response_model=Dict[str, Any])
+def get_plan_handler(rollout: bool = False, _: None = Depends(verify_apikey)) -> Dict[str, Any]:
+    """Get the artifact diffs and docker actions an apply would result in, without applying anything"""
+    return get_plan(rollout)
+
+
+@app.get("/reconcile", response_model=Dict[str, Dict[str, Any]])
+def get_reconcile_handler(_: None = Depends(verify_apikey)) -> Dict[str, Dict[str, Any]]:
+    """Get the action a reconcile would take per upstream project, without taking it"""
+    return reconcile(dry_run=True)
+
+
+@app.post("/reconcile", response_model=Dict[str, str])
+def post_reconcile_handler(_: None = Depends(verify_apikey)) -> Dict[str, str]:
+    """Queue a reconcile of the upstream containers with the db, returning its job id"""
+    return {"id": _add_deploy(reconcile, coalesce_key=RECONCILE_KEY)}
+
+
+@app.get("/revisions", response_model=List[Dict[str, Any]])
+def get_revisions_handler(limit: int = 20, _: None = Depends(verify_apikey)) -> List[Dict[str, Any]]:
+    """Get the latest revisions of the artifacts, the current one first"""
+    return [{"id": r["id"], "created": r["created"], "artifacts": len(r["artifacts"])} for r in get_revisions()[:limit]]
+
+
+@app.post("/revisions/{revision_id}/rollback", response_model=Dict[str, str])
+def post_rollback_handler(revision_id: str, _: None = Depends(verify_apikey)) -> Dict[str, str]:
+    """Queue a rollback to a revision, without rendering anything"""
+    return {"id": _add_deploy(rollback, revision_id=revision_id)}
+
+
+@app.get("/jobs", response_model=List[Dict[str, Any]])
+def get_jobs_handler(limit: int = 20, _: None = Depends(verify_apikey)) -> List[Dict[str, Any]]:
+    """Get the latest queued deploys and their status"""
+    return get_jobs(limit)
+
+
+@app.get("/jobs/{job_id}", response_model=Dict[str, Any])
+def get_job_handler(job_id: str, _: None = Depends(verify_apikey)) -> Dict[str, Any]:
+    """Get the status of a queued deploy"""
+    job = get_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return job
+
+
+@app.get("/deploys", response_model=List[Dict[str, Any]])
+def get_deploys_handler(limit: int = 20, _: None = Depends(verify_apikey)) -> List[Dict[str, Any]]:
+    """Get the latest deploys"""
+    return get_deploys(limit)
+
+
+@app.get("/deploys/{deploy_id}", response_model=List[Dict[str, Any]])
+def get_deploy_handler(deploy_id: str, _: None = Depends(verify_apikey)) -> List[Dict[str, Any]]:
+    """Get the timing spans of a deploy to find its slowest stages"""
+    spans = get_deploy(deploy_id)
+    if not spans:
+        raise HTTPException(status_code=404, detail=f"Deploy {deploy_id} not found")
+    return spans
+
+
+@app.get("/metrics", response_class=Response)
+def get_metrics_handler(_: None = Depends(verify_apikey)) -> Response:
+    """Get deploy metrics in the Prometheus text format"""
+    deploy_queue_depth.set(get_queue_depth())
+    return Response(content=render(), media_type=CONTENT_TYPE)
 
 
 # @app.patch(
@@ -170,9 +413,10 @@ def upsert_service_handler(
 
 
 if __name__ == "__main__":
+    from lib.server import run
 
-    uvicorn.run(
-        app,
+    run(
+        "api.main:app",
         host="0.0.0.0",
         port=8888,
         log_level="debug",
@@ -180,4 +424,7 @@ if __name__ == "__main__":
         forwarded_allow_ips="*",
         log_config="api-log.conf.yaml",
         proxy_headers=os.environ.get("PYTHON_ENV", "development") == "production",
+        # give in-flight deploys this many seconds to finish when a worker is drained
+        timeout_graceful_shutdown=int(os.environ.get("API_DRAIN_TIMEOUT", 600)),
+        workers=int(os.environ.get("API_WORKERS", 1)),
     )
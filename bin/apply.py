@@ -3,20 +3,34 @@
 import os
 import sys
 
-from dotenv import load_dotenv
-
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
+from lib.artifacts import record_revision
+from lib.plan import format_plan, get_plan
+from lib.profiling import profiled
 from lib.proxy import write_proxies
+from lib.trace import deploy
 from lib.upstream import update_upstreams, write_upstreams
+from lib.utils import load_env
 
-load_dotenv()
+load_env()
 
 if __name__ == "__main__":
-    # if any argument is passed, we also do a rollout
-    rollout = bool(sys.argv[1]) if len(sys.argv) > 1 else False
-    # get_certs()
-    write_proxies()
-    write_upstreams()
-    update_upstreams(rollout)
+    # pass --profile to write a profile of the run to logs/profiles
+    profile = "--profile" in sys.argv
+    # pass --plan to only show what would change, without applying anything
+    plan = "--plan" in sys.argv
+    args = [a for a in sys.argv[1:] if a not in ["--profile", "--plan"]]
+    # if any other argument is passed, we also do a rollout
+    rollout = bool(args[0]) if len(args) > 0 else False
+    if plan:
+        with profiled("plan", enabled=profile):
+            print(format_plan(get_plan(rollout)))
+        sys.exit(0)
+    with profiled("apply", enabled=profile), deploy("apply", rollout=rollout):
+        # get_certs()
+        write_proxies()
+        write_upstreams()
+        record_revision()
+        update_upstreams(rollout)
     # reload_proxy()
@@ -0,0 +1,29 @@
+#!.venv/bin/python
+
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from lib.storage import export_db, import_db
+from lib.utils import load_env
+
+load_env()
+
+if __name__ == "__main__":
+    # import db.yml (or the given path) into the storage backend set with DB_STORAGE, or export it back
+    if len(sys.argv) < 2 or sys.argv[1] not in ["import", "export"]:
+        print(f"Usage: {sys.argv[0]} import|export [path]")
+        sys.exit(1)
+    command = sys.argv[1]
+    path = sys.argv[2] if len(sys.argv) > 2 else "db.yml"
+    try:
+        if command == "import":
+            storage = import_db(path)
+            print(f"Imported {path} into {storage.path}")
+        else:
+            storage = export_db(path)
+            print(f"Exported {storage.path} to {path}")
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
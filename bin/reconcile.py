@@ -0,0 +1,20 @@
+#!.venv/bin/python
+
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from lib.reconcile import reconcile
+from lib.trace import deploy
+from lib.utils import load_env
+
+load_env()
+
+if __name__ == "__main__":
+    # pass --plan to only show what would be done, without doing anything
+    dry_run = "--plan" in sys.argv
+    with deploy("reconcile", dry_run=dry_run):
+        plan = reconcile(dry_run)
+    for project, step in plan.items():
+        print(f"{project}: {step['action']}" + (f" ({step['reason']})" if step["reason"] else ""))
@@ -0,0 +1,26 @@
+#!.venv/bin/python
+
+import os
+import sys
+from datetime import datetime
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from lib.artifacts import get_revisions, rollback
+from lib.trace import deploy
+from lib.utils import load_env
+
+load_env()
+
+if __name__ == "__main__":
+    # pass a revision id (or a unique prefix of it) to roll back to, or nothing to list the revisions
+    if len(sys.argv) < 2:
+        for i, revision in enumerate(get_revisions()):
+            created = datetime.fromtimestamp(revision["created"]).isoformat(" ", "seconds")
+            print(
+                f"{revision['id']} {created} {len(revision['artifacts'])} artifacts" + (" (current)" if i == 0 else "")
+            )
+        sys.exit(0)
+    with deploy("rollback", revision_id=sys.argv[1]):
+        result = rollback(sys.argv[1])
+    print(result)
@@ -1,6 +1,12 @@
 #!/usr/bin/env sh
 . .venv/bin/activate
 
+# when the api is already running, gracefully reload its workers so no requests are dropped
+read pid <logs/api.pid 2>/dev/null
+if [ -n "$pid" ] && kill -HUP $pid 2>/dev/null; then
+  exit 0
+fi
+
 kill $(fuser 8888/tcp 2>/dev/null | awk '{ print $1 }') 2>/dev/null
 
 PYTHONPATH=. python api/main.py main:app >logs/error.log 2>&1 &
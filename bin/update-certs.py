@@ -3,15 +3,14 @@
 import os
 import sys
 
-from dotenv import load_dotenv
-
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
 from lib.upstream import update_upstream, update_upstreams
 from lib.certs import get_certs
 from lib.proxy import reload_proxy, rollout_proxy
+from lib.utils import load_env
 
-load_dotenv()
+load_env()
 
 if __name__ == "__main__":
     project = sys.argv[1] if len(sys.argv) > 1 else None
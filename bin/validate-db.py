@@ -6,6 +6,15 @@ import sys
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
 from lib.data import validate_db
+from lib.profiling import profiled
+from lib.utils import load_env
+
+load_env()
 
 if __name__ == "__main__":
-    validate_db()
+    # pass --profile to write a profile of the run to logs/profiles
+    with profiled("validate-db", enabled="--profile" in sys.argv):
+        errors = validate_db(throw=False)
+    for error in errors:
+        print(error)
+    sys.exit(1 if errors else 0)
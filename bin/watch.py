@@ -0,0 +1,15 @@
+#!.venv/bin/python
+
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from lib.utils import load_env
+from lib.watch import Watcher
+
+load_env()
+
+if __name__ == "__main__":
+    # watch db.yml and the templates, applying changes once a burst of saves settled
+    Watcher().run()
@@ -3,17 +3,21 @@
 import os
 import sys
 
-from dotenv import load_dotenv
-
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
+from lib.artifacts import record_revision
 from lib.data import validate_db
+from lib.profiling import profiled
 from lib.proxy import write_proxies
 from lib.upstream import write_upstreams
+from lib.utils import load_env
 
-load_dotenv()
+load_env()
 
 if __name__ == "__main__":
-    validate_db()
-    write_proxies()
-    write_upstreams()
+    # pass --profile to write a profile of the run to logs/profiles
+    with profiled("write-artifacts", enabled="--profile" in sys.argv):
+        validate_db()
+        write_proxies()
+        write_upstreams()
+        record_revision()
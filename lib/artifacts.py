@@ -0,0 +1,164 @@
+import glob
+import hashlib
+import json
+import os
+import time
+from logging import info
+from typing import Any, Dict, List, Set
+
+from lib.data import db_lock, get_db, get_hash
+from lib.metrics import timed
+from lib.proxy import reload_proxy, restart_proxy, update_proxy
+from lib.storage import get_storage
+from lib.upstream import get_upstream_projects
+from lib.utils import run_command, write_files
+
+# the store of all generated artifacts by content, with a manifest per revision
+ARTIFACTS_DIR = "data/artifacts"
+# the number of revisions to keep
+MAX_REVISIONS = 50
+# the generated artifacts: the proxy configs and the upstream compose files
+ARTIFACT_GLOBS = [
+    "proxy/docker-compose.yml",
+    "proxy/nginx/*.conf",
+    "proxy/nginx/map/*.conf",
+    "proxy/traefik/traefik.yml",
+    "proxy/traefik/dynamic/*.yml",
+    "upstream/*/docker-compose.yml",
+    "upstream/*/.env",
+]
+
+Revision = Dict[str, Any]
+
+
+def _object_path(digest: str) -> str:
+    return f"{ARTIFACTS_DIR}/objects/{digest[:2]}/{digest}"
+
+
+def _revision_path(revision_id: str) -> str:
+    return f"{ARTIFACTS_DIR}/revisions/{revision_id}.json"
+
+
+def store_object(content: str) -> str:
+    """Store content by its hash, returning the hash"""
+    digest = hashlib.sha256(content.encode("utf-8")).hexdigest()
+    path = _object_path(digest)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+            f.write(content)
+        os.replace(f"{path}.tmp", path)
+    return digest
+
+
+def load_object(digest: str) -> str:
+    with open(_object_path(digest), encoding="utf-8") as f:
+        return f.read()
+
+
+def get_artifact_paths() -> List[str]:
+    """Get the paths of the generated artifacts on disk, leaving out the ones of projects that are not upstreams"""
+    upstreams = {p.name for p in get_upstream_projects()}
+    paths = [path for pattern in ARTIFACT_GLOBS for path in glob.glob(pattern)]
+    return sorted(path for path in paths if not path.startswith("upstream/") or path.split("/")[1] in upstreams)
+
+
+def _get_projects(revision: Revision) -> Set[str]:
+    return {path.split("/")[1] for path in revision["artifacts"] if path.startswith("upstream/")}
+
+
+@timed("record_revision")
+def record_revision() -> Revision:
+    """
+    Store the artifacts on disk together with the db they were rendered from, as a revision named by its content.
+    Recording the same artifacts again only makes their revision the latest.
+    """
+    # api workers record revisions concurrently, and pruning must not remove the objects of one being recorded
+    with db_lock():
+        artifacts = {}
+        for path in get_artifact_paths():
+            with open(path, encoding="utf-8") as f:
+                artifacts[path] = store_object(f.read())
+        db = get_db()
+        revision_id = get_hash(artifacts)[:12]
+        revision = {
+            "id": revision_id,
+            "created": time.time(),
+            "db": store_object(json.dumps(db, default=str)),
+            "artifacts": artifacts,
+        }
+        os.makedirs(os.path.dirname(_revision_path(revision_id)), exist_ok=True)
+        with open(f"{_revision_path(revision_id)}.tmp", "w", encoding="utf-8") as f:
+            json.dump(revision, f)
+        os.replace(f"{_revision_path(revision_id)}.tmp", _revision_path(revision_id))
+        prune_revisions()
+    return revision
+
+
+def get_revisions() -> List[Revision]:
+    """Get the recorded revisions, the latest (current) one first"""
+    revisions = []
+    for path in glob.glob(_revision_path("*")):
+        with open(path, encoding="utf-8") as f:
+            revisions.append(json.load(f))
+    return sorted(revisions, key=lambda r: r["created"], reverse=True)
+
+
+def get_revision(revision_id: str) -> Revision:
+    """Get a revision by (a unique prefix of) its id"""
+    matches = [r for r in get_revisions() if r["id"].startswith(revision_id)]
+    if len(matches) != 1:
+        raise ValueError(f"Revision {revision_id} {'is ambiguous' if matches else 'not found'}")
+    return matches[0]
+
+
+def prune_revisions(keep: int = MAX_REVISIONS) -> None:
+    """Remove the oldest revisions and the objects no revision refers to anymore"""
+    revisions = get_revisions()
+    if len(revisions) <= keep:
+        return
+    for revision in revisions[keep:]:
+        os.remove(_revision_path(revision["id"]))
+    used = {d for r in revisions[:keep] for d in [r["db"], *r["artifacts"].values()]}
+    for path in glob.glob(_object_path("*")):
+        if os.path.basename(path) not in used:
+            os.remove(path)
+
+
+@timed("rollback")
+def rollback(revision_id: str) -> Dict[str, List[str]]:
+    """
+    Roll back to a revision: put back its db and artifacts as they were stored, without rendering or validating,
+    then only bring up the upstream projects whose artifacts changed and reload the parts of the proxy that did.
+    Returns what was changed.
+    """
+    revision = get_revision(revision_id)
+    current = record_revision()
+    info(f"Rolling back from revision {current['id']} to {revision['id']}")
+    artifacts = {path: load_object(digest) for path, digest in revision["artifacts"].items()}
+    with db_lock():
+        get_storage().save(json.loads(load_object(revision["db"])))
+    for path in artifacts:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    written = write_files(artifacts)
+    # the upstream projects that were not deployed in the revision get taken down
+    gone = sorted(_get_projects(current) - _get_projects(revision))
+    for project in gone:
+        run_command(["docker", "compose", "down"], cwd=f"upstream/{project}")
+    projects = sorted({path.split("/")[1] for path in written if path.startswith("upstream/")})
+    for project in projects:
+        # compose only recreates the services whose config changed
+        run_command(["docker", "compose", "up", "-d", "--remove-orphans"], cwd=f"upstream/{project}")
+    proxy = []
+    if "proxy/docker-compose.yml" in written:
+        update_proxy()
+        proxy.append("update")
+    elif "proxy/traefik/traefik.yml" in written:
+        restart_proxy("traefik")
+        proxy.append("restart traefik")
+    # nginx has its configs mounted, so it only loads them when reloaded
+    if any(path.startswith("proxy/nginx/") for path in written):
+        reload_proxy()
+        proxy.append("reload nginx")
+    record_revision()
+    return {"artifacts": written, "projects": projects, "removed": gone, "proxy": proxy}
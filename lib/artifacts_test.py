@@ -0,0 +1,110 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from typing import Dict
+from unittest import TestCase, mock
+from unittest.mock import Mock, call
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from lib.artifacts import get_revisions, record_revision, rollback
+from lib.models import Project
+
+
+def _write(files: Dict[str, str]) -> None:
+    for path, content in files.items():
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(content)
+
+
+def _read(path: str) -> str:
+    with open(path, encoding="utf-8") as f:
+        return f.read()
+
+
+class TestArtifacts(TestCase):
+
+    def setUp(self) -> None:
+        cwd = os.getcwd()
+        tmp = tempfile.mkdtemp()
+        os.chdir(tmp)
+        self.addCleanup(shutil.rmtree, tmp)
+        self.addCleanup(os.chdir, cwd)
+
+    @mock.patch("lib.artifacts.run_command")
+    @mock.patch("lib.artifacts.db_lock", new=mock.MagicMock())
+    @mock.patch("lib.artifacts.get_storage")
+    @mock.patch("lib.artifacts.get_upstream_projects")
+    @mock.patch("lib.artifacts.get_db")
+    def test_rollback(
+        self,
+        mock_get_db: Mock,
+        mock_get_upstream_projects: Mock,
+        mock_get_storage: Mock,
+        mock_run_command: Mock,
+    ) -> None:
+        mock_update_proxy = self.enterContext(mock.patch("lib.artifacts.update_proxy"))
+        mock_restart_proxy = self.enterContext(mock.patch("lib.artifacts.restart_proxy"))
+        mock_reload_proxy = self.enterContext(mock.patch("lib.artifacts.reload_proxy"))
+        good = {
+            "proxy/nginx/map/terminate.conf": "a.example.com a;\n",
+            "proxy/traefik/dynamic/routers-http.yml": "http: {}\n",
+            "upstream/a/docker-compose.yml": "services: {a: 1}\n",
+            "upstream/b/docker-compose.yml": "services: {b: 1}\n",
+        }
+        _write(good)
+        mock_get_db.return_value = {"projects": [{"name": "a"}, {"name": "b"}]}
+        mock_get_upstream_projects.return_value = [Project(name="a"), Project(name="b")]
+        revision = record_revision()
+        # a bad change breaks a and adds c
+        _write(
+            {
+                "proxy/nginx/map/terminate.conf": "a.example.com a;\nc.example.com c;\n",
+                "upstream/a/docker-compose.yml": "services: {a: 2}\n",
+                "upstream/c/docker-compose.yml": "c",
+            }
+        )
+        mock_get_db.return_value = {"projects": [{"name": "a"}, {"name": "b"}, {"name": "c"}]}
+        mock_get_upstream_projects.return_value = [Project(name="a"), Project(name="b"), Project(name="c")]
+        # saving the db makes it current again
+        mock_get_storage.return_value.save.side_effect = lambda db: mock_get_upstream_projects.configure_mock(
+            return_value=[Project(name=p["name"]) for p in db["projects"]]
+        )
+
+        # Call the function under test
+        result = rollback(revision["id"][:6])
+
+        # The stored db and artifacts are put back, and only the projects that changed are touched
+        mock_get_storage.return_value.save.assert_called_once_with({"projects": [{"name": "a"}, {"name": "b"}]})
+        self.assertEqual(_read("upstream/a/docker-compose.yml"), good["upstream/a/docker-compose.yml"])
+        self.assertEqual(
+            result,
+            {
+                "artifacts": ["proxy/nginx/map/terminate.conf", "upstream/a/docker-compose.yml"],
+                "projects": ["a"],
+                "removed": ["c"],
+                "proxy": ["reload nginx"],
+            },
+        )
+        self.assertEqual(
+            mock_run_command.call_args_list,
+            [
+                call(["docker", "compose", "down"], cwd="upstream/c"),
+                call(["docker", "compose", "up", "-d", "--remove-orphans"], cwd="upstream/a"),
+            ],
+        )
+        mock_update_proxy.assert_not_called()
+        mock_restart_proxy.assert_not_called()
+        # The restored nginx configs get loaded
+        mock_reload_proxy.assert_called_once_with()
+        # The revision rolled back from is kept, and the one rolled back to is current again
+        revisions = get_revisions()
+        self.assertEqual(len(revisions), 2)
+        self.assertEqual(revisions[0]["id"], revision["id"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,11 +2,14 @@ import os
 from logging import debug, info
 from typing import Callable
 
+from lib.domains import get_certs_to_request
+from lib.metrics import timed
 from lib.models import Plugin
 from lib.proxy import get_domains
 from lib.utils import run_command
 
 
+@timed("get_certs")
 def get_certs(filter: Callable[[Plugin], bool] = None) -> bool:
     """Get certificates for all or one project"""
     email = os.getenv("LETSENCRYPT_EMAIL")
@@ -18,7 +21,15 @@ def get_certs(filter: Callable[[Plugin], bool] = None) -> bool:
     changed = False
 
     info(f"Running certbot on domains: {' '.join(domains)}")
-    for domain in domains:
+    # certbot validates over http, so wildcard certificates are requested as certificates with sans
+    mode = "san" if os.getenv("TLS_SHARED_CERTS") else None
+    for cert in get_certs_to_request(domains, mode):
+        domain = cert.main
+        names = [cert.main, *cert.sans]
+        copy = " && ".join(f"mkdir -p /certs/{name} && \
+                cp -L /data/letsencrypt/live/{domain}/fullchain.pem /certs/{name}/fullchain.pem && \
+                cp -L /data/letsencrypt/live/{domain}/privkey.pem /certs/{name}/privkey.pem && \
+                chown -R 101:101 /certs/{name}" for name in names)
         # Run certbot command inside docker
         command = [
             "docker",
@@ -32,8 +43,7 @@ def get_certs(filter: Callable[[Plugin], bool] = None) -> bool:
             "./certs:/certs",
             "certbot/certbot",
             "certonly",
-            "-d",
-            domain,
+            *[arg for name in names for arg in ["-d", name]],
             "--webroot",
             "--webroot-path=/data/certbot",
             "--email",
@@ -48,10 +58,7 @@ def get_certs(filter: Callable[[Plugin], bool] = None) -> bool:
             "--logs-dir",
             "/data/letsencrypt",
             "--post-hook",
-            f"mkdir -p /certs/{domain} && \
-                cp -L /data/letsencrypt/live/{domain}/fullchain.pem /certs/{domain}/fullchain.pem && \
-                cp -L /data/letsencrypt/live/{domain}/privkey.pem /certs/{domain}/privkey.pem && \
-                chown -R 101:101 /certs/{domain} && touch {change_file} && chmod a+wr {change_file}",
+            f"{copy} && touch {change_file} && chmod a+wr {change_file}",
         ]
         staging = os.getenv("LETSENCRYPT_STAGING")
         if not staging is None:
@@ -0,0 +1,136 @@
+from typing import Any, Dict, Iterator, List, Set, Tuple
+
+from lib.domains import get_merge_key, split_domains
+from lib.metrics import timed
+from lib.models import Ingress
+
+
+def _value(v: Any) -> Any:
+    """Get the plain value of enums, which raw projects don't have"""
+    return getattr(v, "value", v)
+
+
+# a claim of a project as (key, path, what), without a key for errors that are not about claims
+Claim = Tuple[Tuple[Any, ...] | None, str, str]
+# the claims of projects by key, with the (path, project name) of every claimer
+Claims = Dict[Tuple[Any, ...], List[Tuple[str, str]]]
+
+
+def _depends_on_errors(p: Dict[str, Any], s: Dict[str, Any], hosts: Set[Any], service_path: str) -> Iterator[Claim]:
+    depends_on = s.get("depends_on") or []
+    for dep in depends_on.keys() if isinstance(depends_on, dict) else depends_on:
+        if dep not in hosts:
+            yield None, f"{service_path}.depends_on", f"service {dep} does not exist in project {p.get('name')}"
+
+
+def _domain_claims(ingress: Dict[str, Any], path: str) -> Iterator[Claim]:
+    # an ingress may hold several domains separated by commas, which each get routed
+    domains = ingress.get("domain")
+    path_prefix = ingress.get("path_prefix") or ""
+    router = _value(ingress.get("router") or "http")
+    for domain in split_domains(domains) if isinstance(domains, str) else []:
+        yield ("domain", domain, path_prefix, router), path, f"domain {domain}{path_prefix}"
+
+
+def _hostport_claims(ingress: Dict[str, Any], path: str) -> Iterator[Claim]:
+    if ingress.get("hostport"):
+        protocol = _value(ingress.get("protocol") or "tcp")
+        yield ("hostport", ingress["hostport"], protocol), path, f"host port {ingress['hostport']}/{protocol}"
+
+
+def _get_merge_key(ingress: Dict[str, Any]) -> str | None:
+    try:
+        return get_merge_key(Ingress.model_validate({k: v for k, v in ingress.items() if v is not None}))
+    except ValueError:
+        # invalid ingresses are reported by the validation of the project
+        return None
+
+
+def _router_claims(
+    p: Dict[str, Any], s: Dict[str, Any], ingress: Dict[str, Any], path: str, merged: Set[str]
+) -> Iterator[Claim]:
+    # the ingresses of a service that only differ in domain share one router, which is claimed once
+    key = _get_merge_key(ingress)
+    if key is not None:
+        if key in merged:
+            return
+        merged.add(key)
+    router = _value(ingress.get("router") or "http")
+    name = f"{p.get('name')}-{str(s.get('host')).replace('.', '-')}-{ingress.get('port') or 8080}"
+    yield ("router", router, name), path, f"{router} router name {name}"
+
+
+def _get_claims(p: Dict[str, Any], i: int) -> Iterator[Claim]:
+    """Get what a (raw) project claims, and the depends_on entries referring to missing services"""
+    project_path = f"projects[{i}]"
+    yield ("name", p.get("name")), project_path, f"project name {p.get('name')}"
+    services = [s for s in p.get("services") or [] if isinstance(s, dict)]
+    hosts = {s.get("host") for s in services}
+    for j, s in enumerate(services):
+        service_path = f"{project_path}.services[{j}]"
+        yield from _depends_on_errors(p, s, hosts, service_path)
+        merged: Set[str] = set()
+        for k, ingress in enumerate(s.get("ingress") or []):
+            if not isinstance(ingress, dict):
+                continue
+            path = f"{service_path}.ingress[{k}]"
+            yield from _domain_claims(ingress, path)
+            yield from _hostport_claims(ingress, path)
+            yield from _router_claims(p, s, ingress, path, merged)
+
+
+@timed("check_consistency")
+def check_consistency(projects: List[Dict[str, Any]]) -> List[str]:
+    """
+    Find conflicts between (raw) projects that would silently break the generated artifacts:
+    duplicate project names, ingresses claiming the same domain and path prefix, services binding the same
+    host port and protocol, colliding router names and depends_on entries referring to missing services.
+    Returns the errors with the yaml path they occurred at.
+    """
+    errors: List[str] = []
+    claimed: Dict[Tuple[Any, ...], str] = {}
+    for i, p in enumerate(projects):
+        if not isinstance(p, dict):
+            continue
+        for key, path, what in _get_claims(p, i):
+            if key is None:
+                errors.append(f"{path}: {what}")
+            elif key in claimed:
+                errors.append(f"{path}: {what} is also claimed by {claimed[key]}")
+            else:
+                claimed[key] = path
+    return errors
+
+
+def get_claims(projects: List[Dict[str, Any]]) -> Claims:
+    """Index what (raw) projects claim, to check changes against with check_projects"""
+    claims: Claims = {}
+    for i, p in enumerate(projects):
+        if not isinstance(p, dict):
+            continue
+        for key, path, _ in _get_claims(p, i):
+            if key is not None:
+                claims.setdefault(key, []).append((path, p.get("name")))
+    return claims
+
+
+@timed("check_projects")
+def check_projects(projects: List[Tuple[int, Dict[str, Any]]], claims: Claims) -> List[str]:
+    """
+    Check (indexed) raw projects that are added to or replace the ones in the db against the claims of the others,
+    without going over all of them. Conflicts between the others are not reported.
+    """
+    names = {p.get("name") for _, p in projects}
+    errors: List[str] = []
+    claimed: Dict[Tuple[Any, ...], str] = {}
+    for i, p in projects:
+        for key, path, what in _get_claims(p, i):
+            if key is None:
+                errors.append(f"{path}: {what}")
+                continue
+            other = claimed.get(key) or next((c for c, name in claims.get(key, []) if name not in names), None)
+            if other:
+                errors.append(f"{path}: {what} is also claimed by {other}")
+            else:
+                claimed[key] = path
+    return errors
@@ -0,0 +1,149 @@
+import os
+import sys
+import unittest
+from typing import Any, Dict, List
+from unittest import TestCase
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from lib.consistency import check_consistency, check_projects, get_claims
+from lib.test_stubs import test_db
+
+
+class TestCheckConsistency(TestCase):
+
+    def test_no_conflicts(self) -> None:
+
+        # Call the function under test
+        errors = check_consistency(test_db["projects"])
+
+        self.assertEqual(errors, [])
+
+    def test_conflicts(self) -> None:
+        projects = [
+            {
+                "name": "a",
+                "services": [
+                    {"host": "web", "depends_on": ["db"], "ingress": [{"domain": "a.example.com", "hostport": 8000}]},
+                    {"host": "api", "ingress": [{"domain": "a.example.com", "path_prefix": "/api"}]},
+                ],
+            },
+            {
+                "name": "a-b",
+                "services": [
+                    {"host": "c", "ingress": [{"domain": "a.example.com"}]},
+                ],
+            },
+            {
+                "name": "a",
+                "services": [
+                    {"host": "b-c", "ingress": [{"domain": "b.example.com", "hostport": 8000}]},
+                    {"host": "udp", "ingress": [{"hostport": 8000, "protocol": "udp", "router": "udp"}]},
+                ],
+            },
+        ]
+
+        # Call the function under test
+        errors = check_consistency(projects)
+
+        self.assertEqual(
+            errors,
+            [
+                "projects[0].services[0].depends_on: service db does not exist in project a",
+                "projects[1].services[0].ingress[0]: domain a.example.com is also claimed by "
+                + "projects[0].services[0].ingress[0]",
+                "projects[2]: project name a is also claimed by projects[0]",
+                "projects[2].services[0].ingress[0]: host port 8000/tcp is also claimed by "
+                + "projects[0].services[0].ingress[0]",
+                "projects[2].services[0].ingress[0]: http router name a-b-c-8080 is also claimed by "
+                + "projects[1].services[0].ingress[0]",
+            ],
+        )
+
+    def test_check_projects(self) -> None:
+        projects = [
+            {"name": "x", "services": [{"host": "web", "ingress": [{"domain": "x.example.com"}]}]},
+            {"name": "y", "services": [{"host": "web", "ingress": [{"domain": "x.example.com"}]}]},
+            {"name": "z", "services": [{"host": "web", "ingress": [{"hostport": 8000}]}]},
+        ]
+        claims = get_claims(projects)
+        changed = [
+            (2, {"name": "z", "services": [{"host": "web", "depends_on": ["db"], "ingress": [{"hostport": 8000}]}]}),
+            (3, {"name": "new", "services": [{"host": "web", "ingress": [{"domain": "x.example.com"}]}]}),
+        ]
+
+        # Call the function under test
+        errors = check_projects(changed, claims)
+
+        # The conflict between x and y is not reported, and z does not conflict with the version it replaces
+        self.assertEqual(
+            errors,
+            [
+                "projects[2].services[0].depends_on: service db does not exist in project z",
+                "projects[3].services[0].ingress[0]: domain x.example.com is also claimed by "
+                + "projects[0].services[0].ingress[0]",
+            ],
+        )
+        # x still conflicts with y when it is checked itself
+        self.assertEqual(
+            check_projects([(0, projects[0])], claims),
+            [
+                "projects[0].services[0].ingress[0]: domain x.example.com is also claimed by "
+                + "projects[1].services[0].ingress[0]"
+            ],
+        )
+
+    def test_conflicts_in_domain_lists(self) -> None:
+        projects = [
+            {"name": "a", "services": [{"host": "web", "ingress": [{"domain": "a.example.com, b.example.com"}]}]},
+            {"name": "b", "services": [{"host": "web", "ingress": [{"domain": "b.example.com"}]}]},
+        ]
+
+        # Call the function under test
+        errors = check_consistency(projects)
+
+        self.assertEqual(
+            errors,
+            [
+                "projects[1].services[0].ingress[0]: domain b.example.com is also claimed by "
+                + "projects[0].services[0].ingress[0]"
+            ],
+        )
+        self.assertEqual(check_projects([(1, projects[1])], get_claims(projects[:1])), errors)
+
+    def test_merged_router(self) -> None:
+        projects: List[Dict[str, Any]] = [
+            {
+                "name": "a",
+                "services": [
+                    {
+                        "host": "web",
+                        "ingress": [
+                            {"domain": "a.example.com", "port": 80},
+                            {"domain": "b.example.com", "port": 80},
+                            {"domain": "c.other.org", "port": 80, "router": "http", "tls": None},
+                            {"domain": "d.example.com", "port": 80, "path_prefix": "/api"},
+                        ],
+                    }
+                ],
+            },
+        ]
+
+        # Call the function under test
+        errors = check_consistency(projects)
+
+        # The ingresses only differing in domain share one router, but the one with a path prefix gets its own
+        self.assertEqual(
+            errors,
+            [
+                "projects[0].services[0].ingress[3]: http router name a-web-80 is also claimed by "
+                + "projects[0].services[0].ingress[0]"
+            ],
+        )
+        projects[0]["services"][0]["ingress"].pop()
+        self.assertEqual(check_consistency(projects), [])
+        self.assertEqual(check_projects([(0, projects[0])], get_claims(projects)), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
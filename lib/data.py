@@ -1,49 +1,179 @@
-import importlib
+import fcntl
+import hashlib
+import json
+import os
+import threading
+from contextlib import contextmanager
 from logging import debug, info
-from typing import Any, Callable, Dict, List, Union, cast
+from typing import Any, Callable, Dict, Iterator, List, Set, Tuple, Union, cast
 
-import yaml
+from pydantic import ValidationError
 
+from lib import models
+from lib.consistency import check_consistency, check_projects, get_claims
+from lib.metrics import db_cache_hits, db_cache_misses, timed
 from lib.models import Env, Ingress, Plugin, PluginRegistry, Project, Service
+from lib.plugins import get_plugin
+from lib.storage import get_storage
+from lib.trace import span
+
+# hashes of the projects that passed validation, so they can be skipped until they change
+VALIDATION_CACHE = "data/cache/validated.json"
+# validate the changed projects in a process pool when there are at least this many
+VALIDATION_POOL_THRESHOLD = 200
+
+DB_LOCK = "data/cache/db.lock"
+
+# the loaded db, keyed on its storage revision so external edits and writes by other api workers are picked up
+_db_cache: Dict[str, Any] = {}
+_db_lock = threading.RLock()
+_db_lock_depth = 0
 
 
 def get_db() -> Dict[str, List[Dict[str, Any]] | Dict[str, Any]]:
-    """Get the db"""
-    with open("db.yml", encoding="utf-8") as f:
-        return yaml.safe_load(f)
+    """Get the db. The result is shared between callers, so it must not be mutated."""
+    storage = get_storage()
+    key = storage.get_revision()
+    if _db_cache.get("key") == key:
+        db_cache_hits.inc()
+        return _db_cache["db"]
+    db_cache_misses.inc()
+    with span("load_db"):
+        db = storage.load()
+    _db_cache.update(key=key, db=db)
+    return db
+
+
+@contextmanager
+def db_lock() -> Iterator[None]:
+    """Lock the db for a read-modify-write, across threads and api workers. Reentrant."""
+    global _db_lock_depth  # pylint: disable=global-statement
+    with _db_lock:
+        if _db_lock_depth:
+            _db_lock_depth += 1
+            try:
+                yield
+            finally:
+                _db_lock_depth -= 1
+            return
+        with open(DB_LOCK, "w", encoding="utf-8") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            _db_lock_depth = 1
+            try:
+                yield
+            finally:
+                _db_lock_depth = 0
+                fcntl.flock(f, fcntl.LOCK_UN)
 
 
 def write_db(partial: Dict[str, List[Dict[str, Any]] | Dict[str, Any]]) -> None:
     """Write the db"""
-    # get the db first
-    db = get_db()
-    # merge wwith partial
-    db = {**db, **partial}
-    with open("db.yml", "w", encoding="utf-8") as f:
-        yaml.dump(db, f)
+    with db_lock():
+        # get the db first
+        db = get_db()
+        # merge wwith partial
+        db = {**db, **partial}
+        get_storage().save(db)
+        _db_cache.clear()
 
 
-def get_plugin_model(name: str) -> type[Plugin]:
-    """Get a model by name"""
-    cls = f"Plugin{name.capitalize()}"
-    try:
-        model = importlib.import_module(f"lib.models.{cls}")
-        return cast(type[Plugin], model)
-    except ModuleNotFoundError:
-        return Plugin
+def get_hash(data: Any) -> str:
+    """Get a stable hash of (raw) data"""
+    return hashlib.sha1(json.dumps(data, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def _format_errors(e: ValidationError, path: str) -> List[str]:
+    """Format validation errors with the yaml path they occurred at"""
+    errors = []
+    for error in e.errors():
+        loc = path + "".join(f"[{part}]" if isinstance(part, int) else f".{part}" for part in error["loc"])
+        errors.append(f"{loc}: {error['msg']}")
+    return errors
 
 
-def validate_db() -> None:
-    """Validate db.yml contents"""
+def _validate_projects(projects: List[Tuple[int, Dict[str, Any]]]) -> List[Tuple[int, List[str]]]:
+    """Validate (indexed) raw projects, returning the errors per index"""
+    results: List[Tuple[int, List[str]]] = []
+    for i, project in projects:
+        try:
+            Project.model_validate(project)
+            results.append((i, []))
+        except ValidationError as e:
+            results.append((i, _format_errors(e, f"projects[{i}]")))
+    return results
+
+
+def _get_validation_key() -> str:
+    """Get the key that invalidates earlier validations when the models change"""
+    stat = os.stat(models.__file__)
+    return f"{stat.st_mtime_ns}-{stat.st_size}"
+
+
+def _read_validation_cache(key: str) -> Set[str]:
+    try:
+        with open(VALIDATION_CACHE, encoding="utf-8") as f:
+            validated = json.load(f)
+    except (OSError, ValueError):
+        return set()
+    return set(validated["projects"]) if validated.get("key") == key else set()
+
+
+def _write_validation_cache(key: str, hashes: List[str]) -> None:
+    os.makedirs(os.path.dirname(VALIDATION_CACHE), exist_ok=True)
+    with open(VALIDATION_CACHE, "w", encoding="utf-8") as f:
+        json.dump({"key": key, "projects": hashes}, f)
+
+
+def _validate_changed_projects(changed: List[Tuple[int, Dict[str, Any]]]) -> List[Tuple[int, List[str]]]:
+    """Validate (indexed) raw projects, spread over a process per cpu when there are many"""
+    if len(changed) < VALIDATION_POOL_THRESHOLD:
+        return _validate_projects(changed)
+    workers = os.cpu_count() or 1
+    # only imported when validating this many projects, as it pulls in multiprocessing
+    # pylint: disable-next=import-outside-toplevel
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        chunks = executor.map(_validate_projects, [changed[n::workers] for n in range(workers)])
+        return sorted(r for chunk in chunks for r in chunk)
+
+
+def _validate_projects_cached(projects: List[Tuple[int, Dict[str, Any]]]) -> List[str]:
+    """Validate (indexed) raw projects, skipping the ones that did not change since they were last validated"""
+    key = _get_validation_key()
+    validated = _read_validation_cache(key)
+    hashes = {i: get_hash(p) for i, p in projects}
+    changed = [(i, p) for i, p in projects if hashes[i] not in validated]
+    debug(f"Validating {len(changed)} changed projects out of {len(projects)}")
+    results = _validate_changed_projects(changed)
+    if changed:
+        failed = {i for i, project_errors in results if project_errors}
+        _write_validation_cache(key, [h for i, h in hashes.items() if i not in failed])
+    return [error for _, project_errors in results for error in project_errors]
+
+
+@timed("validate_db")
+def validate_db(throw: bool = True) -> List[str]:
+    """
+    Validate db.yml contents and the consistency between projects, returning all errors with their yaml path.
+    Optionally throw an error when it is invalid (default). Projects that did not change since they were last
+    validated are skipped, but the consistency check always covers all projects.
+    """
     debug("Validating db.yml")
     db = get_db()
-    plugins_raw = cast(Dict[str, Any], db["plugins"])
+    errors = []
+    plugins_raw = cast(Dict[str, Any], db.get("plugins") or {})
     for name, plugin in plugins_raw.items():
-        model = get_plugin_model(name)
-        p = {"name": name, **plugin}
-        model.model_validate(p)
-    for project in db["projects"]:
-        Project.model_validate(project)
+        try:
+            get_plugin(name, plugin)
+        except ValidationError as e:
+            errors.extend(_format_errors(e, f"plugins.{name}"))
+    projects = list(enumerate(cast(List[Dict[str, Any]], db.get("projects") or [])))
+    errors.extend(_validate_projects_cached(projects))
+    errors.extend(check_consistency([p for _, p in projects]))
+    if errors and throw:
+        raise ValueError("Invalid db.yml:\n" + "\n".join(errors))
+    return errors
 
 
 def get_versions() -> Dict[str, Any]:
@@ -58,7 +188,7 @@ def get_plugin_registry() -> PluginRegistry:
     debug("Getting plugin registry")
     db = get_db()
     plugins_raw = cast(Dict[str, Any], db["plugins"])
-    return PluginRegistry(**plugins_raw)
+    return PluginRegistry(**{name: get_plugin(name, plugin) for name, plugin in plugins_raw.items()})
 
 
 def get_plugins(filter: Callable[[Plugin], bool] = None) -> List[Plugin]:
@@ -66,9 +196,7 @@ def get_plugins(filter: Callable[[Plugin], bool] = None) -> List[Plugin]:
     debug("Getting plugins" + (f" with filter {filter}" if filter else ""))
     registry = get_plugin_registry()
     plugins = []
-    for name, p in registry:
-        model = get_plugin_model(name=name)
-        plugin = model(name=name, **p)
+    for _, plugin in registry:
         if not filter or filter(plugin):
             plugins.append(plugin)
     return plugins
@@ -132,20 +260,44 @@ def get_projects(
     return filtered_projects
 
 
+def _dump_project(project: Project) -> Dict[str, Any]:
+    return project.model_dump(mode="json", exclude_defaults=True, exclude_none=True, exclude_unset=True)
+
+
 def write_projects(projects: List[Project]) -> None:
     """Write the projects to the db"""
     debug(f"Writing {len(projects)} projects to the db")
-    projects_dump = [p.model_dump(exclude_defaults=True, exclude_none=True, exclude_unset=True) for p in projects]
-    write_db({"projects": projects_dump})
+    write_db({"projects": [_dump_project(p) for p in projects]})
+
+
+def write_project(project: Project) -> None:
+    """Write one project to the db, adding it when new. Only rewrites that project when the storage allows."""
+    debug(f"Writing project {project.name} to the db")
+    with db_lock():
+        get_storage().save_project(_dump_project(project))
+        _db_cache.clear()
+
+
+def write_projects_bulk(projects: List[Project]) -> None:
+    """Write projects to the db in one write, adding the new ones"""
+    debug(f"Writing projects {', '.join(p.name for p in projects)} to the db")
+    with db_lock():
+        get_storage().save_projects([_dump_project(p) for p in projects])
+        _db_cache.clear()
 
 
 def get_project(name: str, throw: bool = True) -> Project:
     """Get a project by name. Optionally throw an error if not found (default)."""
     debug(f"Getting project {name}")
-    projects = get_projects()
-    for item in projects:
-        if item.name == name:
-            return item
+    storage = get_storage()
+    if storage.indexed:
+        project = storage.load_project(name)
+    else:
+        projects_raw = cast(List[Dict[str, Any]], get_db()["projects"])
+        project = next((p for p in projects_raw if p.get("name") == name), None)
+    # only the project asked for is turned into a model
+    if project:
+        return Project(**project)
     error = f"Project {name} not found"
     info(error)
     if throw:
@@ -153,18 +305,60 @@ def get_project(name: str, throw: bool = True) -> Project:
     return None
 
 
+def _check_upserts(projects: List[Project]) -> List[str]:
+    """
+    Check projects to upsert against what the other projects in the db claim, which is indexed once per
+    revision of the db. Conflicts between those other projects are not the upsert's to fix.
+    """
+    db = get_db()
+    projects_raw = cast(List[Dict[str, Any]], db["projects"])
+    if _db_cache.get("claims_of") is not db:
+        _db_cache.update(claims=get_claims(projects_raw), claims_of=db)
+    positions = {p.get("name"): i for i, p in enumerate(projects_raw)}
+    # new projects get added at the end
+    added = len(projects_raw)
+    indexed = []
+    for project in projects:
+        i = positions.get(project.name)
+        if i is None:
+            i, added = added, added + 1
+        indexed.append((i, project.model_dump(mode="json")))
+    return check_projects(indexed, _db_cache["claims"])
+
+
 def upsert_project(project: Project) -> None:
     """Upsert a project"""
     debug(f"Upserting project {project.name}: {project}")
-    projects = get_projects()
-    # find the project in the list
-    for i, p in enumerate(projects):
-        if p.name == project.name:
-            projects[i] = project
-            break
-    else:
-        projects.append(project)
-    write_projects(projects)
+    with db_lock():
+        errors = _check_upserts([project])
+        if errors:
+            raise ValueError(f"Project {project.name} conflicts with the db:\n" + "\n".join(errors))
+        write_project(project)
+
+
+def upsert_projects(projects: List[Project], services: List[Tuple[str, Service]] = None) -> List[str]:
+    """
+    Upsert projects, and then services by project name, at once: they are checked together against the db
+    and written in one go, or not at all. Returns the names of the affected projects.
+    """
+    names = [p.name for p in projects]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"Projects {', '.join(duplicates)} are given more than once")
+    with db_lock():
+        changed: Dict[str, Project] = {p.name: p for p in projects}
+        for name, service in services or []:
+            project = changed.get(name) or get_project(name, throw=False)
+            if not project:
+                raise ValueError(f"Project {name} not found")
+            services_by_host = {s.host: s for s in project.services}
+            services_by_host[service.host] = service
+            changed[name] = project.model_copy(update={"services": list(services_by_host.values())})
+        errors = _check_upserts(list(changed.values()))
+        if errors:
+            raise ValueError("The projects conflict with the db:\n" + "\n".join(errors))
+        write_projects_bulk(list(changed.values()))
+    return list(changed)
 
 
 def get_services(project: str = None) -> List[Service]:
@@ -196,21 +390,23 @@ def get_env(project: str | Project, service: str) -> Dict[str, str]:
 
 def upsert_env(project: str | Project, service: str, env: Env) -> None:
     """Upsert the env of a service"""
-    p = get_project(project) if isinstance(project, str) else project
-    debug(f"Upserting env for service {service} in project {p.name}: {env.model_dump_json()}")
-    s = get_service(p, service)
-    s.env = Env(**(s.env.model_dump() | env.model_dump()))
-    upsert_service(project, s)
+    with db_lock():
+        p = get_project(project) if isinstance(project, str) else project
+        debug(f"Upserting env for service {service} in project {p.name}: {env.model_dump_json()}")
+        s = get_service(p, service)
+        s.env = Env(**(s.env.model_dump() | env.model_dump()))
+        upsert_service(project, s)
 
 
 def upsert_service(project: str | Project, service: Service) -> None:
     """Upsert a service"""
-    p = get_project(project) if isinstance(project, str) else project
-    debug(f"Upserting service {service.host} in project {p.name}: {service}")
-    for i, s in enumerate(p.services):
-        if s.host == service.host:
-            p.services[i] = service
-            break
-    else:
-        p.services.append(service)
-    upsert_project(p)
+    with db_lock():
+        p = get_project(project) if isinstance(project, str) else project
+        debug(f"Upserting service {service.host} in project {p.name}: {service}")
+        for i, s in enumerate(p.services):
+            if s.host == service.host:
+                p.services[i] = service
+                break
+        else:
+            p.services.append(service)
+        upsert_project(p)
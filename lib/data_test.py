@@ -1,6 +1,8 @@
 # Generated by CodiumAI
+import copy
 import os
 import sys
+import tempfile
 import unittest
 from unittest import mock
 from unittest.mock import Mock
@@ -8,32 +10,55 @@ from unittest.mock import Mock
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
 from lib.data import (
+    get_db,
     get_project,
     get_projects,
     get_service,
     upsert_env,
     upsert_project,
+    upsert_projects,
+    validate_db,
     write_db,
     write_projects,
 )
 from lib.models import Env, Ingress, Project, Service
+from lib.storage import SqliteStorage
 from lib.test_stubs import test_db, test_projects
 
 
 class TestData(unittest.TestCase):
 
+    # Reading an unchanged db twice parses it only once
+    @mock.patch("os.stat", return_value=mock.Mock(st_mtime_ns=1, st_size=2))
+    @mock.patch("lib.storage.yaml")
+    @mock.patch("builtins.open", new_callable=mock.mock_open)
+    def test_get_db_cached(self, mock_open: Mock, mock_yaml: Mock, _: Mock) -> None:
+        mock_yaml.safe_load.return_value = test_db
+
+        # Call the function under test
+        get_db()
+        result = get_db()
+
+        mock_open.assert_called_once_with("db.yml", encoding="utf-8")
+        mock_yaml.safe_load.assert_called_once()
+        self.assertEqual(result, test_db)
+
     @mock.patch("lib.data.get_db", return_value=test_db.copy())
     @mock.patch(
-        "lib.data.yaml",
+        "lib.storage.yaml",
         return_value={"dump": mock.Mock()},
     )
+    @mock.patch("lib.data.db_lock")
+    @mock.patch("lib.storage.os.replace")
     @mock.patch("builtins.open", new_callable=mock.mock_open)
-    def test_write_db(self, mock_open: Mock, mock_yaml: Mock, _: Mock) -> None:
+    def test_write_db(self, mock_open: Mock, mock_replace: Mock, _: Mock, mock_yaml: Mock, __: Mock) -> None:
 
         # Call the function under test
         write_db({"projects": test_db["projects"]})
 
-        mock_open.assert_called_once_with("db.yml", "w", encoding="utf-8")
+        # The db is replaced atomically
+        mock_open.assert_called_once_with("db.yml.tmp", "w", encoding="utf-8")
+        mock_replace.assert_called_once_with("db.yml.tmp", "db.yml")
 
         # Assert that the mock functions were called correctly
         mock_yaml.dump.assert_called_once_with(
@@ -45,6 +70,36 @@ class TestData(unittest.TestCase):
             mock_open(),
         )
 
+    # Validation returns all errors with their yaml path and remembers valid projects
+    def test_validate_db(self) -> None:
+        db = copy.deepcopy(test_db)
+        db["projects"][2]["services"][0]["ingress"][0]["port"] = "abc"
+        db["projects"][5]["services"][0]["host"] = None
+
+        with (
+            tempfile.TemporaryDirectory() as tmp,
+            mock.patch("lib.data.VALIDATION_CACHE", os.path.join(tmp, "validated.json")),
+            mock.patch("lib.data.get_db", return_value=db),
+        ):
+            # Call the function under test
+            errors = validate_db(throw=False)
+
+            self.assertEqual(
+                errors,
+                [
+                    "projects[2].services[0].ingress[0].port: Input should be a valid integer, "
+                    + "unable to parse string as an integer",
+                    "projects[5].services[0].host: Input should be a valid string",
+                ],
+            )
+            with self.assertRaises(ValueError):
+                validate_db()
+
+            # Unchanged valid projects are skipped the next time
+            with mock.patch("lib.data._validate_projects", return_value=[]) as mock_validate_projects:
+                validate_db(throw=False)
+            mock_validate_projects.assert_called_once_with([(2, db["projects"][2]), (5, db["projects"][5])])
+
     @mock.patch("lib.data.write_db")
     def test_write_projects(self, mock_write_db: Mock) -> None:
 
@@ -93,16 +148,29 @@ class TestData(unittest.TestCase):
         # self.assertEqual(result, test_projects)
 
     # Get a project by name that does not exist
-    @mock.patch(
-        "lib.data.get_projects",
-        return_value=test_projects.copy(),
-    )
+    @mock.patch("lib.data.get_db", return_value=test_db)
     def test_get_nonexistent_project_by_name(self, _: Mock) -> None:
 
         # Call the function under test
         with self.assertRaises(ValueError):
             get_project("nonexistent_project")
 
+    # Get a project by name from the sqlite storage, without loading the whole db
+    @mock.patch("lib.data.get_db")
+    def test_get_project_indexed(self, mock_get_db: Mock) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            storage = SqliteStorage(os.path.join(tmp, "db.sqlite3"))
+            storage.save(test_db)
+
+            with mock.patch("lib.data.get_storage", return_value=storage):
+                # Call the function under test
+                project = get_project("whoami")
+                missing = get_project("nonexistent_project", throw=False)
+
+        self.assertEqual(project, test_projects[5])
+        self.assertIsNone(missing)
+        mock_get_db.assert_not_called()
+
     # Get a service by name that does not exist
     @mock.patch(
         "lib.data.get_project",
@@ -115,17 +183,89 @@ class TestData(unittest.TestCase):
             get_service("project1", "nonexistent_service")
 
     # Upsert a project that does not exist (Fixed)
-    @mock.patch("lib.data.get_projects", return_value=test_projects.copy())
-    @mock.patch("lib.data.write_projects")
-    def test_upsert_nonexistent_project_fixed(self, mock_write_projects: Mock, mock_get_projects: Mock) -> None:
+    @mock.patch("lib.data.get_db", return_value=test_db)
+    @mock.patch("lib.data.get_projects")
+    @mock.patch("lib.data.write_project")
+    def test_upsert_nonexistent_project_fixed(
+        self, mock_write_project: Mock, mock_get_projects: Mock, mock_get_db: Mock
+    ) -> None:
 
         new_project = Project(name="new_project", domain="new_domain")
         # Call the function under test
         upsert_project(new_project)
 
-        # Assert that the mock functions were called correctly
-        mock_get_projects.assert_called_once()
-        mock_write_projects.assert_called_once_with(test_projects + [new_project])
+        # Assert that the mock functions were called correctly, without loading all projects as models
+        mock_get_db.assert_called_once()
+        mock_get_projects.assert_not_called()
+        mock_write_project.assert_called_once_with(new_project)
+
+    # Upsert a project that conflicts with another project
+    @mock.patch("lib.data.get_db", return_value=test_db)
+    @mock.patch("lib.data.write_project")
+    def test_upsert_conflicting_project(self, mock_write_project: Mock, _: Mock) -> None:
+
+        new_project = Project(
+            name="new_project",
+            services=[Service(host="web", ingress=[Ingress(domain="whoami.example.com")])],
+        )
+        # Call the function under test
+        with self.assertRaises(ValueError):
+            upsert_project(new_project)
+
+        mock_write_project.assert_not_called()
+
+    # Upsert a project while other projects in the db conflict with each other
+    @mock.patch("lib.data.write_project")
+    def test_upsert_project_existing_conflict(self, mock_write_project: Mock) -> None:
+        conflicting = Project(
+            name="copy", services=[Service(host="web", ingress=[Ingress(domain="whoami.example.com")])]
+        )
+        db = {**test_db, "projects": [*test_db["projects"], conflicting.model_dump(mode="json")]}
+        new_project = Project(name="new_project", domain="new_domain")
+
+        with mock.patch("lib.data.get_db", return_value=db):
+            # Call the function under test
+            upsert_project(new_project)
+            with self.assertRaises(ValueError):
+                upsert_project(conflicting)
+
+        mock_write_project.assert_called_once_with(new_project)
+
+    # Upsert projects and services in bulk
+    @mock.patch("lib.data.get_db", return_value=test_db)
+    @mock.patch("lib.data.write_projects_bulk")
+    def test_upsert_projects(self, mock_write_projects_bulk: Mock, _: Mock) -> None:
+
+        new_project = Project(name="new_project")
+        service = Service(host="api", image="new/api:latest")
+        # Call the function under test
+        projects = upsert_projects([new_project], [("new_project", service), ("whoami", service)])
+
+        # Both projects are written at once
+        self.assertEqual(projects, ["new_project", "whoami"])
+        mock_write_projects_bulk.assert_called_once()
+        written = mock_write_projects_bulk.call_args[0][0]
+        self.assertEqual(written[0].services, [service])
+        self.assertEqual([s.host for s in written[1].services], ["web", "api"])
+        # The projects in the db are left as they are
+        self.assertEqual([s["host"] for s in test_db["projects"][5]["services"]], ["web"])
+
+    # Upsert projects in bulk of which one conflicts with the db
+    @mock.patch("lib.data.get_db", return_value=test_db)
+    @mock.patch("lib.data.write_projects_bulk")
+    def test_upsert_conflicting_projects(self, mock_write_projects_bulk: Mock, _: Mock) -> None:
+
+        conflicting = Project(
+            name="new_project",
+            services=[Service(host="web", ingress=[Ingress(domain="whoami.example.com")])],
+        )
+        # Call the function under test
+        with self.assertRaises(ValueError):
+            upsert_projects([Project(name="other_project"), conflicting])
+        with self.assertRaises(ValueError):
+            upsert_projects([Project(name="other_project"), Project(name="other_project")])
+
+        mock_write_projects_bulk.assert_not_called()
 
     # Upsert a project's service' env
     @mock.patch("lib.data.get_project", return_value=test_projects[5].model_copy())
@@ -0,0 +1,126 @@
+import os
+from typing import Dict, Iterable, List, Tuple
+
+from lib.models import TLS, Ingress, Project, Router
+
+# Let's Encrypt allows at most 100 names per certificate
+MAX_CERT_NAMES = 100
+
+
+def split_domains(domain: str) -> List[str]:
+    """Get the domains of an ingress, which may hold several separated by commas"""
+    return [d.strip() for d in domain.split(",") if d.strip()] if domain else []
+
+
+def get_zone(domain: str) -> str:
+    """
+    Get the registrable zone of a domain: DOMAIN_SUFFIX when the domain falls under it, the last two labels otherwise.
+    Zones under a multi-label public suffix (like co.uk) need DOMAIN_SUFFIX to be set.
+    """
+    suffix = os.environ.get("DOMAIN_SUFFIX")
+    if suffix and (domain == suffix or domain.endswith(f".{suffix}")):
+        return suffix
+    return ".".join(domain.split(".")[-2:])
+
+
+def group_by_zone(domains: Iterable[str]) -> Dict[str, List[str]]:
+    """Group the domains by zone, both sorted"""
+    zones: Dict[str, List[str]] = {}
+    for domain in sorted(set(domains)):
+        zones.setdefault(get_zone(domain), []).append(domain)
+    return dict(sorted(zones.items()))
+
+
+def get_cert_mode() -> str:
+    """Get how certificates are shared within a zone: "san", "wildcard", or None for a certificate per domain"""
+    mode = os.environ.get("TLS_SHARED_CERTS") or None
+    if mode not in (None, "san", "wildcard"):
+        raise ValueError(f"TLS_SHARED_CERTS must be san or wildcard, not {mode}")
+    if mode == "wildcard" and not os.environ.get("LETSENCRYPT_DNS_PROVIDER"):
+        raise ValueError("Wildcard certificates need a dns challenge, so set LETSENCRYPT_DNS_PROVIDER")
+    return mode
+
+
+def plan_certs(domains: Iterable[str], mode: str = None) -> Dict[str, TLS]:
+    """
+    Plan the shared certificates for the domains, returning the certificate (main domain and sans) per domain.
+    With "san" the domains of a zone share certificates of at most MAX_CERT_NAMES names, with "wildcard" a zone gets
+    one certificate for the zone and *.zone (a wildcard covers one label, so deeper domains keep their own).
+    """
+    mode = mode or get_cert_mode()
+    certs: Dict[str, TLS] = {}
+    if not mode:
+        return certs
+    for zone, zone_domains in group_by_zone(domains).items():
+        if mode == "wildcard":
+            cert = TLS(main=zone, sans=[f"*.{zone}"])
+            for domain in zone_domains:
+                if domain == zone or domain.count(".") == zone.count(".") + 1:
+                    certs[domain] = cert
+            continue
+        for i in range(0, len(zone_domains), MAX_CERT_NAMES):
+            main, *sans = zone_domains[i : i + MAX_CERT_NAMES]
+            cert = TLS(main=main, sans=sans)
+            certs.update({domain: cert for domain in [main, *sans]})
+    return certs
+
+
+def get_certs_to_request(domains: Iterable[str], mode: str = None) -> List[TLS]:
+    """Get the certificates to request for the domains: a shared one per group, and one per remaining domain"""
+    certs = plan_certs(domains, mode)
+    planned = {(cert.main, tuple(cert.sans)): cert for cert in certs.values()}
+    single = [TLS(main=domain) for domain in sorted(set(domains)) if domain not in certs]
+    return list(planned.values()) + single
+
+
+def get_router_certs(domains: List[str], certs: Dict[str, TLS]) -> List[TLS]:
+    """
+    Get the distinct certificates a router needs for its domains, as a router may hold domains of several zones or
+    certificate groups. Domains without a shared certificate get their own. Returns none when no domain has a shared
+    certificate, leaving it to the resolver to take the domains from the router's rule.
+    """
+    if not any(d in certs for d in domains):
+        return []
+    router_certs: Dict[Tuple[str, ...], TLS] = {}
+    for domain in domains:
+        cert = certs.get(domain) or TLS(main=domain)
+        router_certs.setdefault((cert.main, *cert.sans), cert)
+    return list(router_certs.values())
+
+
+def get_merge_key(ingress: Ingress) -> str | None:
+    """
+    Get what the http ingresses that merge_ingress merges into one router have in common besides their domain,
+    or None for an ingress that keeps its own router
+    """
+    if ingress.router != Router.http or ingress.passthrough or ingress.tls or not ingress.domain:
+        return None
+    return ingress.model_dump_json(exclude={"domain"})
+
+
+def merge_ingress(ingress: List[Ingress]) -> List[Ingress]:
+    """
+    Merge the http ingresses of a service that only differ in domain into one with comma separated domains,
+    so they share one router. Ingresses with passthrough or their own tls are left as they are.
+    """
+    merged: List[Ingress] = []
+    by_key: Dict[str, Ingress] = {}
+    for i in ingress:
+        key = get_merge_key(i)
+        if key is None:
+            merged.append(i)
+            continue
+        if key not in by_key:
+            by_key[key] = i.model_copy()
+            merged.append(by_key[key])
+            continue
+        domains = split_domains(by_key[key].domain)
+        by_key[key].domain = ",".join(domains + [d for d in split_domains(i.domain) if d not in domains])
+    return merged
+
+
+def plan_project(project: Project) -> Project:
+    """Get a copy of the project with the ingresses of every service merged"""
+    project = project.model_copy()
+    project.services = [s.model_copy(update={"ingress": merge_ingress(s.ingress or [])}) for s in project.services]
+    return project
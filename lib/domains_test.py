@@ -0,0 +1,92 @@
+import os
+import sys
+import unittest
+from unittest import TestCase, mock
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from lib.domains import (
+    get_certs_to_request,
+    get_router_certs,
+    group_by_zone,
+    merge_ingress,
+    plan_certs,
+)
+from lib.models import TLS, Ingress, Router
+
+
+@mock.patch.dict(os.environ, {"DOMAIN_SUFFIX": "example.co.uk"})
+class TestDomains(TestCase):
+
+    def test_group_by_zone(self) -> None:
+        # Call the function under test
+        zones = group_by_zone(["b.example.com", "a.example.com", "x.example.co.uk", "example.co.uk", "a.example.com"])
+
+        self.assertEqual(
+            zones,
+            {"example.co.uk": ["example.co.uk", "x.example.co.uk"], "example.com": ["a.example.com", "b.example.com"]},
+        )
+
+    def test_merge_ingress(self) -> None:
+        ingress = [
+            Ingress(domain="a.example.com", port=80),
+            Ingress(domain="b.example.com,a.example.com", port=80),
+            Ingress(domain="c.example.com", port=8080),
+            Ingress(domain="d.example.com", port=80, path_prefix="/api"),
+            Ingress(domain="e.example.com", port=80, router=Router.tcp),
+            Ingress(tls=TLS(main="f.example.com"), port=80),
+        ]
+
+        # Call the function under test
+        merged = merge_ingress(ingress)
+
+        self.assertEqual(
+            [i.domain for i in merged],
+            ["a.example.com,b.example.com", "c.example.com", "d.example.com", "e.example.com", None],
+        )
+        # The ingresses of the service are left as they are
+        self.assertEqual(ingress[0].domain, "a.example.com")
+
+    def test_plan_certs(self) -> None:
+        domains = ["a.example.com", "b.example.com", "x.y.example.com", "example.co.uk"]
+
+        # Call the function under test
+        san = plan_certs(domains, "san")
+        wildcard = plan_certs(domains, "wildcard")
+
+        self.assertEqual(san["b.example.com"], TLS(main="a.example.com", sans=["b.example.com", "x.y.example.com"]))
+        self.assertEqual(wildcard["a.example.com"], TLS(main="example.com", sans=["*.example.com"]))
+        # A wildcard covers one label only
+        self.assertNotIn("x.y.example.com", wildcard)
+        self.assertEqual(
+            get_certs_to_request(domains, "wildcard"),
+            [
+                TLS(main="example.co.uk", sans=["*.example.co.uk"]),
+                TLS(main="example.com", sans=["*.example.com"]),
+                TLS(main="x.y.example.com"),
+            ],
+        )
+        self.assertEqual(len(get_certs_to_request([f"{i}.example.com" for i in range(250)], "san")), 3)
+
+    def test_get_router_certs(self) -> None:
+        domains = ["a.example.com", "b.other.org", "c.example.com"]
+        certs = plan_certs([*domains, "x.y.example.com"], "wildcard")
+
+        # Call the function under test
+        router_certs = get_router_certs([*domains, "x.y.example.com"], certs)
+
+        # A router with domains of two zones gets the certificate of both, and one for the domain outside them
+        self.assertEqual(
+            router_certs,
+            [
+                TLS(main="example.com", sans=["*.example.com"]),
+                TLS(main="other.org", sans=["*.other.org"]),
+                TLS(main="x.y.example.com"),
+            ],
+        )
+        self.assertEqual(get_router_certs(["x.y.example.com"], certs), [])
+        self.assertEqual(get_router_certs(domains, {}), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,23 +1,26 @@
 import os
 
-from dotenv import load_dotenv
-
-from lib.proxy import write_proxies
-from lib.upstream import update_upstreams, write_upstreams
+from lib.trace import deploy
 from lib.utils import run_command
 
-load_dotenv()
-
 
 def update_repo() -> None:
     """Update the local git repo"""
-    # execute a git pull with python in the root of this project:
-    if os.environ["PYTHON_ENV"] == "production":
-        run_command("git fetch origin main".split(" "), cwd=".")
-        run_command("git reset --hard origin/main".split(" "), cwd=".")
-    write_proxies()
-    write_upstreams()
-    update_upstreams()
+    # imported on first use, so the api starts without loading the artifact writers
+    # pylint: disable=import-outside-toplevel
+    from lib.artifacts import record_revision
+    from lib.proxy import write_proxies
+    from lib.upstream import update_upstreams, write_upstreams
+
+    with deploy("update_repo"):
+        # execute a git pull with python in the root of this project:
+        if os.environ["PYTHON_ENV"] == "production":
+            run_command("git fetch origin main".split(" "), cwd=".")
+            run_command("git reset --hard origin/main".split(" "), cwd=".")
+        write_proxies()
+        write_upstreams()
+        record_revision()
+        update_upstreams()
     # reload_proxy()
     # restart the api to make sure the new code is running:
     run_command(["bin/start-api.sh"])
@@ -0,0 +1,59 @@
+import os
+import subprocess
+import sys
+import unittest
+from typing import Dict
+from unittest import TestCase
+
+root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+# modules the cli entry points use, which should start without loading the api or rendering stack
+cli_modules = ["lib.data", "lib.proxy", "lib.upstream", "lib.git", "lib.plan"]
+# heavy dependencies that should only be imported on first use
+heavy_modules = ["fastapi", "github_webhooks", "uvicorn", "jinja2", "dotenv"]
+# a generous budget for importing a module, so only real regressions fail
+budget_ms = float(os.environ.get("IMPORT_BUDGET_MS", 750))
+
+
+def get_import_times(module: str) -> Dict[str, float]:
+    """Import a module in a fresh interpreter and get the cumulative import time of everything it imported in ms"""
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        check=True,
+        cwd=root,
+        text=True,
+    )
+    times = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        times[name.strip()] = int(cumulative) / 1000
+    return times
+
+
+class TestImports(TestCase):
+
+    def test_no_heavy_imports(self) -> None:
+        for module in cli_modules:
+            with self.subTest(module=module):
+
+                # Call the function under test
+                times = get_import_times(module)
+
+                self.assertIn(module, times)
+                self.assertEqual([m for m in heavy_modules if m in times], [])
+
+    def test_import_time(self) -> None:
+        for module in cli_modules:
+            with self.subTest(module=module):
+
+                # Call the function under test
+                times = get_import_times(module)
+
+                self.assertLess(times[module], budget_ms)
+
+
+if __name__ == "__main__":
+    unittest.main()
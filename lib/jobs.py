@@ -0,0 +1,272 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import closing, contextmanager
+from logging import error, info
+from typing import Any, Callable, Dict, Iterator, List, Set
+
+from lib.trace import deploy, new_deploy_id
+
+# the deploy queue shared by all api workers
+JOBS_DB = "data/jobs/jobs.db"
+# seconds between polls of an idle worker
+POLL_INTERVAL = 0.5
+# seconds to remember webhook deliveries for, as github redelivers them for up to 3 days
+DELIVERY_TTL = 7 * 24 * 3600
+# seconds after which a pre-pull is forgotten, as when no deploy came for it
+PREPULL_TTL = 3600
+
+_schema = [
+    "PRAGMA journal_mode=WAL",
+    """
+    CREATE TABLE IF NOT EXISTS jobs (
+        id TEXT PRIMARY KEY,
+        name TEXT NOT NULL,
+        kwargs TEXT NOT NULL,
+        status TEXT NOT NULL,
+        worker INTEGER,
+        created REAL NOT NULL,
+        started REAL,
+        finished REAL,
+        error TEXT,
+        key TEXT,
+        run_after REAL NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created)",
+    "CREATE INDEX IF NOT EXISTS jobs_key ON jobs (key, status)",
+    "CREATE TABLE IF NOT EXISTS deliveries (id TEXT PRIMARY KEY, received REAL NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS deliveries_received ON deliveries (received)",
+    """
+    CREATE TABLE IF NOT EXISTS prepulls (
+        job_id TEXT PRIMARY KEY,
+        project TEXT NOT NULL,
+        service TEXT NOT NULL,
+        started REAL NOT NULL,
+        finished REAL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS prepulls_service ON prepulls (project, service)",
+]
+# the jobs dbs the schema was created in by this process
+_ready: Set[str] = set()
+
+
+@contextmanager
+def _connect() -> Iterator[sqlite3.Connection]:
+    # the schema is created again when the file was removed since
+    ready = JOBS_DB in _ready and os.path.exists(JOBS_DB)
+    with closing(sqlite3.connect(JOBS_DB, timeout=30, isolation_level=None)) as db:
+        db.row_factory = sqlite3.Row
+        if not ready:
+            for statement in _schema:
+                db.execute(statement)
+            _ready.add(JOBS_DB)
+        yield db
+
+
+def _to_dict(row: sqlite3.Row) -> Dict[str, Any]:
+    job = dict(row)
+    job["kwargs"] = json.loads(job["kwargs"])
+    return job
+
+
+def add_job(name: str, coalesce_key: str = None, delay: float = 0, **kwargs: Any) -> str:
+    """
+    Queue a job, returning its id (which is also the id of the deploy it runs). A job with a coalesce key is merged
+    into the queued one with the same key, if any, returning the id of that one. A delayed job is only claimed after
+    that many seconds, so the jobs coming in meanwhile can merge into it.
+    """
+    job_id = new_deploy_id()
+    now = time.time()
+    with _connect() as db:
+        db.execute("BEGIN IMMEDIATE")
+        row = (
+            db.execute("SELECT id FROM jobs WHERE key = ? AND status = 'queued' LIMIT 1", (coalesce_key,)).fetchone()
+            if coalesce_key
+            else None
+        )
+        if row:
+            job_id = row["id"]
+            info(f"Merged job {name} into queued job {job_id}")
+        else:
+            db.execute(
+                "INSERT INTO jobs (id, name, kwargs, status, created, key, run_after) "
+                "VALUES (?, ?, ?, 'queued', ?, ?, ?)",
+                (job_id, name, json.dumps(kwargs), now, coalesce_key, now + delay),
+            )
+        db.execute("COMMIT")
+    return job_id
+
+
+def has_queued_job(coalesce_key: str) -> bool:
+    """Whether a job with a coalesce key is queued, so that another one would be merged into it"""
+    with _connect() as db:
+        return bool(db.execute("SELECT 1 FROM jobs WHERE key = ? AND status = 'queued'", (coalesce_key,)).fetchone())
+
+
+def record_delivery(delivery_id: str) -> bool:
+    """Record a webhook delivery, returning False when it was already recorded"""
+    now = time.time()
+    with _connect() as db:
+        db.execute("DELETE FROM deliveries WHERE received < ?", (now - DELIVERY_TTL,))
+        return (
+            db.execute("INSERT OR IGNORE INTO deliveries (id, received) VALUES (?, ?)", (delivery_id, now)).rowcount > 0
+        )
+
+
+def forget_delivery(delivery_id: str) -> None:
+    """Forget a webhook delivery, so it gets handled when it is redelivered"""
+    with _connect() as db:
+        db.execute("DELETE FROM deliveries WHERE id = ?", (delivery_id,))
+
+
+def add_prepull(job_id: str, project: str, service: str) -> bool:
+    """
+    Record a pre-pull of a service for a CI job, returning False when the job already has one, or another job is
+    still pre-pulling the service
+    """
+    now = time.time()
+    with _connect() as db:
+        db.execute("BEGIN IMMEDIATE")
+        db.execute("DELETE FROM prepulls WHERE started < ?", (now - PREPULL_TTL,))
+        row = db.execute(
+            "SELECT 1 FROM prepulls WHERE job_id = ? OR (project = ? AND service = ? AND finished IS NULL)",
+            (job_id, project, service),
+        ).fetchone()
+        if not row:
+            db.execute(
+                "INSERT INTO prepulls (job_id, project, service, started) VALUES (?, ?, ?, ?)",
+                (job_id, project, service, now),
+            )
+        db.execute("COMMIT")
+    return not row
+
+
+def is_prepulling(job_id: str) -> bool:
+    """Whether the pre-pull of a CI job is still running, which ends when the job completes first"""
+    with _connect() as db:
+        return bool(db.execute("SELECT 1 FROM prepulls WHERE job_id = ? AND finished IS NULL", (job_id,)).fetchone())
+
+
+def finish_prepull(job_id: str) -> None:
+    """Mark the pre-pull of a CI job as done, for the next deploy of its service to use"""
+    with _connect() as db:
+        db.execute("UPDATE prepulls SET finished = ? WHERE job_id = ?", (time.time(), job_id))
+
+
+def end_prepull(job_id: str) -> None:
+    """Stop the pre-pull of a CI job when it is still running, as when the job completed or the pull failed"""
+    with _connect() as db:
+        db.execute("DELETE FROM prepulls WHERE job_id = ? AND finished IS NULL", (job_id,))
+
+
+def take_prepulls(project: str, service: str) -> int:
+    """Take the finished pre-pulls of a service, which the deploy pulling it uses up, returning how many there were"""
+    with _connect() as db:
+        return db.execute(
+            "DELETE FROM prepulls WHERE project = ? AND service = ? AND finished IS NOT NULL AND started >= ?",
+            (project, service, time.time() - PREPULL_TTL),
+        ).rowcount
+
+
+def claim_job(worker: int) -> Dict[str, Any]:
+    """Claim the oldest queued job for a worker. Claiming is atomic, so every job runs exactly once."""
+    with _connect() as db:
+        db.execute("BEGIN IMMEDIATE")
+        row = db.execute(
+            "SELECT * FROM jobs WHERE status = 'queued' AND run_after <= ? ORDER BY created LIMIT 1",
+            (time.time(),),
+        ).fetchone()
+        if row:
+            db.execute(
+                "UPDATE jobs SET status = 'running', worker = ?, started = ? WHERE id = ?",
+                (worker, time.time(), row["id"]),
+            )
+        db.execute("COMMIT")
+    return _to_dict(row) if row else None
+
+
+def finish_job(job_id: str, err: str = None) -> None:
+    """Mark a job as done, or failed when given an error"""
+    with _connect() as db:
+        db.execute(
+            "UPDATE jobs SET status = ?, finished = ?, error = ? WHERE id = ?",
+            ("failed" if err else "done", time.time(), err, job_id),
+        )
+
+
+def fail_orphaned_jobs() -> None:
+    """Fail the jobs left running by workers that died"""
+    with _connect() as db:
+        for row in db.execute("SELECT id, worker FROM jobs WHERE status = 'running'").fetchall():
+            try:
+                os.kill(row["worker"], 0)
+            except PermissionError:
+                pass
+            except ProcessLookupError:
+                finish_job(row["id"], f"Worker {row['worker']} died")
+
+
+def get_job(job_id: str) -> Dict[str, Any]:
+    with _connect() as db:
+        row = db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    return _to_dict(row) if row else None
+
+
+def get_jobs(limit: int = 20) -> List[Dict[str, Any]]:
+    """Get the latest jobs, newest first"""
+    with _connect() as db:
+        rows = db.execute("SELECT * FROM jobs ORDER BY created DESC LIMIT ?", (limit,)).fetchall()
+    return [_to_dict(row) for row in rows]
+
+
+def get_latest_job(name: str) -> Dict[str, Any]:
+    """Get the latest job with a name"""
+    with _connect() as db:
+        row = db.execute("SELECT * FROM jobs WHERE name = ? ORDER BY created DESC LIMIT 1", (name,)).fetchone()
+    return _to_dict(row) if row else None
+
+
+def get_queue_depth() -> int:
+    """Get the number of jobs that are queued or running"""
+    with _connect() as db:
+        return int(db.execute("SELECT COUNT(*) FROM jobs WHERE status IN ('queued', 'running')").fetchone()[0])
+
+
+def run_job(job: Dict[str, Any], handlers: Dict[str, Callable[..., Any]]) -> None:
+    """Run a claimed job as a deploy"""
+    try:
+        with deploy(job["name"], deploy_id=job["id"], **job["kwargs"]):
+            handlers[job["name"]](**job["kwargs"])
+    except Exception as e:  # pylint: disable=broad-except
+        error(f"Job {job['id']} failed: {e!r}")
+        finish_job(job["id"], repr(e))
+    else:
+        finish_job(job["id"])
+
+
+class Worker(threading.Thread):
+    """Runs the queued jobs one by one. Every api worker runs one, sharing the queue."""
+
+    def __init__(self, handlers: Dict[str, Callable[..., Any]]) -> None:
+        super().__init__(name="jobs", daemon=True)
+        self.handlers = handlers
+        self.stopping = threading.Event()
+
+    def run(self) -> None:
+        fail_orphaned_jobs()
+        while not self.stopping.is_set():
+            job = claim_job(os.getpid())
+            if not job:
+                self.stopping.wait(POLL_INTERVAL)
+                continue
+            info(f"Worker {os.getpid()} runs job {job['id']}")
+            run_job(job, self.handlers)
+
+    def stop(self) -> None:
+        """Stop after the running job, if any"""
+        self.stopping.set()
+        self.join()
@@ -0,0 +1,96 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import TestCase, mock
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from lib.jobs import (
+    add_job,
+    claim_job,
+    fail_orphaned_jobs,
+    forget_delivery,
+    get_job,
+    get_queue_depth,
+    has_queued_job,
+    record_delivery,
+    run_job,
+)
+
+
+class TestJobs(TestCase):
+
+    def setUp(self) -> None:
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        patcher = mock.patch("lib.jobs.JOBS_DB", os.path.join(self.tmp, "jobs.db"))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_claim_job(self) -> None:
+        job_ids = [add_job("deploy", project=f"project{i}") for i in range(20)]
+
+        # Call the function under test from competing workers
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            claimed = list(executor.map(lambda _: claim_job(os.getpid()), range(30)))
+
+        # Every job is claimed exactly once, oldest first
+        claimed_ids = [job["id"] for job in claimed if job]
+        self.assertEqual(sorted(claimed_ids), sorted(job_ids))
+        self.assertEqual(get_job(job_ids[0])["kwargs"], {"project": "project0"})
+        self.assertEqual(get_queue_depth(), 20)
+
+    @mock.patch("lib.trace._write_span")
+    def test_run_job(self, _: mock.Mock) -> None:
+        ok, failing = mock.Mock(), mock.Mock(side_effect=ValueError("boom"))
+        add_job("ok", project="a")
+        failing_id = add_job("failing")
+
+        # Call the function under test
+        run_job(claim_job(os.getpid()), {"ok": ok, "failing": failing})
+        run_job(claim_job(os.getpid()), {"ok": ok, "failing": failing})
+
+        ok.assert_called_once_with(project="a")
+        self.assertEqual(get_job(failing_id)["status"], "failed")
+        self.assertEqual(get_queue_depth(), 0)
+
+    @mock.patch("lib.jobs.os.kill", side_effect=ProcessLookupError)
+    def test_fail_orphaned_jobs(self, _: mock.Mock) -> None:
+        job_id = add_job("deploy")
+        claim_job(12345)
+
+        # Call the function under test
+        fail_orphaned_jobs()
+
+        job = get_job(job_id)
+        self.assertEqual(job["status"], "failed")
+        self.assertEqual(job["error"], "Worker 12345 died")
+
+    def test_coalesce_jobs(self) -> None:
+        # Call the function under test
+        first = add_job("deploy", coalesce_key="hook:a:web", delay=60, project="a", received_at=1)
+        merged = add_job("deploy", coalesce_key="hook:a:web", delay=60, project="a", received_at=2)
+        other = add_job("deploy", coalesce_key="hook:b:web", project="b")
+
+        # Events for the same project and service become one deploy, which waits for the window to pass
+        self.assertEqual(merged, first)
+        self.assertEqual(get_queue_depth(), 2)
+        self.assertEqual(claim_job(os.getpid())["id"], other)
+        self.assertIsNone(claim_job(os.getpid()))
+        self.assertTrue(has_queued_job("hook:a:web"))
+        self.assertEqual(get_job(first)["kwargs"], {"project": "a", "received_at": 1})
+
+    def test_record_delivery(self) -> None:
+        # Call the function under test
+        recorded = [record_delivery("abc"), record_delivery("abc"), record_delivery("def")]
+
+        self.assertEqual(recorded, [True, False, True])
+        forget_delivery("abc")
+        self.assertTrue(record_delivery("abc"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,163 @@
+import threading
+import time
+from functools import wraps
+from typing import Any, Callable, Dict, List, Tuple, TypeVar
+
+from lib.trace import span
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+_lock = threading.Lock()
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: Dict[str, Any]) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(labels: Labels, extra: Dict[str, str] = None) -> str:
+    pairs = list(labels) + list((extra or {}).items())
+    if not pairs:
+        return ""
+    escaped = [(k, v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for k, v in pairs]
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Metric:
+    """Base for metrics that are rendered in the Prometheus text format"""
+
+    type = "untyped"
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        registry.append(self)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.type}"]
+        return "\n".join(lines + self.samples())
+
+
+class Counter(Metric):
+    """A value that only goes up"""
+
+    type = "counter"
+
+    def __init__(self, name: str, description: str):
+        super().__init__(name, description)
+        self.values: Dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, **labels: Any) -> None:
+        key = _labels(labels)
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels: Any) -> float:
+        return self.values.get(_labels(labels), 0)
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{_format_labels(k)} {_format_value(v)}" for k, v in sorted(self.values.items())]
+
+
+class Gauge(Counter):
+    """A value that can go up and down"""
+
+    type = "gauge"
+
+    def dec(self, amount: float = 1, **labels: Any) -> None:
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels: Any) -> None:
+        with _lock:
+            self.values[_labels(labels)] = value
+
+
+class Histogram(Metric):
+    """Observations counted in cumulative buckets"""
+
+    type = "histogram"
+
+    def __init__(self, name: str, description: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, description)
+        self.buckets = buckets
+        self.values: Dict[Labels, Tuple[List[int], float, int]] = {}
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = _labels(labels)
+        with _lock:
+            counts, total, count = self.values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            counts = [c + 1 if value <= b else c for c, b in zip(counts, self.buckets)]
+            self.values[key] = (counts, total + value, count + 1)
+
+    def get_count(self, **labels: Any) -> int:
+        return self.values[_labels(labels)][2] if _labels(labels) in self.values else 0
+
+    def get_sum(self, **labels: Any) -> float:
+        return self.values[_labels(labels)][1] if _labels(labels) in self.values else 0.0
+
+    def samples(self) -> List[str]:
+        lines = []
+        for key, (counts, total, count) in sorted(self.values.items()):
+            for b, c in zip(self.buckets, counts):
+                lines.append(f"{self.name}_bucket{_format_labels(key, {'le': _format_value(b)})} {c}")
+            lines.append(f"{self.name}_bucket{_format_labels(key, {'le': '+Inf'})} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {count}")
+        return lines
+
+
+registry: List[Metric] = []
+
+stage_duration = Histogram("itsup_stage_duration_seconds", "Duration of deploy pipeline stages")
+command_duration = Histogram("itsup_command_duration_seconds", "Duration of subprocess commands")
+db_cache_hits = Counter("itsup_db_cache_hits_total", "Number of db reads served from cache")
+db_cache_misses = Counter("itsup_db_cache_misses_total", "Number of db reads that parsed db.yml")
+artifact_writes = Counter("itsup_artifact_writes_total", "Number of generated artifacts (re)written")
+deploy_queue_depth = Gauge("itsup_deploy_queue_depth", "Number of deploys scheduled but not yet finished")
+deploy_queue_depth.set(0)
+prepull_duration = Histogram(
+    "itsup_prepull_duration_seconds", "Duration of the pulls of new images done while CI was still running"
+)
+deploy_pull_duration = Histogram(
+    "itsup_deploy_pull_duration_seconds", "Duration of the image pull of a deploy, by whether it was pre-pulled"
+)
+prepull_saved = Counter(
+    "itsup_prepull_saved_seconds_total",
+    "Seconds that pulls of pre-pulled deploys were shorter than the mean pull of deploys without a pre-pull",
+)
+
+
+def timed(stage: str) -> Callable[[F], F]:
+    """Decorator that records the duration of a pipeline stage, and traces it as a span of the active deploy"""
+
+    def decorator(fn: F) -> F:
+        @wraps(fn)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            start = time.perf_counter()
+            try:
+                with span(stage):
+                    return fn(*args, **kwargs)
+            finally:
+                stage_duration.observe(time.perf_counter() - start, stage=stage)
+
+        return wrapper  # type: ignore[return-value]
+
+    return decorator
+
+
+def render() -> str:
+    """Render all metrics in the Prometheus text format"""
+    with _lock:
+        return "\n".join(m.render() for m in registry) + "\n"
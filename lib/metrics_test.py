@@ -0,0 +1,60 @@
+import os
+import sys
+import unittest
+from unittest import TestCase
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from lib.metrics import Counter, Histogram, registry, stage_duration, timed
+
+
+class TestMetrics(TestCase):
+
+    def setUp(self) -> None:
+        self.registry_size = len(registry)
+
+    def tearDown(self) -> None:
+        # drop the metrics created by the tests from the global registry
+        del registry[self.registry_size :]
+
+    def test_counter_render(self) -> None:
+        counter = Counter("test_writes_total", "Test writes")
+        counter.inc(artifact='proxy/"x".conf')
+        counter.inc(2, artifact='proxy/"x".conf')
+
+        self.assertEqual(
+            counter.render(),
+            "# HELP test_writes_total Test writes\n"
+            "# TYPE test_writes_total counter\n"
+            'test_writes_total{artifact="proxy/\\"x\\".conf"} 3',
+        )
+
+    def test_histogram_render(self) -> None:
+        histogram = Histogram("test_duration_seconds", "Test durations", buckets=(0.1, 1.0))
+        histogram.observe(0.05, stage="a")
+        histogram.observe(0.5, stage="a")
+
+        self.assertEqual(
+            histogram.samples(),
+            [
+                'test_duration_seconds_bucket{stage="a",le="0.1"} 1',
+                'test_duration_seconds_bucket{stage="a",le="1"} 2',
+                'test_duration_seconds_bucket{stage="a",le="+Inf"} 2',
+                'test_duration_seconds_sum{stage="a"} 0.55',
+                'test_duration_seconds_count{stage="a"} 2',
+            ],
+        )
+
+    def test_timed_observes_on_error(self) -> None:
+        @timed("test_stage")
+        def fail() -> None:
+            raise ValueError("boom")
+
+        with self.assertRaises(ValueError):
+            fail()
+
+        self.assertEqual(stage_duration.get_count(stage="test_stage"), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
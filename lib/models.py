@@ -1,7 +1,6 @@
 from enum import Enum
 from typing import Any, Dict, List
 
-from github_webhooks.schemas import WebhookCommonPayload
 from pydantic import BaseModel, ConfigDict, model_validator
 
 
@@ -33,9 +32,9 @@ class PluginCrowdsec(Plugin):
 
 
 class PluginRegistry(BaseModel):
-    """Plugin registry"""
+    """Plugin registry, holding the configured plugins by name (see lib.plugins)"""
 
-    crowdsec: PluginCrowdsec
+    model_config = ConfigDict(extra="allow")
 
 
 class Protocol(str, Enum):
@@ -102,6 +101,7 @@ class Ingress(BaseModel):
     def check_passthrough_tcp(cls, data: Any) -> Any:
         if data.passthrough and data.port == 80 and not data.path_prefix == "/.well-known/acme-challenge/":
             raise ValueError("Passthrough is only allowed for ACME challenge on port 80.")
+        return data
 
 
 class Service(BaseModel):
@@ -125,8 +125,13 @@ class Service(BaseModel):
     labels: List[str] = []
     """Extra labels to add to the service. Should not interfere with 
     generated traefik labels for ingress."""
+    readiness_path: str = None
+    """An http path on the first ingress port that must respond successfully before a new container 
+    is considered ready during a rollout. If omitted, the container healthcheck (or state) is used."""
     restart: str = "unless-stopped"
     """The restart policy to use for the service"""
+    rollout_timeout: int = 60
+    """The number of seconds a new container gets to become ready before the rollout is rolled back"""
     volumes: List[str] = []
     """A list of volumes to mount in the service"""
 
@@ -148,15 +153,19 @@ class Project(BaseModel):
     """A list of services to run in the project"""
 
 
-class PingPayload(WebhookCommonPayload):
+class ProjectService(BaseModel):
+    """A service of a project, to upsert in bulk"""
 
-    zen: str
+    project: str
+    """The name of the project the service belongs to"""
+    service: Service
+    """The service to upsert"""
 
 
-class WorkflowJobPayload(WebhookCommonPayload):
-    class WorkflowJob(BaseModel):
-        name: str
-        status: str
-        conclusion: str | None = None
+class BulkUpsert(BaseModel):
+    """Projects and services to upsert at once, with one write and one deploy"""
 
-    workflow_job: WorkflowJob
+    projects: List[Project] = []
+    """The projects to upsert"""
+    services: List[ProjectService] = []
+    """The services to upsert, after the projects"""
@@ -0,0 +1,66 @@
+import difflib
+import os
+from typing import Any, Dict, List
+
+from lib.data import get_projects
+from lib.metrics import timed
+from lib.proxy import render_proxies
+from lib.upstream import render_upstreams
+from lib.utils import is_unchanged
+
+
+def diff_artifacts(artifacts: Dict[str, str]) -> Dict[str, str]:
+    """Diff rendered artifacts against the ones on disk, returning a unified diff per changed path"""
+    diffs = {}
+    for path, content in artifacts.items():
+        if is_unchanged(path, content):
+            continue
+        current = ""
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                current = f.read()
+        diff = difflib.unified_diff(current.splitlines(True), content.splitlines(True), f"a/{path}", f"b/{path}")
+        diffs[path] = "".join(diff)
+    return diffs
+
+
+def get_project_actions(artifacts: Dict[str, str], rollout: bool = False) -> Dict[str, List[str]]:
+    """Get the docker actions an apply would run per upstream project"""
+    upstreams = {path.split("/")[1] for path in artifacts if path.startswith("upstream/")}
+    if os.path.isdir("upstream"):
+        upstreams.update(f.name for f in os.scandir("upstream") if f.is_dir())
+    projects = {p.name: p for p in get_projects()}
+    actions = {}
+    for name in sorted(upstreams):
+        project = projects.get(name)
+        if not project:
+            actions[name] = ["missing from db"]
+        elif not project.enabled:
+            actions[name] = ["down"]
+        else:
+            actions[name] = ["pull", "up"]
+            if rollout:
+                actions[name] += [f"rollout {s.host}" for s in project.services if s.image]
+    return actions
+
+
+@timed("plan")
+def get_plan(rollout: bool = False) -> Dict[str, Any]:
+    """
+    Render all artifacts in memory and plan what an apply would do without changing anything:
+    the diffs of the artifacts that would change and the docker actions per upstream project.
+    """
+    artifacts = {**render_proxies(), **render_upstreams()}
+    return {
+        "artifacts": diff_artifacts(artifacts),
+        "projects": get_project_actions(artifacts, rollout),
+    }
+
+
+def format_plan(plan: Dict[str, Any]) -> str:
+    """Format a plan for the terminal"""
+    lines = [diff.rstrip("\n") for diff in plan["artifacts"].values()]
+    if not plan["artifacts"]:
+        lines.append("No artifacts would change.")
+    lines += [f"{project}: {', '.join(actions)}" for project, actions in plan["projects"].items()]
+    return "\n".join(lines)
@@ -0,0 +1,61 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import TestCase, mock
+from unittest.mock import Mock
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from lib.plan import diff_artifacts, get_plan
+from lib.test_stubs import test_projects
+
+
+class TestPlan(TestCase):
+
+    def setUp(self) -> None:
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.cwd = os.getcwd()
+        os.chdir(self.tmp)
+        self.addCleanup(os.chdir, self.cwd)
+
+    def test_diff_artifacts(self) -> None:
+        with open("unchanged.conf", "w", encoding="utf-8") as f:
+            f.write("a\n")
+        with open("changed.conf", "w", encoding="utf-8") as f:
+            f.write("a\nb\n")
+
+        # Call the function under test
+        diffs = diff_artifacts({"unchanged.conf": "a\n", "changed.conf": "a\nc\n", "new.conf": "d\n"})
+
+        self.assertEqual(
+            diffs,
+            {
+                "changed.conf": "--- a/changed.conf\n+++ b/changed.conf\n@@ -1,2 +1,2 @@\n a\n-b\n+c\n",
+                "new.conf": "--- a/new.conf\n+++ b/new.conf\n@@ -0,0 +1 @@\n+d\n",
+            },
+        )
+
+    @mock.patch("lib.plan.get_projects", return_value=test_projects)
+    @mock.patch("lib.plan.render_upstreams", return_value={"upstream/whoami/docker-compose.yml": "services:\n"})
+    @mock.patch("lib.plan.render_proxies", return_value={"proxy/docker-compose.yml": "services:\n"})
+    def test_get_plan(self, _: Mock, _2: Mock, _3: Mock) -> None:
+        os.makedirs("upstream/minio")
+        os.makedirs("upstream/removed")
+
+        # Call the function under test
+        plan = get_plan(rollout=True)
+
+        self.assertEqual(sorted(plan["artifacts"]), ["proxy/docker-compose.yml", "upstream/whoami/docker-compose.yml"])
+        self.assertEqual(
+            plan["projects"],
+            {"minio": ["down"], "removed": ["missing from db"], "whoami": ["pull", "up", "rollout web"]},
+        )
+        # Nothing was written
+        self.assertFalse(os.path.exists("proxy"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,55 @@
+import importlib
+from functools import cache
+from typing import Any, Callable, Dict, TypeVar, cast
+
+from lib.models import Plugin
+
+P = TypeVar("P", bound=type[Plugin])
+
+# entry point group other packages can register their plugin models under
+ENTRY_POINT_GROUP = "itsup.plugins"
+
+# plugin models by name, either as "module:Class" so the module is only imported once the plugin is used,
+# or as the class itself when registered with @register_plugin
+plugin_models: Dict[str, str | type[Plugin]] = {
+    "crowdsec": "lib.models:PluginCrowdsec",
+}
+
+
+def register_plugin(name: str) -> Callable[[P], P]:
+    """Decorator that registers a plugin model by name"""
+
+    def decorator(model: P) -> P:
+        plugin_models[name] = model
+        get_plugin_model.cache_clear()
+        return model
+
+    return decorator
+
+
+@cache
+def get_plugin_model(name: str) -> type[Plugin]:
+    """Get a plugin model by name, importing its module on first use. Falls back to the generic model."""
+    target: Any = plugin_models.get(name)
+    if target is None:
+        # only plugins missing from the registry are looked up in the installed packages, which is slow to import
+        # pylint: disable-next=import-outside-toplevel
+        from importlib.metadata import entry_points
+
+        found = entry_points(group=ENTRY_POINT_GROUP, name=name)
+        if not found:
+            return Plugin
+        return cast(type[Plugin], next(iter(found)).load())
+    if isinstance(target, str):
+        module, cls = target.split(":")
+        target = getattr(importlib.import_module(module), cls)
+    return cast(type[Plugin], target)
+
+
+def get_plugin(name: str, plugin: Dict[str, Any]) -> Plugin:
+    """
+    Get a plugin from its raw config. Only enabled plugins are validated with their own model,
+    so disabled plugins cost no imports.
+    """
+    model = get_plugin_model(name) if plugin.get("enabled") else Plugin
+    return model.model_validate({"name": name, **plugin})
@@ -0,0 +1,51 @@
+import os
+import sys
+import unittest
+from unittest import TestCase, mock
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from lib.models import Plugin, PluginCrowdsec
+from lib.plugins import get_plugin, get_plugin_model, plugin_models, register_plugin
+
+
+class TestPlugins(TestCase):
+
+    def tearDown(self) -> None:
+        plugin_models.pop("test", None)
+        get_plugin_model.cache_clear()
+
+    def test_get_plugin(self) -> None:
+
+        # Call the function under test
+        plugin = get_plugin("crowdsec", {"enabled": True, "version": "v1", "collections": ["a"]})
+
+        self.assertIsInstance(plugin, PluginCrowdsec)
+        self.assertEqual(plugin.collections, ["a"])
+
+    @mock.patch("lib.plugins.importlib.import_module")
+    def test_get_disabled_plugin(self, mock_import_module: mock.Mock) -> None:
+
+        # Call the function under test
+        plugin = get_plugin("crowdsec", {"enabled": False, "version": "v1", "collections": ["a"]})
+
+        # Disabled plugins are not imported nor validated with their own model
+        mock_import_module.assert_not_called()
+        self.assertIs(type(plugin), Plugin)
+
+    def test_register_plugin(self) -> None:
+        self.assertIs(get_plugin_model("test"), Plugin)
+
+        @register_plugin("test")
+        class PluginTest(Plugin):
+            url: str = None
+
+        # Call the function under test
+        plugin = get_plugin("test", {"enabled": True, "version": "v1", "url": "http://test"})
+
+        self.assertIsInstance(plugin, PluginTest)
+        self.assertEqual(plugin.name, "test")
+
+
+if __name__ == "__main__":
+    unittest.main()
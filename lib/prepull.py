@@ -0,0 +1,99 @@
+import os
+import time
+from logging import info
+from typing import Any, List
+
+from lib.data import get_project, get_service
+from lib.jobs import (
+    PREPULL_TTL,
+    add_prepull,
+    end_prepull,
+    finish_prepull,
+    is_prepulling,
+    take_prepulls,
+)
+from lib.metrics import deploy_pull_duration, prepull_duration, prepull_saved
+from lib.utils import run_command, run_command_output
+
+# seconds between lookups of the manifest a tag points at in the registry, while waiting for CI to push a new one
+PREPULL_POLL_INTERVAL = float(os.environ.get("PREPULL_POLL_INTERVAL", 10))
+
+
+def prepull_enabled() -> bool:
+    """Whether images get pulled while CI is still running (DEPLOY_PREPULL)"""
+    return os.environ.get("DEPLOY_PREPULL", "").lower() in ["1", "true", "yes"]
+
+
+def _get_job_id(project: str, service: str, job_id: Any) -> str:
+    return str(job_id or f"{project}:{service}")
+
+
+def get_manifest_digest(image: str) -> str:
+    """Resolve the digest of the manifest a tag points at in the registry, without pulling anything"""
+    return run_command_output(
+        ["docker", "buildx", "imagetools", "inspect", image, "--format", "{{.Manifest.Digest}}"]
+    ).strip()
+
+
+def get_local_digests(image: str) -> List[str]:
+    """Get the digests of the manifests the local image of a tag was pulled by, or none when it was not pulled yet"""
+    try:
+        output = run_command_output(
+            ["docker", "image", "inspect", "--format", "{{range .RepoDigests}}{{println .}}{{end}}", image]
+        )
+    except Exception:  # pylint: disable=broad-except
+        return []
+    return [line.split("@", 1)[1] for line in output.split() if "@" in line]
+
+
+def prepull(project: str, service: str, job_id: Any = None) -> None:
+    """
+    Pull the image of a service as soon as a CI job of it pushes a new one. Until then only the manifest the tag
+    points at is resolved, every PREPULL_POLL_INTERVAL seconds, as the layers it shares with the deployed image are
+    local already. Once it points at a manifest we don't have, only its new layers get pulled, so the deploy after the
+    job completes finds them local and starts right away. Stops when the job completes first.
+    """
+    p = get_project(project, throw=False)
+    s = get_service(p, service, throw=False) if p else None
+    if not (s and p.enabled and s.image):
+        return
+    job_id = _get_job_id(project, service, job_id)
+    # a job sends both queued and in_progress, and the jobs of a workflow wait for the same image
+    if not add_prepull(job_id, project, service):
+        return
+    info(f'Waiting for a new image of service "{project}:{service}" to pre-pull')
+    deadline = time.time() + PREPULL_TTL
+    try:
+        while get_manifest_digest(s.image) in get_local_digests(s.image):
+            time.sleep(PREPULL_POLL_INTERVAL)
+            if time.time() > deadline or not is_prepulling(job_id):
+                end_prepull(job_id)
+                return
+        info(f'Pre-pulling the new image of service "{project}:{service}"')
+        start = time.perf_counter()
+        run_command(["docker", "compose", "pull", f"{project}-{service}"], cwd=f"upstream/{project}")
+    except Exception:
+        end_prepull(job_id)
+        raise
+    prepull_duration.observe(time.perf_counter() - start)
+    finish_prepull(job_id)
+
+
+def stop_prepull(project: str, service: str, job_id: Any = None) -> None:
+    """Stop waiting for a new image when the CI job completed without pushing one yet"""
+    end_prepull(_get_job_id(project, service, job_id))
+
+
+def record_pull(project: str, service: str, duration: float) -> None:
+    """
+    Record the pull of a deploy. When a pre-pull already pulled the new image, the time saved is how much shorter the
+    pull was than the mean pull of deploys without a pre-pull.
+    """
+    # the finished pre-pulls of the service are used up by this deploy, whichever api worker ran them
+    prepulled = take_prepulls(project, service) > 0
+    deploy_pull_duration.observe(duration, prepulled=str(prepulled).lower())
+    baseline = deploy_pull_duration.get_count(prepulled="false")
+    if prepulled and baseline:
+        saved = max(deploy_pull_duration.get_sum(prepulled="false") / baseline - duration, 0)
+        prepull_saved.inc(saved)
+        info(f'Pre-pulling "{project}:{service}" saved {saved:.2f}s, leaving a pull of {duration:.2f}s')
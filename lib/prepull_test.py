@@ -0,0 +1,113 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from typing import List
+from unittest import TestCase, mock
+from unittest.mock import Mock
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from lib.metrics import deploy_pull_duration, prepull_saved
+from lib.prepull import prepull, record_pull, stop_prepull
+from lib.test_stubs import test_projects
+
+
+def _registry(digests: List[str]) -> Mock:
+    """Fake the docker commands looking up the manifest of the tag in the registry (the next digest per lookup)"""
+
+    def run_command_output(command: List[str]) -> str:
+        if command[1] == "buildx":
+            return digests.pop(0) if len(digests) > 1 else digests[0]
+        return "whoami@sha256:old\n"
+
+    return Mock(side_effect=run_command_output)
+
+
+class TestPrepull(TestCase):
+
+    def setUp(self) -> None:
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        self.enterContext(mock.patch("lib.jobs.JOBS_DB", os.path.join(tmp, "jobs.db")))
+        self.enterContext(mock.patch.dict(deploy_pull_duration.values, clear=True))
+        self.enterContext(mock.patch("time.sleep"))
+
+    @mock.patch("lib.prepull.run_command")
+    @mock.patch("lib.prepull.get_project", return_value=test_projects[5])
+    def test_prepull(self, _: Mock, mock_run_command: Mock) -> None:
+        saved = prepull_saved.get()
+        record_pull("whoami", "web", 4.0)
+        registry = _registry(["sha256:old", "sha256:old", "sha256:new"])
+
+        # Call the function under test
+        with mock.patch("lib.prepull.run_command_output", registry):
+            prepull("whoami", "web", 1)
+            prepull("whoami", "web", 1)
+
+        # The manifest is looked up until the tag moves, and the queued and in_progress events of a job pull once
+        self.assertEqual(len([c for c in registry.call_args_list if c.args[0][1] == "buildx"]), 3)
+        mock_run_command.assert_called_once_with(["docker", "compose", "pull", "whoami-web"], cwd="upstream/whoami")
+
+        record_pull("whoami", "web", 0.5)
+        record_pull("whoami", "web", 2.0)
+
+        # Only the first deploy after the pre-pull counts, saving what it pulled less than a deploy without one
+        self.assertEqual(prepull_saved.get() - saved, 3.5)
+        self.assertEqual(deploy_pull_duration.get_count(prepulled="true"), 1)
+        self.assertEqual(deploy_pull_duration.get_count(prepulled="false"), 2)
+
+    @mock.patch("lib.prepull.run_command")
+    @mock.patch("lib.prepull.get_project", return_value=test_projects[5])
+    def test_prepull_job_completed(self, _: Mock, mock_run_command: Mock) -> None:
+        saved = prepull_saved.get()
+        record_pull("whoami", "web", 4.0)
+
+        # Call the function under test, with the job completing while waiting for the new image
+        with (
+            mock.patch("lib.prepull.run_command_output", _registry(["sha256:old"])),
+            mock.patch("time.sleep", side_effect=lambda _: stop_prepull("whoami", "web", 1)),
+        ):
+            prepull("whoami", "web", 1)
+        record_pull("whoami", "web", 3.0)
+
+        # Nothing was pulled ahead, so the deploy did not get faster from it
+        mock_run_command.assert_not_called()
+        self.assertEqual(prepull_saved.get(), saved)
+        self.assertEqual(deploy_pull_duration.get_count(prepulled="false"), 2)
+
+    @mock.patch("lib.prepull.run_command")
+    @mock.patch("lib.prepull.get_project", return_value=test_projects[5])
+    def test_prepull_per_service(self, _: Mock, mock_run_command: Mock) -> None:
+        registry = _registry(["sha256:new"])
+
+        # Call the function under test
+        with mock.patch("lib.prepull.run_command_output", registry), mock.patch("time.time", return_value=0):
+            prepull("whoami", "web", 1)
+        with mock.patch("lib.prepull.run_command_output", registry):
+            prepull("whoami", "web", 2)
+            prepull("whoami", "web", 2)
+
+        # A pre-pull no deploy came for is forgotten, and does not hold up the one of a later job
+        self.assertEqual(mock_run_command.call_count, 2)
+
+    @mock.patch("lib.prepull.run_command", side_effect=ValueError("pull failed"))
+    @mock.patch("lib.prepull.get_project", return_value=test_projects[5])
+    def test_prepull_failed(self, _: Mock, mock_run_command: Mock) -> None:
+
+        # Call the function under test
+        with mock.patch("lib.prepull.run_command_output", _registry(["sha256:new"])):
+            with self.assertRaises(ValueError):
+                prepull("whoami", "web", 1)
+            with self.assertRaises(ValueError):
+                prepull("whoami", "web", 1)
+        record_pull("whoami", "web", 3.0)
+
+        # A failed pull is retried by the next event of the job, and is not counted
+        self.assertEqual(mock_run_command.call_count, 2)
+        self.assertEqual(deploy_pull_duration.get_count(prepulled="true"), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,91 @@
+import cProfile
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from logging import info
+from typing import Callable, Iterator
+
+PROFILE_DIR = "logs/profiles"
+
+# leaf frames of threads that are idle, which would only add noise to a profile
+_IDLE_FRAMES = [("threading.py", "wait"), ("selectors.py", "select"), ("queue.py", "get")]
+
+
+def _profile_path(name: str, ext: str) -> str:
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    name = re.sub(r"[^\w.-]+", "_", name).strip("_")
+    return f"{PROFILE_DIR}/{name}-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.{ext}"
+
+
+@contextmanager
+def profiled(name: str, enabled: bool = True) -> Iterator[cProfile.Profile]:
+    """Profile a block with cProfile and write the stats to logs/profiles/<name>-<time>-<pid>.pstats"""
+    if not enabled:
+        yield None
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        path = _profile_path(name, "pstats")
+        profiler.dump_stats(path)
+        info(f"Wrote profile to {path}")
+
+
+def serving_threads(loop_ident: int) -> Callable[[threading.Thread], bool]:
+    """
+    Select the threads that serve api requests: the event loop thread and the worker threads sync handlers run in,
+    leaving out background threads like the deploy worker, the status watcher and the reconciler
+    """
+    return lambda thread: thread.ident == loop_ident or thread.name == "AnyIO worker thread"
+
+
+class Sampler:
+    """
+    Samples the stacks of all other threads (or the ones selected by `threads`) at an interval, counting them in
+    the collapsed stack format flamegraph tools take as input. Unlike cProfile it also sees work done in worker threads.
+    """
+
+    def __init__(self, interval: float = 0.005, threads: Callable[[threading.Thread], bool] = None):
+        self.interval = interval
+        self.threads = threads
+        self.stacks: Counter[str] = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self) -> None:
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            selected = {t.ident for t in threading.enumerate() if self.threads(t)} if self.threads else None
+            for ident, frame in sys._current_frames().items():  # pylint: disable=protected-access
+                if ident == me or (selected is not None and ident not in selected):
+                    continue
+                leaf = (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name)
+                if leaf in _IDLE_FRAMES:
+                    continue
+                stack = []
+                while frame:
+                    stack.append(f"{frame.f_code.co_name} ({frame.f_code.co_filename}:{frame.f_code.co_firstlineno})")
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def write(self, name: str) -> str:
+        """Write the collapsed stacks to logs/profiles/<name>-<time>-<pid>.collapsed"""
+        path = _profile_path(name, "collapsed")
+        with open(path, "w", encoding="utf-8") as f:
+            f.writelines(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+        info(f"Wrote profile to {path}")
+        return path
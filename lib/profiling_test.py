@@ -0,0 +1,94 @@
+import os
+import pstats
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import TestCase, mock
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from lib.profiling import Sampler, profiled, serving_threads
+
+
+def _busy(stop: threading.Event) -> None:
+    while not stop.is_set():
+        sum(range(1000))
+
+
+def _background(stop: threading.Event) -> None:
+    while not stop.is_set():
+        sum(range(1000))
+
+
+class TestProfiling(TestCase):
+
+    def setUp(self) -> None:
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        patcher = mock.patch("lib.profiling.PROFILE_DIR", self.tmp)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_profiled_writes_pstats(self) -> None:
+
+        with profiled("apply"):
+            sorted(range(1000), reverse=True)
+
+        files = os.listdir(self.tmp)
+        self.assertEqual(len(files), 1)
+        self.assertTrue(files[0].startswith("apply-") and files[0].endswith(".pstats"))
+        stats = pstats.Stats(os.path.join(self.tmp, files[0]))
+        self.assertTrue(any(func[2] == "<built-in method builtins.sorted>" for func in stats.stats))  # type: ignore
+
+    def test_profiled_disabled(self) -> None:
+
+        with profiled("apply", enabled=False) as profiler:
+            self.assertIsNone(profiler)
+
+        self.assertEqual(os.listdir(self.tmp), [])
+
+    def test_sampler_collapsed_stacks(self) -> None:
+        stop = threading.Event()
+        worker = threading.Thread(target=_busy, args=(stop,))
+        worker.start()
+
+        sampler = Sampler(interval=0.001)
+        sampler.start()
+        time.sleep(0.05)
+        sampler.stop()
+        stop.set()
+        worker.join()
+        path = sampler.write("api-GET-/projects")
+
+        self.assertTrue(os.path.basename(path).startswith("api-GET-_projects-"))
+        with open(path, encoding="utf-8") as f:
+            lines = f.read().splitlines()
+        self.assertTrue(any("_busy" in line for line in lines))
+        self.assertTrue(all(line.rsplit(" ", 1)[1].isdigit() for line in lines))
+
+    def test_sampler_only_serving_threads(self) -> None:
+        stop = threading.Event()
+        worker = threading.Thread(target=_busy, args=(stop,), name="AnyIO worker thread")
+        background = threading.Thread(target=_background, args=(stop,), name="DeployWorker")
+        worker.start()
+        background.start()
+
+        # Call the function under test
+        sampler = Sampler(interval=0.001, threads=serving_threads(threading.get_ident()))
+        sampler.start()
+        time.sleep(0.05)
+        sampler.stop()
+        stop.set()
+        worker.join()
+        background.join()
+
+        stacks = list(sampler.stacks)
+        self.assertTrue(any("_busy" in stack for stack in stacks))
+        self.assertFalse(any("_background" in stack for stack in stacks))
+
+
+if __name__ == "__main__":
+    unittest.main()
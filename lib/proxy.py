@@ -1,18 +1,42 @@
 import os
 from logging import info
-from typing import Callable, Dict, List
-
-from dotenv import load_dotenv
-from jinja2 import Template
+from typing import Any, Callable, Dict, List, Union
 
 from lib.data import get_plugin_registry, get_project, get_projects, get_versions
-from lib.models import Plugin, Protocol, ProxyProtocol, Router
-from lib.utils import run_command
-
-load_dotenv()
-
-
-def get_domains(filter: Callable[[Plugin], bool] = None) -> List[str]:
+from lib.domains import (
+    get_cert_mode,
+    get_router_certs,
+    plan_certs,
+    plan_project,
+    split_domains,
+)
+from lib.metrics import timed
+from lib.models import (
+    TLS,
+    Ingress,
+    Project,
+    Protocol,
+    ProxyProtocol,
+    Router,
+    Service,
+)
+from lib.utils import load_template, run_command, write_files
+
+# the nginx defaults that tuning never goes below
+NGINX_HASH_MAX_SIZE = 512
+NGINX_HASH_BUCKET_SIZE = 64
+NGINX_WORKER_CONNECTIONS = 1024
+# nginx allocates its connections up front, so cap them
+NGINX_MAX_WORKER_CONNECTIONS = 65536
+# the concurrent clients to size the worker connections for, per domain
+NGINX_CLIENTS_PER_DOMAIN = 16
+
+
+def get_domains(
+    filter: Union[
+        Callable[[Project, Service, Ingress], bool], Callable[[Project, Service], bool], Callable[[Project], bool]
+    ] = None,
+) -> List[str]:
     """Get all domains in use"""
     projects = get_projects(filter)
     domains = set()
@@ -20,8 +44,7 @@ def get_domains(filter: Callable[[Plugin], bool] = None) -> List[str]:
     for project in projects:
         for service in project.services:
             for ingress in service.ingress:
-                if ingress.domain:
-                    domains.add(ingress.domain)
+                domains.update(split_domains(ingress.domain))
 
                 if ingress.tls:
                     domains.add(ingress.tls.main)
@@ -29,7 +52,17 @@ def get_domains(filter: Callable[[Plugin], bool] = None) -> List[str]:
                     if ingress.tls.sans:
                         domains.update(ingress.tls.sans)
 
-    return list(domains)
+    return sorted(domains)
+
+
+def get_shared_certs() -> Dict[str, TLS]:
+    """
+    Get the shared certificate per domain when TLS_SHARED_CERTS is set, see lib.domains.plan_certs.
+    Passthrough domains are left out, as their certificates are handled by the services themselves.
+    """
+    if not get_cert_mode():
+        return {}
+    return plan_certs(get_domains(filter=lambda _, _2, i: not i.passthrough))
 
 
 def get_internal_map() -> Dict[str, str]:
@@ -37,111 +70,183 @@ def get_internal_map() -> Dict[str, str]:
     return {d: "terminate:8443" for d in domains}
 
 
+def get_upstream_keepalive() -> int:
+    """Get the number of idle connections to keep open per terminate backend, off (0) unless set"""
+    return int(os.environ.get("NGINX_UPSTREAM_KEEPALIVE", 0))
+
+
+def get_upstream_name(backend: str) -> str:
+    """Get the name of the nginx upstream (keepalive pool) of a backend"""
+    return backend.replace(":", "_")
+
+
 def get_terminate_map() -> Dict[str, str]:
     projects = get_projects(filter=lambda _, _2, i: not i.passthrough)
+    keepalive = get_upstream_keepalive()
     map = {}
     for p in projects:
         for s in p.services:
             prefix = f"{p.name}-" if s.image else ""
             for i in s.ingress:
-                map[i.domain] = f"{prefix}{s.host}:{i.port}"
+                backend = f"{prefix}{s.host}:{i.port}"
+                for domain in split_domains(i.domain):
+                    # point to the upstream holding the keepalive pool, as nginx only looks those up without a port
+                    map[domain] = get_upstream_name(backend) if keepalive else backend
     return map
 
 
+def get_terminate_upstreams() -> Dict[str, str]:
+    """Get the backends of the terminate proxy by upstream name, when they have a keepalive pool"""
+    if not get_upstream_keepalive():
+        return {}
+    projects = get_projects(filter=lambda _, _2, i: not i.passthrough)
+    backends = {f"{p.name}-{s.host}" if s.image else s.host: s for p in projects for s in p.services}
+    return {
+        get_upstream_name(f"{host}:{i.port}"): f"{host}:{i.port}" for host, s in backends.items() for i in s.ingress
+    }
+
+
+def _next_power_of_two(n: int) -> int:
+    return 1 << max(0, n - 1).bit_length()
+
+
+def get_hash_sizes(keys: List[str]) -> Dict[str, int]:
+    """
+    Get the nginx hash sizes that fit the keys, as nginx refuses to start when they don't.
+    A bucket must fit the longest key, which nginx stores after a pointer with 2 bytes for its length,
+    aligned to the pointer size, plus a closing pointer. The max size leaves room to spread the keys.
+    """
+    longest = max((len(k) for k in keys), default=0)
+    entry = 8 + (longest + 2 + 7) // 8 * 8
+    return {
+        "bucket_size": max(NGINX_HASH_BUCKET_SIZE, _next_power_of_two(entry + 8)),
+        "max_size": max(NGINX_HASH_MAX_SIZE, _next_power_of_two(2 * len(keys))),
+    }
+
+
+def get_nginx_tuning(domains: List[str], upstreams: Dict[str, str] = None) -> Dict[str, Any]:
+    """
+    Get the nginx settings for the domains and backends to proxy to: the sizes of the domain hashes, and enough
+    worker connections for a client and a backend connection per request plus the idle keepalive connections.
+    """
+    keepalive = get_upstream_keepalive() if upstreams else 0
+    connections = 2 * NGINX_CLIENTS_PER_DOMAIN * len(domains) + keepalive * len(upstreams or {})
+    worker_connections = min(
+        NGINX_MAX_WORKER_CONNECTIONS, max(NGINX_WORKER_CONNECTIONS, _next_power_of_two(connections))
+    )
+    hash_sizes = get_hash_sizes(domains)
+    return {
+        "worker_connections": worker_connections,
+        # every connection needs a file descriptor, and some more for logs and config
+        "worker_rlimit_nofile": 2 * worker_connections,
+        "hash_bucket_size": hash_sizes["bucket_size"],
+        "hash_max_size": hash_sizes["max_size"],
+        "keepalive": keepalive,
+    }
+
+
 def get_passthrough_map() -> Dict[str, str]:
     projects = get_projects(filter=lambda _, _2, i: i.passthrough)
     map = {}
     for p in projects:
         for s in p.services:
             for i in s.ingress:
-                map[i.domain] = f"{s.host}:{i.port if 'port' in i else 8080}"
+                for domain in split_domains(i.domain):
+                    map[domain] = f"{s.host}:{i.port if 'port' in i else 8080}"
     return map
 
 
-def write_maps() -> None:
+def render_maps() -> Dict[str, str]:
     internal_map = get_internal_map()
     passthrough_map = get_passthrough_map()
     terminate_map = get_terminate_map()
-    with open("proxy/tpl/map.conf.j2", encoding="utf-8") as f:
-        t = f.read()
-    tpl = Template(t)
+    tpl = load_template("proxy/tpl/map.conf.j2")
     internal = tpl.render(map=internal_map)
     passthrough = tpl.render(map=passthrough_map)
     terminate = tpl.render(map=terminate_map)
-    with open("proxy/nginx/map/internal.conf", "w", encoding="utf-8") as f:
-        f.write(internal)
-    with open("proxy/nginx/map/passthrough.conf", "w", encoding="utf-8") as f:
-        f.write(passthrough)
-    with open("proxy/nginx/map/terminate.conf", "w", encoding="utf-8") as f:
-        f.write(terminate)
+    return {
+        "proxy/nginx/map/internal.conf": internal,
+        "proxy/nginx/map/passthrough.conf": passthrough,
+        "proxy/nginx/map/terminate.conf": terminate,
+    }
+
 
+@timed("write_maps")
+def write_maps() -> List[str]:
+    return write_files(render_maps())
 
-def write_proxy() -> None:
+
+def render_proxy() -> Dict[str, str]:
     project = get_project("home-assistant", throw=False)
-    with open("proxy/tpl/proxy.conf.j2", encoding="utf-8") as f:
-        t = f.read()
-    tpl = Template(t)
-    terminate = tpl.render(project=project)
-    with open("proxy/nginx/proxy.conf", "w", encoding="utf-8") as f:
-        f.write(terminate)
+    tuning = get_nginx_tuning(get_domains())
+    tpl = load_template("proxy/tpl/proxy.conf.j2")
+    return {"proxy/nginx/proxy.conf": tpl.render(project=project, tuning=tuning)}
+
 
+@timed("write_proxy")
+def write_proxy() -> List[str]:
+    return write_files(render_proxy())
 
-def write_terminate() -> None:
+
+def render_terminate() -> Dict[str, str]:
     domains = get_domains()
-    with open("proxy/tpl/terminate.conf.j2", encoding="utf-8") as f:
-        t = f.read()
-    tpl = Template(t)
-    terminate = tpl.render(domains=domains)
-    with open("proxy/nginx/terminate.conf", "w", encoding="utf-8") as f:
-        f.write(terminate)
+    upstreams = get_terminate_upstreams()
+    tuning = get_nginx_tuning(domains, upstreams)
+    tpl = load_template("proxy/tpl/terminate.conf.j2")
+    return {"proxy/nginx/terminate.conf": tpl.render(domains=domains, upstreams=upstreams, tuning=tuning)}
+
 
+@timed("write_terminate")
+def write_terminate() -> List[str]:
+    return write_files(render_terminate())
 
-def write_routers() -> None:
+
+def render_routers() -> Dict[str, str]:
     # we only get the stuff with passthrough or hostport + domain as the port 80/443 containers
     # have labels themselves and will be picked up dynamically
     projects_http = get_projects(
         filter=lambda _, s, i: i.router == Router.http
         and (i.passthrough or not s.image or (i.hostport and (i.domain or i.tls)))
     )
-    with open("proxy/tpl/routers-http.yml.j2", encoding="utf-8") as f:
-        t = f.read()
-    tpl_routers_http = Template(t)
+    # one router per group of ingresses that only differ in domain
+    projects_http = [plan_project(p) for p in projects_http]
+    tpl_routers_http = load_template("proxy/tpl/routers-http.yml.j2")
     domain = os.environ.get("TRAEFIK_DOMAIN")
     routers_http = tpl_routers_http.render(
+        certs=get_shared_certs(),
         domain_suffix=os.environ.get("DOMAIN_SUFFIX"),
+        get_router_certs=get_router_certs,
         plugin_registry=get_plugin_registry(),
         projects=projects_http,
         traefik_admin=os.environ.get("TRAEFIK_ADMIN"),
         traefik_rule=f"Host(`{domain}`)",
         trusted_ips_cidrs=os.environ.get("TRUSTED_IPS_CIDRS").split(","),
     )
-    with open("proxy/traefik/dynamic/routers-http.yml", "w", encoding="utf-8") as f:
-        f.write(routers_http)
     projects_tcp = get_projects(
         filter=lambda _, s, i: i.router == Router.tcp and (i.passthrough or not s.image or i.hostport)
     )
-    with open("proxy/tpl/routers-tcp.yml.j2", encoding="utf-8") as f:
-        t = f.read()
-    tpl_routers_tcp = Template(t)
+    tpl_routers_tcp = load_template("proxy/tpl/routers-tcp.yml.j2")
     tpl_routers_tcp.globals["ProxyProtocol"] = ProxyProtocol
     routers_tcp = tpl_routers_tcp.render(
         projects=projects_tcp,
     )
-    with open("proxy/traefik/dynamic/routers-tcp.yml", "w", encoding="utf-8") as f:
-        f.write(routers_tcp)
     projects_udp = get_projects(filter=lambda _, _2, i: i.router == Router.udp)
-    with open("proxy/tpl/routers-udp.yml.j2", encoding="utf-8") as f:
-        t = f.read()
-    tpl_routers_udp = Template(t)
+    tpl_routers_udp = load_template("proxy/tpl/routers-udp.yml.j2")
     routers_udp = tpl_routers_udp.render(projects=projects_udp)
-    with open("proxy/traefik/dynamic/routers-udp.yml", "w", encoding="utf-8") as f:
-        f.write(routers_udp)
+    return {
+        "proxy/traefik/dynamic/routers-http.yml": routers_http,
+        "proxy/traefik/dynamic/routers-tcp.yml": routers_tcp,
+        "proxy/traefik/dynamic/routers-udp.yml": routers_udp,
+    }
+
 
+@timed("write_routers")
+def write_routers() -> List[str]:
+    return write_files(render_routers())
 
-def write_config() -> None:
-    with open("proxy/tpl/traefik.yml.j2", encoding="utf-8") as f:
-        t = f.read()
-    tpl_config_http = Template(t)
+
+def render_config() -> Dict[str, str]:
+    tpl_config_http = load_template("proxy/tpl/traefik.yml.j2")
     tpl_config_http.globals["Protocol"] = Protocol
     tpl_config_http.globals["Router"] = Router
     trusted_ips_cidrs = os.environ.get("TRUSTED_IPS_CIDRS").split(",")
@@ -150,38 +255,55 @@ def write_config() -> None:
     has_plugins = any(plugin.enabled for _, plugin in plugin_registry)
     config_http = tpl_config_http.render(
         has_plugins=has_plugins,
+        le_dns_provider=os.environ.get("LETSENCRYPT_DNS_PROVIDER"),
         le_email=os.environ.get("LETSENCRYPT_EMAIL"),
         le_staging=bool(os.environ.get("LETSENCRYPT_STAGING")),
         plugin_registry=plugin_registry,
         projects=projects_hostport,
         trusted_ips_cidrs=trusted_ips_cidrs,
     )
-    with open("proxy/traefik/traefik.yml", "w", encoding="utf-8") as f:
-        f.write(config_http)
+    return {"proxy/traefik/traefik.yml": config_http}
+
 
+@timed("write_config")
+def write_config() -> List[str]:
+    return write_files(render_config())
 
-def write_compose() -> None:
+
+def render_compose() -> Dict[str, str]:
     plugin_registry = get_plugin_registry()
     versions = get_versions()
-    with open("proxy/tpl/docker-compose.yml.j2", encoding="utf-8") as f:
-        t = f.read()
-    tpl_compose = Template(t)
+    tpl_compose = load_template("proxy/tpl/docker-compose.yml.j2")
     tpl_compose.globals["Protocol"] = Protocol
     projects_hostport = get_projects(filter=lambda _, _2, i: bool(i.hostport))
     compose = tpl_compose.render(versions=versions, projects=projects_hostport, plugin_registry=plugin_registry)
-    with open("proxy/docker-compose.yml", "w", encoding="utf-8") as f:
-        f.write(compose)
+    return {"proxy/docker-compose.yml": compose}
+
+
+@timed("write_compose")
+def write_compose() -> List[str]:
+    return write_files(render_compose())
+
 
+def render_proxies() -> Dict[str, str]:
+    """Render all proxy artifacts, by path"""
+    return {
+        **render_maps(),
+        **render_proxy(),
+        **render_terminate(),
+        **render_routers(),
+        **render_config(),
+        **render_compose(),
+    }
 
-def write_proxies() -> None:
-    write_maps()
-    write_proxy()
-    write_terminate()
-    write_routers()
-    write_config()
-    write_compose()
 
+@timed("write_proxies")
+def write_proxies() -> List[str]:
+    """Write all proxy artifacts, returning the paths of the ones that changed"""
+    return write_maps() + write_proxy() + write_terminate() + write_routers() + write_config() + write_compose()
 
+
+@timed("update_proxy")
 def update_proxy(
     service: str = None,
 ) -> None:
@@ -192,6 +314,14 @@ def update_proxy(
     # rollout_proxy(service)
 
 
+@timed("restart_proxy")
+def restart_proxy(service: str = "traefik") -> None:
+    """Restart a proxy service to make it load its static config"""
+    info(f"Restarting proxy {service}")
+    run_command(["docker", "compose", "restart", service], cwd="proxy")
+
+
+@timed("reload_proxy")
 def reload_proxy(service: str = None) -> None:
     info("Reloading proxy")
     # Execute docker compose command to reload nginx for both 'proxy' and 'terminate' services
@@ -202,6 +332,7 @@ def reload_proxy(service: str = None) -> None:
         )
 
 
+@timed("rollout_proxy")
 def rollout_proxy(service: str = None) -> None:
     info(f"Rolling out proxy {service}")
     for s in [service] if service else ["proxy", "terminate"]:
@@ -0,0 +1,67 @@
+import os
+import sys
+import unittest
+from unittest import TestCase, mock
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from lib.models import Ingress, Project, Service
+from lib.proxy import (
+    get_hash_sizes,
+    get_nginx_tuning,
+    get_terminate_map,
+    get_terminate_upstreams,
+)
+
+_projects = [
+    Project(
+        name="whoami",
+        services=[Service(host="web", image="traefik/whoami:latest", ingress=[Ingress(domain="whoami.dev", port=80)])],
+    ),
+    Project(name="vm", services=[Service(host="192.168.1.2", ingress=[Ingress(domain="vm.dev", port=8080)])]),
+]
+
+
+class TestProxy(TestCase):
+
+    def test_get_hash_sizes(self) -> None:
+        # Call the function under test
+        small = get_hash_sizes(["a.dev", "b.dev"])
+        large = get_hash_sizes([f"{i}.{'sub.' * 20}example.com" for i in range(2000)])
+
+        # Small sets keep the nginx defaults
+        self.assertEqual(small, {"bucket_size": 64, "max_size": 512})
+        # A bucket fits the longest name (pointer + aligned name + end pointer), the hash spreads the names
+        self.assertEqual(large, {"bucket_size": 128, "max_size": 4096})
+
+    @mock.patch.dict(os.environ, {"NGINX_UPSTREAM_KEEPALIVE": "16"})
+    def test_get_nginx_tuning(self) -> None:
+        domains = [f"{i}.example.com" for i in range(100)]
+        upstreams = {f"backend{i}_80": f"backend{i}:80" for i in range(100)}
+
+        # Call the function under test
+        tuning = get_nginx_tuning(domains, upstreams)
+
+        # 2 connections for 16 clients per domain plus 16 idle connections per backend
+        self.assertEqual(tuning["worker_connections"], 8192)
+        self.assertEqual(tuning["worker_rlimit_nofile"], 16384)
+        self.assertEqual(tuning["keepalive"], 16)
+        self.assertEqual(get_nginx_tuning(["a.dev"])["worker_connections"], 1024)
+
+    @mock.patch("lib.proxy.get_projects", return_value=_projects)
+    def test_get_terminate_map_keepalive(self, _: mock.Mock) -> None:
+        # Call the function under test
+        with mock.patch.dict(os.environ, {"NGINX_UPSTREAM_KEEPALIVE": "16"}):
+            map = get_terminate_map()
+            upstreams = get_terminate_upstreams()
+
+        # The domains point to the upstream pools, which nginx can only find without a port
+        self.assertEqual(map, {"whoami.dev": "whoami-web_80", "vm.dev": "192.168.1.2_8080"})
+        self.assertEqual(upstreams, {"whoami-web_80": "whoami-web:80", "192.168.1.2_8080": "192.168.1.2:8080"})
+        # Without keepalive the domains point to the backends themselves
+        self.assertEqual(get_terminate_map(), {"whoami.dev": "whoami-web:80", "vm.dev": "192.168.1.2:8080"})
+        self.assertEqual(get_terminate_upstreams(), {})
+
+
+if __name__ == "__main__":
+    unittest.main()
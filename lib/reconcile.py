@@ -0,0 +1,130 @@
+import os
+import threading
+import time
+from logging import info
+from typing import Dict, List
+
+from lib.jobs import add_job, get_latest_job
+from lib.metrics import timed
+from lib.upstream import (
+    CONFIG_HASH_LABEL,
+    get_config_hashes,
+    write_upstreams,
+)
+from lib.utils import run_command, run_command_output
+
+# container states that need the container to be recreated
+STOPPED_STATES = ["created", "exited", "dead"]
+
+_labels = ["com.docker.compose.project.working_dir", "com.docker.compose.service", CONFIG_HASH_LABEL]
+_format = "\t".join([*[f'{{{{.Label "{label}"}}}}' for label in _labels], "{{.State}}"])
+
+# the actual state of a project: the hashes and states of the containers per service
+Containers = Dict[str, List[Dict[str, str]]]
+
+
+def get_desired_state() -> Dict[str, Dict[str, str]]:
+    """Get the desired state of the upstream projects from the db: the fingerprints of their services"""
+    return get_config_hashes()
+
+
+def get_actual_state() -> Dict[str, Containers]:
+    """Get the containers of all upstream projects with one docker call, by project and service"""
+    out = run_command_output(
+        ["docker", "ps", "-a", "--filter", "label=com.docker.compose.project", "--format", _format]
+    )
+    state: Dict[str, Containers] = {}
+    for line in out.splitlines():
+        working_dir, service, config_hash, container_state = line.split("\t")
+        # only the projects in upstream/, as named by their folder (compose lowercases the project name)
+        if os.path.basename(os.path.dirname(working_dir)) != "upstream":
+            continue
+        project = os.path.basename(working_dir)
+        state.setdefault(project, {}).setdefault(service, []).append({"hash": config_hash, "state": container_state})
+    return state
+
+
+def _get_drift(desired: Dict[str, str], containers: Containers) -> str:
+    """Get why the containers of a project drifted from the fingerprints of its services, or None when they did not"""
+    for service in sorted(desired):
+        if service not in containers:
+            return f"{service} is missing"
+    for service in sorted(containers):
+        if service not in desired:
+            return f"{service} is orphaned"
+        for container in containers[service]:
+            if container["hash"] != desired[service]:
+                return f"{service} has changed"
+            if container["state"] in STOPPED_STATES:
+                return f"{service} is {container['state']}"
+    return None
+
+
+def plan_reconcile(desired: Dict[str, Dict[str, str]], actual: Dict[str, Containers]) -> Dict[str, Dict[str, str]]:
+    """Plan the actions that converge the actual state to the desired state: create, recreate, remove or skip"""
+    plan = {}
+    for project in sorted(desired.keys() | actual.keys()):
+        if project not in actual:
+            plan[project] = {"action": "create", "reason": "no containers"}
+        elif project not in desired:
+            plan[project] = {"action": "remove", "reason": "not enabled in the db"}
+        else:
+            drift = _get_drift(desired[project], actual[project])
+            plan[project] = {"action": "recreate", "reason": drift} if drift else {"action": "skip", "reason": None}
+    return plan
+
+
+def get_reconcile_plan() -> Dict[str, Dict[str, str]]:
+    """Plan a reconcile without changing anything"""
+    return plan_reconcile(get_desired_state(), get_actual_state())
+
+
+@timed("reconcile")
+def reconcile(dry_run: bool = False) -> Dict[str, Dict[str, str]]:
+    """
+    Converge the upstream containers to the db, only touching the projects that drifted.
+    Compose only recreates the services whose config changed, and removes the orphaned ones.
+    Returns the plan that was applied.
+    """
+    if not dry_run:
+        write_upstreams()
+    plan = get_reconcile_plan()
+    if dry_run:
+        return plan
+    for project, step in plan.items():
+        if step["action"] == "skip":
+            continue
+        info(f"Reconciling project {project}: {step['action']} ({step['reason']})")
+        if step["action"] == "remove":
+            cwd = f"upstream/{project}" if os.path.isdir(f"upstream/{project}") else None
+            run_command(["docker", "compose", "-p", project.lower(), "down", "--remove-orphans"], cwd=cwd)
+        else:
+            run_command(["docker", "compose", "up", "-d", "--remove-orphans"], cwd=f"upstream/{project}")
+    return plan
+
+
+# the coalesce key of reconcile jobs, so at most one is queued at a time
+RECONCILE_KEY = "reconcile"
+
+
+class Reconciler(threading.Thread):
+    """
+    Queues a reconcile every interval, unless an api worker already queued one within that interval. A reconcile
+    that is still queued (behind a long deploy, or by another api worker at the same time) gets merged into.
+    """
+
+    def __init__(self, interval: float) -> None:
+        super().__init__(name="reconciler", daemon=True)
+        self.interval = interval
+        self.stopping = threading.Event()
+
+    def run(self) -> None:
+        while not self.stopping.wait(self.interval):
+            job = get_latest_job("reconcile")
+            if job and time.time() - job["created"] < self.interval:
+                continue
+            add_job("reconcile", coalesce_key=RECONCILE_KEY)
+
+    def stop(self) -> None:
+        self.stopping.set()
+        self.join()
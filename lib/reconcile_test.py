@@ -0,0 +1,112 @@
+import os
+import sys
+import unittest
+from unittest import TestCase, mock
+from unittest.mock import Mock, call
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from lib.reconcile import (
+    RECONCILE_KEY,
+    Reconciler,
+    get_actual_state,
+    plan_reconcile,
+    reconcile,
+)
+
+_ps = "\n".join(
+    [
+        "/home/itsup/upstream/whoami\twhoami-web\tabc\trunning",
+        "/home/itsup/upstream/itsUP\titsUP-api\tabc\trunning",
+        "/home/itsup/proxy\ttraefik\t\trunning",
+    ]
+)
+
+_desired = {
+    "whoami": {"whoami-web": "abc"},
+    "changed": {"changed-web": "new"},
+    "stopped": {"stopped-web": "abc"},
+    "orphans": {"orphans-web": "abc"},
+    "new": {"new-web": "abc"},
+}
+
+_actual = {
+    "whoami": {"whoami-web": [{"hash": "abc", "state": "running"}]},
+    "changed": {"changed-web": [{"hash": "old", "state": "running"}]},
+    "stopped": {"stopped-web": [{"hash": "abc", "state": "exited"}]},
+    "orphans": {"orphans-web": [{"hash": "abc", "state": "running"}], "orphans-db": [{"hash": "", "state": "running"}]},
+    "removed": {"removed-web": [{"hash": "abc", "state": "running"}]},
+}
+
+
+class TestReconcile(TestCase):
+
+    @mock.patch("lib.reconcile.run_command_output", return_value=_ps)
+    def test_get_actual_state(self, mock_run_command_output: Mock) -> None:
+        # Call the function under test
+        state = get_actual_state()
+
+        # One docker call gets the upstream projects only, by folder name
+        mock_run_command_output.assert_called_once()
+        self.assertEqual(
+            state,
+            {
+                "whoami": {"whoami-web": [{"hash": "abc", "state": "running"}]},
+                "itsUP": {"itsUP-api": [{"hash": "abc", "state": "running"}]},
+            },
+        )
+
+    def test_plan_reconcile(self) -> None:
+        # Call the function under test
+        plan = plan_reconcile(_desired, _actual)
+
+        self.assertEqual(
+            {project: step["action"] for project, step in plan.items()},
+            {
+                "changed": "recreate",
+                "new": "create",
+                "orphans": "recreate",
+                "removed": "remove",
+                "stopped": "recreate",
+                "whoami": "skip",
+            },
+        )
+        self.assertEqual(plan["orphans"]["reason"], "orphans-db is orphaned")
+
+    @mock.patch("lib.reconcile.run_command")
+    @mock.patch("lib.reconcile.get_actual_state", return_value=_actual)
+    @mock.patch("lib.reconcile.get_desired_state", return_value=_desired)
+    @mock.patch("lib.reconcile.write_upstreams")
+    def test_reconcile(self, mock_write_upstreams: Mock, _: Mock, _2: Mock, mock_run_command: Mock) -> None:
+        # Call the function under test
+        reconcile()
+
+        # Only the projects that drifted are touched
+        mock_write_upstreams.assert_called_once()
+        up = ["docker", "compose", "up", "-d", "--remove-orphans"]
+        self.assertEqual(
+            mock_run_command.call_args_list,
+            [
+                call(up, cwd="upstream/changed"),
+                call(up, cwd="upstream/new"),
+                call(up, cwd="upstream/orphans"),
+                call(["docker", "compose", "-p", "removed", "down", "--remove-orphans"], cwd=None),
+                call(up, cwd="upstream/stopped"),
+            ],
+        )
+
+    @mock.patch("lib.reconcile.add_job")
+    @mock.patch("lib.reconcile.get_latest_job", return_value={"created": 0})
+    def test_reconciler(self, _: Mock, mock_add_job: Mock) -> None:
+        reconciler = Reconciler(60)
+
+        # Call the function under test
+        with mock.patch.object(reconciler.stopping, "wait", side_effect=[False, True]):
+            reconciler.run()
+
+        # A reconcile that is still queued gets merged into instead of queueing another
+        mock_add_job.assert_called_once_with("reconcile", coalesce_key=RECONCILE_KEY)
+
+
+if __name__ == "__main__":
+    unittest.main()
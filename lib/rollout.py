@@ -0,0 +1,110 @@
+import time
+import urllib.request
+from logging import debug, info
+from typing import List
+
+from lib.utils import run_command, run_command_output
+
+# container states that mean a container is serving (healthy when it has a healthcheck, running otherwise)
+READY_STATES = ["healthy", "running"]
+# container states that will never turn ready
+FAILED_STATES = ["unhealthy", "exited", "dead"]
+
+
+def get_container_ids(project: str, service: str) -> List[str]:
+    """Get the ids of the running containers of a project's service"""
+    out = run_command_output(["docker", "compose", "ps", "-q", f"{project}-{service}"], cwd=f"upstream/{project}")
+    return out.split()
+
+
+def get_container_state(container_id: str) -> str:
+    """Get the health status of a container, or its state when it has no healthcheck"""
+    out = run_command_output(
+        [
+            "docker",
+            "inspect",
+            "--format",
+            "{{if .State.Health}}{{.State.Health.Status}}{{else}}{{.State.Status}}{{end}}",
+            container_id,
+        ]
+    )
+    return out.strip()
+
+
+def get_container_ip(container_id: str) -> str:
+    """Get the first ip address of a container"""
+    out = run_command_output(
+        ["docker", "inspect", "--format", "{{range .NetworkSettings.Networks}}{{.IPAddress}} {{end}}", container_id]
+    )
+    return out.split()[0]
+
+
+def is_ready(container_id: str, readiness_path: str = None, port: int = 8080) -> bool:
+    """Check if a container is ready to serve, optionally by polling an http readiness path"""
+    state = get_container_state(container_id)
+    if state in FAILED_STATES:
+        raise ValueError(f"Container {container_id} is {state}")
+    if state not in READY_STATES:
+        return False
+    if not readiness_path:
+        return True
+    url = f"http://{get_container_ip(container_id)}:{port}{readiness_path}"
+    try:
+        with urllib.request.urlopen(url, timeout=2) as response:
+            return response.status < 400
+    except OSError:
+        return False
+
+
+def wait_ready(container_ids: List[str], readiness_path: str = None, port: int = 8080, timeout: int = 60) -> bool:
+    """Poll containers with backoff until they are all ready or the timeout expires"""
+    deadline = time.monotonic() + timeout
+    delay = 0.5
+    pending = list(container_ids)
+    while True:
+        pending = [c for c in pending if not is_ready(c, readiness_path, port)]
+        if not pending:
+            return True
+        if time.monotonic() + delay > deadline:
+            return False
+        debug(f"Waiting {delay}s for containers {pending} to become ready")
+        time.sleep(delay)
+        delay = min(delay * 2, 5)
+
+
+def remove_containers(container_ids: List[str], log_file: str = "logs/error.log") -> None:
+    """Stop and remove containers"""
+    run_command(["docker", "stop", *container_ids], log_file=log_file)
+    run_command(["docker", "rm", *container_ids], log_file=log_file)
+
+
+def rollout(project: str, service: str, readiness_path: str = None, port: int = 8080, timeout: int = 60) -> None:
+    """
+    Replace the containers of a service without downtime: start new containers next to the old ones,
+    wait for them to be ready and only then retire the old ones. Rolls back when they don't get ready in time.
+    """
+    name = f"{project}-{service}"
+    cwd = f"upstream/{project}"
+    # rollouts run in parallel, so each writes the output of its commands to its own log
+    log_file = f"logs/rollout-{name}.log"
+    old = get_container_ids(project, service)
+    if not old:
+        info(f'No running containers for "{project}:{service}", starting it')
+        run_command(["docker", "compose", "up", "-d", "--no-deps", name], cwd=cwd, log_file=log_file)
+        return
+    run_command(
+        ["docker", "compose", "up", "-d", "--no-deps", "--no-recreate", "--scale", f"{name}={len(old) * 2}", name],
+        cwd=cwd,
+        log_file=log_file,
+    )
+    new = [c for c in get_container_ids(project, service) if c not in old]
+    try:
+        ready = wait_ready(new, readiness_path, port, timeout)
+    except ValueError as e:
+        info(str(e))
+        ready = False
+    if not ready:
+        info(f'Rollout of "{project}:{service}" failed, rolling back')
+        remove_containers(new, log_file)
+        raise TimeoutError(f"Service {project}:{service} did not become ready and was rolled back")
+    remove_containers(old, log_file)
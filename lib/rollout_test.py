@@ -0,0 +1,84 @@
+import os
+import sys
+import unittest
+from unittest import TestCase, mock
+from unittest.mock import Mock, call
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from lib.rollout import rollout, wait_ready
+
+
+class TestRollout(TestCase):
+
+    @mock.patch("lib.rollout.wait_ready", return_value=True)
+    @mock.patch("lib.rollout.run_command")
+    @mock.patch("lib.rollout.get_container_ids", side_effect=[["old"], ["old", "new"]])
+    def test_rollout_retires_old_containers(self, _: Mock, mock_run_command: Mock, mock_wait_ready: Mock) -> None:
+
+        # Call the function under test
+        rollout("my-project", "web", readiness_path="/healthz", port=8080, timeout=30)
+
+        # Assert that the new container is started next to the old one and waited for
+        mock_wait_ready.assert_called_once_with(["new"], "/healthz", 8080, 30)
+        mock_run_command.assert_has_calls(
+            [
+                call(
+                    [
+                        "docker",
+                        "compose",
+                        "up",
+                        "-d",
+                        "--no-deps",
+                        "--no-recreate",
+                        "--scale",
+                        "my-project-web=2",
+                        "my-project-web",
+                    ],
+                    cwd="upstream/my-project",
+                    log_file="logs/rollout-my-project-web.log",
+                ),
+                call(["docker", "stop", "old"], log_file="logs/rollout-my-project-web.log"),
+                call(["docker", "rm", "old"], log_file="logs/rollout-my-project-web.log"),
+            ]
+        )
+
+    @mock.patch("lib.rollout.wait_ready", return_value=False)
+    @mock.patch("lib.rollout.run_command")
+    @mock.patch("lib.rollout.get_container_ids", side_effect=[["old"], ["old", "new"]])
+    def test_rollout_rolls_back_when_not_ready(self, _: Mock, mock_run_command: Mock, _2: Mock) -> None:
+
+        # Call the function under test
+        with self.assertRaises(TimeoutError):
+            rollout("my-project", "web")
+
+        # Assert that the new container is removed and the old one is left alone
+        log_file = "logs/rollout-my-project-web.log"
+        mock_run_command.assert_has_calls(
+            [call(["docker", "stop", "new"], log_file=log_file), call(["docker", "rm", "new"], log_file=log_file)]
+        )
+        self.assertNotIn(call(["docker", "stop", "old"], log_file=log_file), mock_run_command.mock_calls)
+
+    @mock.patch("time.sleep")
+    @mock.patch("lib.rollout.get_container_state", side_effect=["starting", "starting", "healthy"])
+    def test_wait_ready_polls_with_backoff(self, _: Mock, mock_sleep: Mock) -> None:
+
+        # Call the function under test
+        result = wait_ready(["new"], timeout=30)
+
+        self.assertTrue(result)
+        mock_sleep.assert_has_calls([call(0.5), call(1.0)])
+
+    @mock.patch("time.sleep")
+    @mock.patch("lib.rollout.get_container_state", return_value="unhealthy")
+    def test_wait_ready_fails_fast_when_unhealthy(self, _: Mock, mock_sleep: Mock) -> None:
+
+        # Call the function under test
+        with self.assertRaises(ValueError):
+            wait_ready(["new"], timeout=30)
+
+        mock_sleep.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+import os
+from functools import partial
+from logging import error, info
+from multiprocessing import get_context
+from multiprocessing.synchronize import Event
+from socket import socket
+from typing import Any, List, Tuple
+
+from uvicorn import Config, Server
+from uvicorn.supervisors.multiprocess import Multiprocess, Process
+
+PID_FILE = "logs/api.pid"
+
+
+def _serve(config: Config, ready: Event | None, sockets: List[socket]) -> None:
+    """Run a worker, signalling it is ready once the (new) app code is imported"""
+    config.load()
+    if ready:
+        ready.set()
+    Server(config).run(sockets=sockets)
+
+
+class Supervisor(Multiprocess):
+    """
+    Uvicorn's worker supervisor, holding the listening socket while workers come and go.
+    On SIGHUP it replaces the workers one by one, only draining an old worker once its replacement
+    has imported the new code, so a reload drops no requests nor in-flight background deploys.
+    """
+
+    def __init__(self, config: Config, sockets: List[socket], ready_timeout: float = 60) -> None:
+        super().__init__(config, target=partial(_serve, config, None), sockets=sockets)
+        self.ready_timeout = ready_timeout
+
+    def start_process(self) -> Tuple[Process, Event]:
+        """Start a worker, returning it with the event that is set once it is ready"""
+        ready = get_context("spawn").Event()
+        process = Process(self.config, partial(_serve, self.config, ready), self.sockets)
+        process.start()
+        return process, ready
+
+    def restart_all(self) -> None:
+        for idx, old in enumerate(self.processes):
+            new, ready = self.start_process()
+            if not ready.wait(self.ready_timeout):
+                # the new code doesn't load, so keep serving with the old worker
+                error(f"Worker [{new.pid}] did not get ready, keeping worker [{old.pid}]")
+                new.terminate()
+                new.join()
+                continue
+            info(f"Worker [{new.pid}] is ready, draining worker [{old.pid}]")
+            old.terminate()
+            old.join()
+            self.processes[idx] = new
+
+    def run(self) -> None:
+        with open(PID_FILE, "w", encoding="utf-8") as f:
+            f.write(str(os.getpid()))
+        try:
+            super().run()
+        finally:
+            os.remove(PID_FILE)
+
+
+def run(app: str, **kwargs: Any) -> None:
+    """Serve the app (given as import string) with workers that can be reloaded gracefully with SIGHUP"""
+    config = Config(app, **kwargs)
+    sock = config.bind_socket()
+    Supervisor(config, [sock]).run()
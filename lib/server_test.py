@@ -0,0 +1,52 @@
+import os
+import sys
+import unittest
+from unittest import TestCase, mock
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from uvicorn import Config
+
+from lib.server import Supervisor
+
+
+class TestSupervisor(TestCase):
+
+    def setUp(self) -> None:
+        self.supervisor = Supervisor(Config("api.main:app"), [], ready_timeout=1)
+        self.old = mock.Mock()
+        self.supervisor.processes = [self.old]
+
+    @mock.patch("lib.server.Supervisor.start_process")
+    def test_restart_all(self, mock_start_process: mock.Mock) -> None:
+        manager = mock.Mock()
+        new, ready = mock.Mock(), mock.Mock()
+        ready.wait.return_value = True
+        mock_start_process.side_effect = lambda: (manager.start(), (new, ready))[1]
+        manager.attach_mock(self.old.terminate, "terminate")
+
+        # Call the function under test
+        self.supervisor.restart_all()
+
+        # The old worker is only drained once the new one is ready
+        self.assertEqual(manager.mock_calls, [mock.call.start(), mock.call.terminate()])
+        self.old.join.assert_called_once()
+        self.assertEqual(self.supervisor.processes, [new])
+
+    @mock.patch("lib.server.Supervisor.start_process")
+    def test_restart_all_not_ready(self, mock_start_process: mock.Mock) -> None:
+        new, ready = mock.Mock(), mock.Mock()
+        ready.wait.return_value = False
+        mock_start_process.return_value = (new, ready)
+
+        # Call the function under test
+        self.supervisor.restart_all()
+
+        # The old worker keeps serving when the new code doesn't load
+        new.terminate.assert_called_once()
+        self.old.terminate.assert_not_called()
+        self.assertEqual(self.supervisor.processes, [self.old])
+
+
+if __name__ == "__main__":
+    unittest.main()
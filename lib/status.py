@@ -0,0 +1,225 @@
+import json
+import os
+import subprocess
+import threading
+from logging import error, info
+from typing import Any, Callable, Dict, Iterable, Iterator, List
+
+from lib.utils import run_command_output
+
+# seconds to wait before resubscribing when the docker events stream broke off, doubling up to the max
+RETRY_INTERVAL = 1.0
+MAX_RETRY_INTERVAL = 60.0
+
+Status = Dict[str, Any]
+
+
+def get_upstream_project(labels: Dict[str, str]) -> str:
+    """Get the upstream project of a container from its compose labels, or None when it is not in upstream/"""
+    working_dir = labels.get("com.docker.compose.project.working_dir") or ""
+    if os.path.basename(os.path.dirname(working_dir)) != "upstream":
+        return None
+    # named by their folder, as compose lowercases the project name
+    return os.path.basename(working_dir)
+
+
+def list_containers() -> List[Dict[str, Any]]:
+    """Inspect all compose containers with two docker calls"""
+    ids = run_command_output(["docker", "ps", "-aq", "--filter", "label=com.docker.compose.project"]).split()
+    return inspect_containers(ids)
+
+
+def inspect_containers(ids: List[str]) -> List[Dict[str, Any]]:
+    """Inspect containers, adding the repo digest of their image as ImageDigest, as docker only gives its local id"""
+    if not ids:
+        return []
+    containers = json.loads(run_command_output(["docker", "inspect", *ids]))
+    digests = get_image_digests({c["Image"] for c in containers})
+    for container in containers:
+        container["ImageDigest"] = digests.get(container["Image"])
+    return containers
+
+
+def get_image_digests(image_ids: Iterable[str]) -> Dict[str, str]:
+    """Get the repo digest of images by id, with one docker call. Images that were only built locally have none."""
+    if not image_ids:
+        return {}
+    try:
+        output = run_command_output(["docker", "image", "inspect", *sorted(image_ids)])
+    except subprocess.CalledProcessError as e:
+        # docker still prints the images it found when some are gone
+        output = e.stdout or "[]"
+    return {image["Id"]: next(iter(image.get("RepoDigests") or []), None) for image in json.loads(output)}
+
+
+class EventStream:
+    """The events streamed by a docker events process, which can be closed from another thread"""
+
+    def __init__(self, process: subprocess.Popen[str]) -> None:
+        self.process = process
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        with self.process:
+            try:
+                for line in self.process.stdout:
+                    yield json.loads(line)
+            finally:
+                self.process.terminate()
+        if self.process.returncode > 0:
+            raise ValueError(f"docker events exited with {self.process.returncode}")
+
+    def close(self) -> None:
+        """Terminate the process, which ends the stream"""
+        self.process.terminate()
+
+
+def docker_events() -> EventStream:
+    """Subscribe to the events of compose containers, streaming the ones that happen from now on"""
+    command = ["docker", "events", "--format", "{{json .}}", "--filter", "type=container"]
+    command += ["--filter", "label=com.docker.compose.project"]
+    return EventStream(subprocess.Popen(command, stdout=subprocess.PIPE, text=True))
+
+
+class StatusCache:
+    """
+    The status of the upstream containers by project and <project>-<service>, kept up to date by events.
+    A status holds the image by its repo digest (none for images that were only built locally) and its local id.
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.projects: Dict[str, Dict[str, Status]] = {}
+
+    def get_status(self) -> Dict[str, Status]:
+        """Get the status of all services"""
+        with self.lock:
+            return {
+                service: dict(status) for services in self.projects.values() for service, status in services.items()
+            }
+
+    def get_project_status(self, project: str) -> Dict[str, Status]:
+        """Get the status of the services of a project"""
+        with self.lock:
+            return {service: dict(status) for service, status in self.projects.get(project, {}).items()}
+
+    def load(self, containers: List[Dict[str, Any]]) -> None:
+        """Replace the whole table with the status of inspected containers"""
+        projects: Dict[str, Dict[str, Status]] = {}
+        for container in containers:
+            labels = container["Config"]["Labels"] or {}
+            project = get_upstream_project(labels)
+            if project:
+                projects.setdefault(project, {})[labels["com.docker.compose.service"]] = self._from_inspect(container)
+        with self.lock:
+            self.projects = projects
+
+    def update(self, container: Dict[str, Any]) -> None:
+        """Update the status of an inspected container"""
+        labels = container["Config"]["Labels"] or {}
+        project = get_upstream_project(labels)
+        if project:
+            with self.lock:
+                self.projects.setdefault(project, {})[labels["com.docker.compose.service"]] = self._from_inspect(
+                    container
+                )
+
+    @staticmethod
+    def _from_inspect(container: Dict[str, Any]) -> Status:
+        state = container["State"]
+        return {
+            "container": container["Id"],
+            "state": state["Status"],
+            "health": (state.get("Health") or {}).get("Status"),
+            "restarts": container.get("RestartCount", 0),
+            "image": container.get("ImageDigest"),
+            "image_id": container["Image"],
+        }
+
+    def apply_event(self, event: Dict[str, Any], inspect: Callable[[List[str]], List[Dict[str, Any]]]) -> None:
+        """
+        Apply a container event. Only a start, after which the restart count and image can change,
+        needs the container to be inspected.
+        """
+        action = event.get("Action") or event.get("status") or ""
+        container_id = event.get("id") or event["Actor"]["ID"]
+        labels = event.get("Actor", {}).get("Attributes", {})
+        project, service = get_upstream_project(labels), labels.get("com.docker.compose.service")
+        if not project or not service:
+            return
+        if action == "start":
+            for container in inspect([container_id]):
+                self.update(container)
+            return
+        with self.lock:
+            status = self.projects.get(project, {}).get(service)
+            # events of other containers of the service, like the old one in a rollout, don't change its status
+            if not status or status["container"] != container_id:
+                return
+            if action == "destroy":
+                del self.projects[project][service]
+            elif action == "die":
+                status["state"] = "exited"
+            elif action == "pause":
+                status["state"] = "paused"
+            elif action == "unpause":
+                status["state"] = "running"
+            elif action.startswith("health_status:"):
+                status["health"] = action.split(":", 1)[1].strip()
+
+
+class StatusWatcher(threading.Thread):
+    """Keeps a status cache up to date from the docker events stream, resyncing whenever it resubscribes"""
+
+    def __init__(
+        self,
+        cache: StatusCache,
+        events: Callable[[], Iterable[Dict[str, Any]]] = docker_events,
+        containers: Callable[[], List[Dict[str, Any]]] = list_containers,
+        inspect: Callable[[List[str]], List[Dict[str, Any]]] = inspect_containers,
+    ) -> None:
+        super().__init__(name="status", daemon=True)
+        self.cache = cache
+        self.events = events
+        self.containers = containers
+        self.inspect = inspect
+        self.stopping = threading.Event()
+        self.stream: Iterable[Dict[str, Any]] = None
+
+    def watch(self) -> None:
+        """Load the current status, then apply events until the stream ends"""
+        # subscribe before loading, so no event gets lost in between
+        self.stream = self.events()
+        try:
+            if self.stopping.is_set():
+                return
+            self.cache.load(self.containers())
+            for event in self.stream:
+                if self.stopping.is_set():
+                    return
+                self.cache.apply_event(event, self.inspect)
+        finally:
+            self._close()
+
+    def _close(self) -> None:
+        close = getattr(self.stream, "close", None)
+        if close:
+            close()
+
+    def run(self) -> None:
+        interval = RETRY_INTERVAL
+        while not self.stopping.is_set():
+            try:
+                self.watch()
+                interval = RETRY_INTERVAL
+            except Exception as e:  # pylint: disable=broad-except
+                error(f"Watching docker events failed: {e}")
+                interval = min(interval * 2, MAX_RETRY_INTERVAL)
+            if not self.stopping.wait(interval):
+                info("Resubscribing to docker events")
+
+    def stop(self) -> None:
+        """Stop, closing the stream so its docker events process doesn't outlive the watcher"""
+        self.stopping.set()
+        self._close()
+        if self.is_alive():
+            self.join()
@@ -0,0 +1,136 @@
+import json
+import os
+import subprocess
+import sys
+import unittest
+from typing import Any, Dict, List
+from unittest import TestCase, mock
+from unittest.mock import Mock
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from lib.status import EventStream, StatusCache, StatusWatcher, inspect_containers
+
+
+def _labels(project: str, service: str, folder: str = "upstream") -> Dict[str, str]:
+    return {
+        "com.docker.compose.project": project.lower(),
+        "com.docker.compose.project.working_dir": f"/home/itsup/{folder}/{project}",
+        "com.docker.compose.service": service,
+    }
+
+
+def _container(container_id: str, project: str, service: str, restarts: int = 0, **state: Any) -> Dict[str, Any]:
+    return {
+        "Id": container_id,
+        "Config": {"Labels": _labels(project, service)},
+        "Image": f"sha256:{container_id}",
+        "ImageDigest": f"{project}/{service}@sha256:{container_id}",
+        "RestartCount": restarts,
+        "State": {"Status": "running", **state},
+    }
+
+
+def _event(action: str, container_id: str, project: str, service: str, folder: str = "upstream") -> Dict[str, Any]:
+    return {
+        "Type": "container",
+        "Action": action,
+        "Actor": {"ID": container_id, "Attributes": _labels(project, service, folder)},
+    }
+
+
+class FakeEvents:
+    """A fake docker events stream, which records the containers inspected while applying the events"""
+
+    def __init__(self, events: List[Dict[str, Any]], containers: Dict[str, Dict[str, Any]]) -> None:
+        self.events = events
+        self.containers = containers
+        self.inspected: List[str] = []
+
+    def inspect(self, ids: List[str]) -> List[Dict[str, Any]]:
+        self.inspected += ids
+        return [self.containers[i] for i in ids]
+
+
+class TestStatus(TestCase):
+
+    def test_watch(self) -> None:
+        containers = {
+            "a1": _container("a1", "itsUP", "itsUP-api"),
+            "b1": _container("b1", "whoami", "whoami-web", Health={"Status": "starting"}),
+            "b2": _container("b2", "whoami", "whoami-web", restarts=1, Health={"Status": "starting"}),
+        }
+        fake = FakeEvents(
+            [
+                _event("health_status: healthy", "b1", "whoami", "whoami-web"),
+                _event("die", "a1", "itsUP", "itsUP-api"),
+                # a rollout starts a new container and removes the old one
+                _event("start", "b2", "whoami", "whoami-web"),
+                _event("health_status: healthy", "b2", "whoami", "whoami-web"),
+                _event("die", "b1", "whoami", "whoami-web"),
+                _event("destroy", "b1", "whoami", "whoami-web"),
+                # containers outside of upstream/ are ignored
+                _event("start", "p1", "proxy", "traefik", folder="itsup"),
+            ],
+            containers,
+        )
+        cache = StatusCache()
+        watcher = StatusWatcher(
+            cache,
+            events=lambda: fake.events,
+            containers=lambda: [containers["a1"], containers["b1"]],
+            inspect=fake.inspect,
+        )
+
+        # Call the function under test
+        watcher.watch()
+
+        # Only a start needs a docker call
+        self.assertEqual(fake.inspected, ["b2"])
+        self.assertEqual(
+            cache.get_project_status("whoami"),
+            {
+                "whoami-web": {
+                    "container": "b2",
+                    "state": "running",
+                    "health": "healthy",
+                    "restarts": 1,
+                    "image": "whoami/whoami-web@sha256:b2",
+                    "image_id": "sha256:b2",
+                }
+            },
+        )
+        self.assertEqual(cache.get_status()["itsUP-api"]["state"], "exited")
+        self.assertEqual(cache.get_project_status("proxy"), {})
+
+    @mock.patch("lib.status.run_command_output")
+    def test_inspect_containers(self, mock_run_command_output: Mock) -> None:
+        containers = [_container("a1", "whoami", "whoami-web"), _container("b1", "local", "local-web")]
+        for container in containers:
+            del container["ImageDigest"]
+        images = [{"Id": "sha256:a1", "RepoDigests": ["traefik/whoami@sha256:123"]}, {"Id": "sha256:b1"}]
+        mock_run_command_output.side_effect = [json.dumps(containers), json.dumps(images)]
+
+        # Call the function under test
+        inspected = inspect_containers(["a1", "b1"])
+
+        # The images of all containers are inspected with one docker call
+        mock_run_command_output.assert_called_with(["docker", "image", "inspect", "sha256:a1", "sha256:b1"])
+        self.assertEqual([c["ImageDigest"] for c in inspected], ["traefik/whoami@sha256:123", None])
+
+    def test_stop(self) -> None:
+        # a process that streams nothing, like docker events without events
+        with subprocess.Popen(["sleep", "30"], stdout=subprocess.PIPE, text=True) as process:
+            watcher = StatusWatcher(StatusCache(), events=lambda: EventStream(process), containers=lambda: [])
+            watcher.start()
+
+            # Call the function under test
+            watcher.stop()
+
+            # The process is terminated instead of waiting for the next event
+            self.assertFalse(watcher.is_alive())
+            self.assertIsNotNone(process.poll())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,282 @@
+import json
+import os
+import sqlite3
+from contextlib import closing, contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple, cast
+
+import yaml
+
+DB_FILE = "db.yml"
+SQLITE_FILE = "data/db/db.sqlite3"
+SPLIT_DIR = "db"
+
+Db = Dict[str, List[Dict[str, Any]] | Dict[str, Any]]
+
+
+def get_projects(db: Db) -> List[Dict[str, Any]]:
+    """Get the (raw) projects of a db"""
+    return list(cast(List[Dict[str, Any]], db.get("projects") or []))
+
+
+class Storage:
+    """Where the db lives. Set DB_STORAGE to sqlite or split to use another backend than db.yml."""
+
+    # whether load_project reads one project without loading the whole db
+    indexed = False
+
+    def get_revision(self) -> Any:
+        """Get a key that changes whenever the db changes, to cache reads on"""
+        raise NotImplementedError
+
+    def load(self) -> Db:
+        """Load the whole db"""
+        raise NotImplementedError
+
+    def load_project(self, name: str) -> Optional[Dict[str, Any]]:
+        """Load one project by name, or None when it does not exist"""
+        return next((p for p in get_projects(self.load()) if p.get("name") == name), None)
+
+    def save(self, db: Db) -> None:
+        """Save the whole db"""
+        raise NotImplementedError
+
+    def save_project(self, project: Dict[str, Any]) -> None:
+        """Save one project, adding it when new. Backends that can write it on its own override this."""
+        self.save_projects([project])
+
+    def save_projects(self, projects: List[Dict[str, Any]]) -> None:
+        """Save projects in one write, adding the new ones. Backends that can write them on their own override this."""
+        db = self.load()
+        current = get_projects(db)
+        positions = {p["name"]: i for i, p in enumerate(current)}
+        for project in projects:
+            if project["name"] in positions:
+                current[positions[project["name"]]] = project
+            else:
+                positions[project["name"]] = len(current)
+                current.append(project)
+        self.save({**db, "projects": current})
+
+
+class YamlStorage(Storage):
+    """Stores the db in db.yml"""
+
+    def __init__(self, path: str = DB_FILE) -> None:
+        self.path = path
+
+    def get_revision(self) -> Any:
+        stat = os.stat(self.path)
+        return (self.path, stat.st_mtime_ns, stat.st_size)
+
+    def load(self) -> Db:
+        with open(self.path, encoding="utf-8") as f:
+            return yaml.safe_load(f)
+
+    def save(self, db: Db) -> None:
+        # write to a temp file first, so readers never see a partially written db
+        with open(f"{self.path}.tmp", "w", encoding="utf-8") as f:
+            yaml.dump(db, f)
+        os.replace(f"{self.path}.tmp", self.path)
+
+
+class SqliteStorage(Storage):
+    """
+    Stores the db in sqlite, with a row per project keyed on its name that is only rewritten when the project changed,
+    so single projects (and their services) are looked up without loading the rest. Runs in WAL mode so readers
+    never block.
+    """
+
+    indexed = True
+
+    schema = [
+        "PRAGMA journal_mode=WAL",
+        "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS projects (name TEXT PRIMARY KEY, position INTEGER NOT NULL, data TEXT NOT NULL)",
+    ]
+
+    # the db files the schema was created in by this process
+    _ready: Set[str] = set()
+
+    def __init__(self, path: str = SQLITE_FILE) -> None:
+        self.path = path
+
+    @contextmanager
+    def connect(self) -> Iterator[sqlite3.Connection]:
+        # the schema is created again when the file was removed since
+        ready = self.path in self._ready and os.path.exists(self.path)
+        with closing(sqlite3.connect(self.path, timeout=30, isolation_level=None)) as db:
+            if not ready:
+                for statement in self.schema:
+                    db.execute(statement)
+                self._ready.add(self.path)
+            yield db
+
+    def get_revision(self) -> Any:
+        with self.connect() as db:
+            row = db.execute("SELECT value FROM meta WHERE key = 'revision'").fetchone()
+        return (self.path, row[0] if row else None)
+
+    def load(self) -> Db:
+        with self.connect() as db:
+            meta = {k: json.loads(v) for k, v in db.execute("SELECT key, value FROM meta WHERE key != 'revision'")}
+            projects = [json.loads(data) for (data,) in db.execute("SELECT data FROM projects ORDER BY position")]
+        return {**meta, "projects": projects}
+
+    def load_project(self, name: str) -> Optional[Dict[str, Any]]:
+        with self.connect() as db:
+            row = db.execute("SELECT data FROM projects WHERE name = ?", (name,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save(self, db: Db) -> None:
+        projects = {p["name"]: (i, json.dumps(p, sort_keys=True)) for i, p in enumerate(get_projects(db))}
+        with self.connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            for key, value in db.items():
+                if key != "projects":
+                    conn.execute("REPLACE INTO meta (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+            current = {name: (position, data) for name, position, data in conn.execute("SELECT * FROM projects")}
+            for name in current.keys() - projects.keys():
+                conn.execute("DELETE FROM projects WHERE name = ?", (name,))
+            for name, (position, data) in projects.items():
+                if current.get(name) == (position, data):
+                    continue
+                if current.get(name, (None, None))[1] == data:
+                    conn.execute("UPDATE projects SET position = ? WHERE name = ?", (position, name))
+                    continue
+                conn.execute("REPLACE INTO projects (name, position, data) VALUES (?, ?, ?)", (name, position, data))
+            self._bump_revision(conn)
+            conn.execute("COMMIT")
+
+    def save_project(self, project: Dict[str, Any]) -> None:
+        self.save_projects([project])
+
+    def save_projects(self, projects: List[Dict[str, Any]]) -> None:
+        """Save projects in one transaction, bumping the revision once"""
+        with self.connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            for project in projects:
+                name = project["name"]
+                row = conn.execute("SELECT position FROM projects WHERE name = ?", (name,)).fetchone()
+                position = (
+                    row[0] if row else conn.execute("SELECT COALESCE(MAX(position) + 1, 0) FROM projects").fetchone()[0]
+                )
+                data = json.dumps(project, sort_keys=True)
+                conn.execute("REPLACE INTO projects (name, position, data) VALUES (?, ?, ?)", (name, position, data))
+            self._bump_revision(conn)
+            conn.execute("COMMIT")
+
+    @staticmethod
+    def _bump_revision(conn: sqlite3.Connection) -> None:
+        conn.execute(
+            "INSERT INTO meta (key, value) VALUES ('revision', 1) ON CONFLICT (key) DO UPDATE SET value = value + 1"
+        )
+
+
+class SplitYamlStorage(Storage):
+    """
+    Stores the db in a folder, with the versions and plugins in db/db.yml and every project in db/projects/<name>.yml,
+    so an upsert only writes the project it changes, and a reload only parses the files that changed.
+    Projects are ordered by name.
+    """
+
+    # parsed files by path, keyed on their modification time and size
+    _files: Dict[str, Tuple[Any, Any]] = {}
+
+    def __init__(self, path: str = SPLIT_DIR) -> None:
+        self.path = path
+        self.main_file = f"{path}/db.yml"
+        self.projects_path = f"{path}/projects"
+
+    def _project_file(self, name: str) -> str:
+        if not name or "/" in name or name.startswith("."):
+            raise ValueError(f"Project name {name} can not be used as a file name")
+        return f"{self.projects_path}/{name}.yml"
+
+    def _stat_files(self) -> List[Tuple[str, os.stat_result]]:
+        files = [(self.main_file, os.stat(self.main_file))]
+        if os.path.isdir(self.projects_path):
+            entries = sorted(os.scandir(self.projects_path), key=lambda e: e.name)
+            files += [(e.path, e.stat()) for e in entries if e.name.endswith(".yml")]
+        return files
+
+    def get_revision(self) -> Any:
+        return tuple((path, stat.st_mtime_ns, stat.st_size) for path, stat in self._stat_files())
+
+    def _read(self, path: str, stat: os.stat_result) -> Any:
+        key = (stat.st_mtime_ns, stat.st_size)
+        cached = self._files.get(path)
+        if cached and cached[0] == key:
+            return cached[1]
+        with open(path, encoding="utf-8") as f:
+            data = yaml.safe_load(f)
+        self._files[path] = (key, data)
+        return data
+
+    def _write(self, path: str, data: Any) -> None:
+        cached = self._files.get(path)
+        # skip writing what is on disk already, unless the file was changed by hand since it was read or written
+        if cached and cached[1] == data and os.path.exists(path):
+            stat = os.stat(path)
+            if cached[0] == (stat.st_mtime_ns, stat.st_size):
+                return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+            yaml.dump(data, f)
+        os.replace(f"{path}.tmp", path)
+        stat = os.stat(path)
+        self._files[path] = ((stat.st_mtime_ns, stat.st_size), data)
+
+    def load(self) -> Db:
+        (main_file, main_stat), *project_files = self._stat_files()
+        db = dict(self._read(main_file, main_stat) or {})
+        db["projects"] = [self._read(path, stat) for path, stat in project_files]
+        return db
+
+    def save(self, db: Db) -> None:
+        self._write(self.main_file, {k: v for k, v in db.items() if k != "projects"})
+        paths = set()
+        for project in get_projects(db):
+            self.save_project(project)
+            paths.add(self._project_file(project["name"]))
+        for path, _ in self._stat_files()[1:]:
+            if path not in paths:
+                os.remove(path)
+                self._files.pop(path, None)
+
+    def save_project(self, project: Dict[str, Any]) -> None:
+        self._write(self._project_file(project["name"]), project)
+
+    def save_projects(self, projects: List[Dict[str, Any]]) -> None:
+        # check all names before writing any
+        for project in projects:
+            self._project_file(project["name"])
+        for project in projects:
+            self.save_project(project)
+
+
+def get_storage() -> Storage:
+    """Get the configured storage backend"""
+    storage = os.environ.get("DB_STORAGE", "yaml")
+    if storage == "sqlite":
+        return SqliteStorage()
+    if storage == "split":
+        return SplitYamlStorage()
+    return YamlStorage()
+
+
+def import_db(path: str = DB_FILE) -> Storage:
+    """Import a yaml db into the configured storage backend, returning it"""
+    storage = get_storage()
+    if isinstance(storage, YamlStorage):
+        raise ValueError("Set DB_STORAGE to sqlite or split to import a yaml db into another backend")
+    storage.save(YamlStorage(path).load())
+    return storage
+
+
+def export_db(path: str = DB_FILE) -> Storage:
+    """Export the configured storage backend to a yaml db, returning it"""
+    storage = get_storage()
+    if isinstance(storage, YamlStorage):
+        raise ValueError("Set DB_STORAGE to sqlite or split to export another backend to a yaml db")
+    YamlStorage(path).save(storage.load())
+    return storage
@@ -0,0 +1,144 @@
+import copy
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+from typing import Any, List
+from unittest import TestCase, mock
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from lib.storage import SplitYamlStorage, SqliteStorage, YamlStorage, get_projects
+from lib.test_stubs import test_db
+
+sqlite3_connect = sqlite3.connect
+
+
+class TestSqliteStorage(TestCase):
+
+    def setUp(self) -> None:
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.storage = SqliteStorage(os.path.join(self.tmp, "db.sqlite3"))
+
+    def test_save(self) -> None:
+        db = copy.deepcopy(test_db)
+        self.storage.save(db)
+        revision = self.storage.get_revision()
+        db["projects"][1]["description"] = "changed"
+        db["projects"].pop(0)
+
+        # Call the function under test
+        self.storage.save(db)
+
+        self.assertEqual(self.storage.load(), db)
+        self.assertNotEqual(self.storage.get_revision(), revision)
+
+    def test_load_project(self) -> None:
+        self.storage.save(test_db)
+
+        # Call the function under test
+        project = self.storage.load_project(test_db["projects"][2]["name"])
+
+        self.assertEqual(project, test_db["projects"][2])
+        self.assertIsNone(self.storage.load_project("nonexistent"))
+
+    def test_schema_once(self) -> None:
+        self.storage.save(test_db)
+        statements: List[str] = []
+
+        def connect(*args: Any, **kwargs: Any) -> sqlite3.Connection:
+            conn = sqlite3_connect(*args, **kwargs)
+            conn.set_trace_callback(statements.append)
+            return conn
+
+        # Call the function under test
+        with mock.patch("sqlite3.connect", side_effect=connect):
+            self.storage.get_revision()
+            self.storage.get_revision()
+            os.remove(self.storage.path)
+            self.storage.get_revision()
+
+        # The schema is only created again after the file was removed
+        self.assertEqual(statements.count(SqliteStorage.schema[1]), 1)
+        self.assertEqual(len([s for s in statements if s.startswith("SELECT")]), 3)
+
+    def test_save_projects(self) -> None:
+        self.storage.save(test_db)
+        path, revision = self.storage.get_revision()
+        changed = copy.deepcopy(test_db["projects"][1])
+        changed["description"] = "changed"
+        new = {"name": "new", "services": []}
+
+        # Call the function under test
+        self.storage.save_projects([changed, new])
+
+        # One transaction bumps the revision once, keeping the order of the projects
+        self.assertEqual(self.storage.get_revision(), (path, str(int(revision) + 1)))
+        projects = get_projects(self.storage.load())
+        self.assertEqual(projects[1], changed)
+        self.assertEqual(projects[-1], new)
+        self.assertEqual(len(projects), len(test_db["projects"]) + 1)
+
+    def test_roundtrip(self) -> None:
+        yaml_storage = YamlStorage(os.path.join(self.tmp, "db.yml"))
+
+        # Call the function under test
+        self.storage.save(test_db)
+        yaml_storage.save(self.storage.load())
+
+        self.assertEqual(yaml_storage.load(), test_db)
+
+
+class TestSplitYamlStorage(TestCase):
+
+    def setUp(self) -> None:
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.storage = SplitYamlStorage(self.tmp)
+        self.storage.save(test_db)
+
+    def test_save_project(self) -> None:
+        project = copy.deepcopy(test_db["projects"][2])
+        project["description"] = "changed"
+        files = {path: mtime for path, mtime, _ in self.storage.get_revision()}
+
+        # Call the function under test
+        self.storage.save_project(project)
+
+        # Only the project's own file is written
+        changed = [path for path, mtime, _ in self.storage.get_revision() if mtime != files[path]]
+        self.assertEqual(changed, [f"{self.tmp}/projects/{project['name']}.yml"])
+        self.assertIn(project, self.storage.load()["projects"])
+
+    def test_save(self) -> None:
+        db = copy.deepcopy(test_db)
+        removed = db["projects"].pop(0)
+
+        # Call the function under test
+        self.storage.save(db)
+
+        loaded = self.storage.load()
+        self.assertEqual(loaded["plugins"], test_db["plugins"])
+        self.assertEqual(sorted(p["name"] for p in get_projects(loaded)), sorted(p["name"] for p in db["projects"]))
+        self.assertFalse(os.path.exists(f"{self.tmp}/projects/{removed['name']}.yml"))
+
+    def test_save_project_edited_by_hand(self) -> None:
+        project = test_db["projects"][2]
+        path = f"{self.tmp}/projects/{project['name']}.yml"
+        with open(path, "a", encoding="utf-8") as f:
+            f.write("description: edited by hand\n")
+
+        # Call the function under test
+        self.storage.save_project(project)
+
+        # The project as saved wins over the edit
+        with open(path, encoding="utf-8") as f:
+            self.assertNotIn("edited by hand", f.read())
+        self.assertIn(project, self.storage.load()["projects"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,115 @@
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from logging import info
+from typing import Any, Dict, Iterator, List
+
+TRACE_FILE = "logs/deploys.jsonl"
+# rotate the trace file to TRACE_FILE.1 when it grows beyond this size
+TRACE_FILE_MAX_BYTES = 10 * 1024 * 1024
+
+_lock = threading.Lock()
+_current: contextvars.ContextVar[Dict[str, Any]] = contextvars.ContextVar("span", default=None)
+
+
+def _write_span(record: Dict[str, Any]) -> None:
+    line = json.dumps(record, default=str) + "\n"
+    with _lock:
+        if os.path.exists(TRACE_FILE) and os.path.getsize(TRACE_FILE) > TRACE_FILE_MAX_BYTES:
+            os.replace(TRACE_FILE, f"{TRACE_FILE}.1")
+        with open(TRACE_FILE, "a", encoding="utf-8") as f:
+            f.write(line)
+
+
+def get_deploy_id() -> str:
+    """Get the id of the deploy that is being traced, if any"""
+    parent = _current.get()
+    return parent["deploy_id"] if parent else None
+
+
+@contextmanager
+def span(name: str, **attrs: Any) -> Iterator[Dict[str, Any]]:
+    """Time a stage of the active deploy. Does nothing when no deploy is being traced."""
+    parent = _current.get()
+    if not parent:
+        yield None
+        return
+    record = {
+        "deploy_id": parent["deploy_id"],
+        "span_id": uuid.uuid4().hex[:16],
+        "parent_id": parent["span_id"],
+        "name": name,
+        "start": time.time(),
+        "duration": None,
+        "attrs": attrs,
+        "error": None,
+    }
+    token = _current.set(record)
+    start = time.perf_counter()
+    try:
+        yield record
+    except BaseException as e:
+        record["error"] = repr(e)
+        raise
+    finally:
+        record["duration"] = time.perf_counter() - start
+        _current.reset(token)
+        _write_span(record)
+
+
+def add_attrs(**attrs: Any) -> None:
+    """Add attributes to the active span, like the outcome of a stage. Does nothing when no deploy is being traced."""
+    record = _current.get()
+    if record and "attrs" in record:
+        record["attrs"].update(attrs)
+
+
+def new_deploy_id() -> str:
+    return uuid.uuid4().hex[:12]
+
+
+@contextmanager
+def deploy(trigger: str, deploy_id: str = None, **attrs: Any) -> Iterator[str]:
+    """Trace a deploy, yielding its id. Joins the active deploy when one is already being traced."""
+    if _current.get():
+        yield get_deploy_id()
+        return
+    root = {"deploy_id": deploy_id or new_deploy_id(), "span_id": None}
+    token = _current.set(root)
+    try:
+        info(f"Starting deploy {root['deploy_id']} triggered by {trigger}")
+        with span("deploy", trigger=trigger, **attrs):
+            yield root["deploy_id"]
+    finally:
+        _current.reset(token)
+
+
+def get_deploy(deploy_id: str) -> List[Dict[str, Any]]:
+    """Get the spans of a deploy, ordered by start time"""
+    spans = []
+    for file in [f"{TRACE_FILE}.1", TRACE_FILE]:
+        if not os.path.exists(file):
+            continue
+        with open(file, encoding="utf-8") as f:
+            for line in f:
+                # cheap check before parsing as most lines belong to other deploys
+                if deploy_id in line:
+                    record = json.loads(line)
+                    if record["deploy_id"] == deploy_id:
+                        spans.append(record)
+    return sorted(spans, key=lambda s: s["start"])
+
+
+def get_deploys(limit: int = 20) -> List[Dict[str, Any]]:
+    """Get the root spans of the latest deploys, newest first"""
+    deploys: List[Dict[str, Any]] = []
+    for file in [f"{TRACE_FILE}.1", TRACE_FILE]:
+        if not os.path.exists(file):
+            continue
+        with open(file, encoding="utf-8") as f:
+            deploys.extend(json.loads(line) for line in f if '"parent_id": null' in line)
+    return sorted(deploys, key=lambda s: s["start"], reverse=True)[:limit]
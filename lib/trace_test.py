@@ -0,0 +1,62 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import TestCase, mock
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from lib.trace import deploy, get_deploy, get_deploy_id, get_deploys, span
+
+
+class TestTrace(TestCase):
+
+    def setUp(self) -> None:
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        patcher = mock.patch("lib.trace.TRACE_FILE", os.path.join(self.tmp, "deploys.jsonl"))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_nested_spans(self) -> None:
+
+        with deploy("apply") as deploy_id:
+            with span("write_proxies"):
+                with span("write_maps"):
+                    pass
+            # a nested deploy joins the active one
+            with deploy("update_repo") as nested_id:
+                self.assertEqual(nested_id, deploy_id)
+
+        spans = {s["name"]: s for s in get_deploy(deploy_id)}
+
+        self.assertEqual(set(spans), {"deploy", "write_proxies", "write_maps"})
+        self.assertIsNone(spans["deploy"]["parent_id"])
+        self.assertEqual(spans["write_proxies"]["parent_id"], spans["deploy"]["span_id"])
+        self.assertEqual(spans["write_maps"]["parent_id"], spans["write_proxies"]["span_id"])
+        self.assertEqual(spans["deploy"]["attrs"], {"trigger": "apply"})
+        self.assertEqual([d["deploy_id"] for d in get_deploys()], [deploy_id])
+        self.assertIsNone(get_deploy_id())
+
+    def test_span_records_error(self) -> None:
+
+        with self.assertRaises(ValueError):
+            with deploy("apply", deploy_id="abc"):
+                with span("rollout_service"):
+                    raise ValueError("boom")
+
+        spans = get_deploy("abc")
+
+        self.assertEqual([s["error"] for s in spans], ["ValueError('boom')", "ValueError('boom')"])
+
+    def test_span_without_deploy(self) -> None:
+
+        with span("write_maps") as record:
+            self.assertIsNone(record)
+
+        self.assertFalse(os.path.exists(os.path.join(self.tmp, "deploys.jsonl")))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,33 +1,201 @@
+import contextvars
+import hashlib
+import json
 import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
 from logging import info
+from typing import Any, Dict, List, Set, Tuple
 
-from dotenv import load_dotenv
-from jinja2 import Template
+import yaml
 
 from lib.data import get_project, get_projects, get_service
-from lib.models import Project, Protocol, Router
-from lib.utils import run_command
+from lib.domains import get_router_certs, plan_project
+from lib.metrics import timed
+from lib.models import TLS, Ingress, Project, Protocol, Router, Service
+from lib.prepull import record_pull
+from lib.proxy import get_shared_certs
+from lib.rollout import rollout as rollout_container
+from lib.trace import add_attrs
+from lib.utils import load_template, run_command, run_command_output, write_files
 
-load_dotenv()
+# the label holding the fingerprint of the service config a container was created from, to find the ones that changed
+CONFIG_HASH_LABEL = "itsup.config-hash"
+_config_hash_placeholder = "__config_hash__"
+# the compose template, which is only rendered when it was changed: the stock one is emitted from python instead
+COMPOSE_TEMPLATE = "tpl/docker-compose.yml.j2"
+STOCK_COMPOSE_TEMPLATE_HASH = "d8af8b521443a717c6e83ec8e462c6e20293d37f28f66c80f30ef8f5af9961c5"
+# libyaml parses the compose files to fingerprint them many times faster, when pyyaml was built with it
+_yaml_loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
 
 
-def write_upstream(project: Project) -> None:
-    with open("tpl/docker-compose.yml.j2", encoding="utf-8") as f:
-        t = f.read()
-    tpl = Template(t)
+class _Quoted(str):
+    """A scalar that is written in single quotes"""
+
+
+class _Block(str):
+    """A scalar that is written on its own line below its key"""
+
+
+def _needs_discovery(ingress: List[Ingress]) -> bool:
+    """
+    Whether a service needs discovery labels: when one of its ingress entries has a domain or tls and is not using
+    hostport (hostport services are handled by static routers because of their need to restart anyway for new
+    entrypoints)
+    """
+    with_domain = sum(1 for i in ingress if i.domain)
+    with_tls = sum(1 for i in ingress if i.tls)
+    with_hostport = sum(1 for i in ingress if i.domain and i.hostport)
+    return with_domain + with_tls > with_hostport
+
+
+def _get_router_labels(project: Project, service: Service, i: Ingress, certs: Dict[str, TLS]) -> List[str]:
+    """Get the traefik labels that route an ingress of a service"""
+    name = f"{project.name}-{service.host.replace('.', '-')}-{i.port}"
+    router = Router(i.router).value
+    prefix = f"traefik.{router}.routers.{name}"
+    labels = [f"{prefix}.entrypoints=web-secure"]
+    if i.router != Router.udp:
+        domains = ([i.tls.main] + i.tls.sans) if (i.tls and i.tls.main) else i.domain.split(",")
+        host = "HostSNI" if i.router == Router.tcp else "Host"
+        rule = " || ".join(f"{host}(`{d}`)" for d in domains)
+        if i.path_prefix:
+            rule += f" && PathPrefix(`{i.path_prefix}`)"
+        labels += [f"{prefix}.rule={rule}", f"{prefix}.tls.certresolver=letsencrypt"]
+        for n, cert in enumerate([i.tls] if (i.tls and i.tls.main) else get_router_certs(domains, certs)):
+            labels.append(f"{prefix}.tls.domains[{n}].main={cert.main}")
+            labels += [f"{prefix}.tls.domains[{n}].sans[{m}]={san}" for m, san in enumerate(cert.sans)]
+    labels.append(f"{prefix}.service={name}")
+    if i.path_prefix and i.path_remove:
+        labels.append(f"traefik.{router}.middlewares.removeServiceSelector.stripPrefix.prefixes={i.path_prefix}")
+    middlewares = getattr(i, "middlewares", None)
+    if middlewares:
+        labels.append(f"{prefix}.middlewares={','.join(middlewares)}")
+    labels.append(f"traefik.{router}.services.{name}.loadbalancer.server.port={i.port}")
+    return labels
+
+
+def get_compose_service(project: Project, s: Service, certs: Dict[str, TLS], config_hash: str) -> Dict[str, Any]:
+    """Get the compose config of a service. Values that compose takes as they are stay strings."""
+    ingress = s.ingress or []
+    service: Dict[str, Any] = {}
+    if s.command:
+        service["command"] = s.command
+    if s.depends_on:
+        if isinstance(s.depends_on, dict):
+            service["depends_on"] = {f"{project.name}-{k}": _Block(dep) for k, dep in s.depends_on.items()}
+        else:
+            service["depends_on"] = [f"{project.name}-{dep}" for dep in s.depends_on]
+    env = list(s.env)
+    if env:
+        service["environment"] = [_Quoted(f"{k}=" + str(v).replace("'", "''")) for k, v in env]
+    if ingress:
+        service["expose"] = [f"{i.port}/{Protocol[i.protocol].value}" for i in ingress]
+    service["image"] = s.image
+    labels = [f"{CONFIG_HASH_LABEL}={config_hash}"]
+    if _needs_discovery(ingress):
+        labels += ["traefik.enable=true", "traefik.docker.network=proxynet"]
+        for i in ingress:
+            if not i.hostport and (i.domain or (i.tls and i.tls.main)):
+                labels += _get_router_labels(project, s, i, certs)
+    service["labels"] = labels + s.labels
+    if ingress or len(project.services) > 1:
+        service["networks"] = (["default"] if len(project.services) > 1 else []) + (["proxynet"] if ingress else [])
+    service["restart"] = s.restart
+    if s.volumes:
+        service["volumes"] = [_Quoted(v if ":" in v else f".{v}:{v}") for v in s.volumes]
+    service.update({k: str(v) for k, v in s.additional_properties.items()})
+    return service
+
+
+def get_compose(project: Project, certs: Dict[str, TLS], config_hash: str) -> Dict[str, Any]:
+    """Get the compose config of a (planned) project"""
+    return {
+        "networks": {"proxynet": {"name": "proxynet", "external": "true"}},
+        "services": {
+            f"{project.name}-{s.host}": get_compose_service(project, s, certs, config_hash) for s in project.services
+        },
+    }
+
+
+def _emit(key: str, value: Any, indent: int, lines: List[str]) -> None:
+    pad = " " * indent
+    if isinstance(value, dict):
+        lines.append(f"{pad}{key}:")
+        for k, v in value.items():
+            _emit(k, v, indent + 2, lines)
+    elif isinstance(value, list):
+        lines.append(f"{pad}{key}:")
+        lines += [f"{pad}  - '{item}'" if isinstance(item, _Quoted) else f"{pad}  - {item}" for item in value]
+    elif isinstance(value, _Block):
+        lines += [f"{pad}{key}:", f"{pad}  {value}"]
+    else:
+        lines.append(f"{pad}{key}: {value}")
+
+
+def emit_compose(compose: Dict[str, Any]) -> str:
+    """Write a compose config as yaml, in the layout of the compose template"""
+    blocks = []
+    for key, value in compose.items():
+        lines: List[str] = []
+        _emit(key, value, 0, lines)
+        blocks.append("\n".join(lines))
+    return "---\n" + "\n\n".join(blocks)
+
+
+def _render_compose(project: Project, certs: Dict[str, TLS]) -> str:
+    """Render the compose file of a (planned) project, with the template when it was changed"""
+    with open(COMPOSE_TEMPLATE, encoding="utf-8") as f:
+        source = f.read()
+    if hashlib.sha256(source.encode("utf-8")).hexdigest() == STOCK_COMPOSE_TEMPLATE_HASH:
+        return emit_compose(get_compose(project, certs, _config_hash_placeholder))
+    tpl = load_template(COMPOSE_TEMPLATE)
     tpl.globals["Protocol"] = Protocol
     tpl.globals["Router"] = Router
+    tpl.globals["get_router_certs"] = get_router_certs
     tpl.globals["isinstance"] = isinstance
     tpl.globals["len"] = len
     tpl.globals["list"] = list
     tpl.globals["str"] = str
-    content = tpl.render(project=project)
-    with open(f"upstream/{project.name}/docker-compose.yml", "w", encoding="utf-8") as f:
-        f.write(content)
+    return tpl.render(certs=certs, config_hash=_config_hash_placeholder, project=project)
+
+
+def get_service_hashes(compose: str, env: str = "") -> Dict[str, str]:
+    """
+    Get the fingerprint of every service in a rendered compose file: the hash of its block together with the
+    project env, so a service only gets another fingerprint when its own config changed.
+    """
+    services = yaml.load(compose, Loader=_yaml_loader)["services"] or {}
+    return {
+        name: hashlib.sha256((json.dumps(service, sort_keys=True, default=str) + env).encode()).hexdigest()[:16]
+        for name, service in services.items()
+    }
+
+
+def _render_upstream(project: Project, certs: Dict[str, TLS] = None) -> Tuple[Dict[str, str], Dict[str, str]]:
+    """Render the artifacts of a project with the fingerprints of its services, given the shared certificates"""
+    if certs is None:
+        certs = get_shared_certs()
+    compose = _render_compose(plan_project(project), certs)
+    artifacts = {f"upstream/{project.name}/docker-compose.yml": compose}
     if project.env:
-        env_content = "\n".join([f"{k}={v}" for k, v in project.env])
-        with open(f"upstream/{project.name}/.env", "w", encoding="utf-8") as f:
-            f.write(env_content)
+        artifacts[f"upstream/{project.name}/.env"] = "\n".join([f"{k}={v}" for k, v in project.env])
+    # fingerprint the services without their fingerprint, then stamp them in the order they were rendered
+    hashes = get_service_hashes(compose, artifacts.get(f"upstream/{project.name}/.env", ""))
+    stamps = iter(hashes.values())
+    compose = re.sub(_config_hash_placeholder, lambda _: next(stamps), compose)
+    artifacts[f"upstream/{project.name}/docker-compose.yml"] = compose
+    return artifacts, hashes
+
+
+def render_upstream(project: Project, certs: Dict[str, TLS] = None) -> Dict[str, str]:
+    """Render the artifacts of a project, by path, given the shared certificates (looked up when not given)"""
+    return _render_upstream(project, certs)[0]
+
+
+def write_upstream(project: Project, certs: Dict[str, TLS] = None) -> List[str]:
+    return write_files(render_upstream(project, certs))
 
 
 def write_upstream_volume_folders(project: Project) -> None:
@@ -48,12 +216,34 @@ def write_upstream_volume_folders(project: Project) -> None:
             os.makedirs(f"upstream/{project.name}{path}", exist_ok=True)
 
 
-def write_upstreams() -> None:
-    projects = get_projects(filter=lambda p, s: p.enabled and s.image)
+def get_upstream_projects() -> List[Project]:
+    """Get the projects that have upstream artifacts: enabled ones with services that have an image"""
+    return get_projects(filter=lambda p, s: p.enabled and s.image)
+
+
+def render_upstreams() -> Dict[str, str]:
+    """Render the artifacts of all upstream projects, by path"""
+    certs = get_shared_certs()
+    return {path: content for p in get_upstream_projects() for path, content in render_upstream(p, certs).items()}
+
+
+def get_config_hashes() -> Dict[str, Dict[str, str]]:
+    """Get the fingerprints of the services of every upstream project, which their containers should be labeled with"""
+    certs = get_shared_certs()
+    return {p.name: _render_upstream(p, certs)[1] for p in get_upstream_projects()}
+
+
+@timed("write_upstreams")
+def write_upstreams() -> List[str]:
+    """Write the artifacts of all upstream projects, returning the paths of the ones that changed"""
+    written = []
+    projects = get_upstream_projects()
+    certs = get_shared_certs()
     for p in projects:
         os.makedirs(f"upstream/{p.name}", exist_ok=True)
-        write_upstream(p)
+        written += write_upstream(p, certs)
         write_upstream_volume_folders(p)
+    return written
 
 
 def check_upstream(project: str, service: str = None) -> None:
@@ -67,36 +257,123 @@ def check_upstream(project: str, service: str = None) -> None:
         raise ValueError(f"Project {project} does not have service {service}")
 
 
+def get_deployed_hashes(project: str) -> Dict[str, Set[str]]:
+    """Get the fingerprints of the containers of a project by service, with one docker call"""
+    out = run_command_output(
+        [
+            "docker",
+            "ps",
+            "-a",
+            "--filter",
+            f"label=com.docker.compose.project={project.lower()}",
+            "--format",
+            f'{{{{.Label "com.docker.compose.service"}}}}\t{{{{.Label "{CONFIG_HASH_LABEL}"}}}}',
+        ]
+    )
+    hashes: Dict[str, Set[str]] = {}
+    for line in out.splitlines():
+        service, config_hash = line.split("\t")
+        hashes.setdefault(service, set()).add(config_hash)
+    return hashes
+
+
+def diff_services(project: str) -> Dict[str, List[str]]:
+    """Diff the fingerprints of the services of an enabled project against the ones of its containers"""
+    projects = get_projects(filter=lambda p, s: p.enabled and p.name == project and bool(s.image))
+    desired = _render_upstream(projects[0])[1] if projects else {}
+    deployed = get_deployed_hashes(project)
+    return {
+        "changed": sorted(s for s, h in desired.items() if deployed.get(s) != {h}),
+        "unchanged": sorted(s for s, h in desired.items() if deployed.get(s) == {h}),
+        "removed": sorted(deployed.keys() - desired.keys()),
+    }
+
+
+@timed("update_upstream")
 def update_upstream(
     project: Project | str,
     service: str = None,
     rollout: bool = False,
-) -> None:
-    """Reload service(s) in a docker compose config"""
+    changed_only: bool = False,
+) -> List[str]:
+    """
+    Reload service(s) in a docker compose config. With changed_only only the services whose fingerprint changed
+    are pulled, recreated and rolled out, leaving the others running untouched.
+    Returns the hosts of the services that were updated or rolled out. The diff is added to the deploy trace.
+    """
     project = get_project(project, throw=True)
     info(f"Updating upstream for project {project.name}")
-    if project.enabled:
-        run_command(["docker", "compose", "pull"], cwd=f"upstream/{project.name}")
-        run_command(["docker", "compose", "up", "-d"], cwd=f"upstream/{project.name}")
+    cwd = f"upstream/{project.name}"
+    if not project.enabled:
+        run_command(["docker", "compose", "down"], cwd=cwd)
+        return []
+    hosts = None
+    if changed_only:
+        diff = diff_services(project.name)
+        add_attrs(**diff)
+        hosts = [s[len(project.name) + 1 :] for s in diff["changed"]]
+        if not hosts and not diff["removed"]:
+            info(f"No services of project {project.name} changed")
+            return []
+        info(f"Updating changed services of project {project.name}: {', '.join(diff['changed'] or ['none'])}")
+        if hosts:
+            names = [f"{project.name}-{h}" for h in hosts]
+            run_command(["docker", "compose", "pull", *names], cwd=cwd)
+            run_command(["docker", "compose", "up", "-d", "--remove-orphans", *names], cwd=cwd)
+        else:
+            # without names compose would act on every service, so only the removed ones are taken down
+            run_command(["docker", "compose", "up", "-d", "--no-recreate", "--remove-orphans"], cwd=cwd)
     else:
-        run_command(["docker", "compose", "down"], cwd=f"upstream/{project.name}")
-    if not rollout:
+        run_command(["docker", "compose", "pull"], cwd=cwd)
+        run_command(["docker", "compose", "up", "-d"], cwd=cwd)
+    if hosts is None and rollout:
+        # filter out the project by name and its services that should have an image
+        projects = get_projects(filter=lambda p, s: p.enabled and p.name == project.name and bool(s.image))
+        hosts = [s.host for p in projects for s in p.services]
+    if rollout:
+        rollout_services(project.name, [h for h in hosts if not service or h == service])
+    return hosts or []
+
+
+@timed("update_service")
+def update_service(project: str, service: str) -> None:
+    """Pull and roll out a single service of a project, leaving its siblings untouched"""
+    p = get_project(project, throw=True)
+    s = get_service(p, service, throw=True)
+    if not (p.enabled and s.image):
+        # nothing to pull or roll out for this service, so let the project handle it
+        update_upstream(p.name, service, rollout=True)
         return
-    # filter out the project by name and its services that should have an image
-    projects = get_projects(filter=lambda p, s: p.enabled and p.name == project.name and bool(s.image))
-    for p in projects:
-        for s in p.services:
-            if not service or s.host == service:
-                rollout_service(project.name, s.host)
+    info(f'Updating service "{p.name}:{s.host}"')
+    start = time.perf_counter()
+    run_command(["docker", "compose", "pull", f"{p.name}-{s.host}"], cwd=f"upstream/{p.name}")
+    record_pull(p.name, s.host, time.perf_counter() - start)
+    rollout_service(p.name, s.host)
 
 
+@timed("update_upstreams")
 def update_upstreams(rollout: bool = False) -> None:
-    for upstream_dir in [f.path for f in os.scandir("upstream") if f.is_dir()]:
-        # get last item from path:
-        project = upstream_dir.split("/")[-1]
-        update_upstream(project, rollout=rollout)
+    """Update the upstream projects in the db, taking down the disabled ones that were deployed"""
+    for p in get_projects(filter=lambda _, s: bool(s.image)):
+        if p.enabled or os.path.isdir(f"upstream/{p.name}"):
+            update_upstream(p.name, rollout=rollout)
 
 
+@timed("rollout_service")
 def rollout_service(project: str, service: str) -> None:
     info(f'Rolling out service "{project}:{service}"')
-    run_command(["docker", "rollout", f"{project}-{service}"], cwd=f"upstream/{project}")
+    s = get_service(project, service)
+    port = s.ingress[0].port if s.ingress else 8080
+    rollout_container(project, service, readiness_path=s.readiness_path, port=port, timeout=s.rollout_timeout)
+
+
+def rollout_services(project: str, services: List[str]) -> None:
+    """Roll out services of a project in parallel"""
+    if not services:
+        return
+    with ThreadPoolExecutor(max_workers=len(services)) as executor:
+        # run each rollout in a copy of our context so it is traced as part of the active deploy
+        futures = [executor.submit(contextvars.copy_context().run, rollout_service, project, s) for s in services]
+    # surface the first failure only after all rollouts have settled
+    for f in futures:
+        f.result()
@@ -1,24 +1,27 @@
+import hashlib
 import os
 import sys
 import unittest
 from unittest import TestCase, mock
 from unittest.mock import Mock, call
 
-from lib.models import Env, Project
+from lib.models import TLS, Env, Ingress, Project, Protocol, Router
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
 from lib.data import Service
-from lib.upstream import update_upstream, update_upstreams, write_upstream
-
-
-class DirEntry:
-    def __init__(self, path: str):
-        self.path = path
-
-    def is_dir(self) -> bool:
-        return True
-
+from lib.domains import plan_certs
+from lib.test_stubs import test_projects
+from lib.upstream import (
+    COMPOSE_TEMPLATE,
+    STOCK_COMPOSE_TEMPLATE_HASH,
+    get_service_hashes,
+    render_upstream,
+    update_service,
+    update_upstream,
+    update_upstreams,
+    write_upstream,
+)
 
 _ret_tpl = """
 ---
@@ -198,20 +201,185 @@ class TestUpdateUpstream(TestCase):
         # Assert that the rollout_service function is not called
         mock_rollout_service.assert_not_called()
 
-    @mock.patch("os.scandir")
     @mock.patch("lib.upstream.update_upstream")
+    @mock.patch("lib.upstream.rollout_service")
+    @mock.patch("lib.upstream.run_command")
+    @mock.patch(
+        "lib.upstream.get_project",
+        return_value=Project(name="my-project", services=[Service(host="service1", image="morriz/hello-world:main")]),
+    )
+    def test_update_service(
+        self, _: Mock, mock_run_command: Mock, mock_rollout_service: Mock, mock_update_upstream: Mock
+    ) -> None:
+
+        # Call the function under test
+        update_service("my-project", "service1")
+
+        # Assert that only the one service is pulled and rolled out
+        mock_run_command.assert_called_once_with(
+            ["docker", "compose", "pull", "my-project-service1"],
+            cwd="upstream/my-project",
+        )
+        mock_rollout_service.assert_called_once_with("my-project", "service1")
+        mock_update_upstream.assert_not_called()
+
+    @mock.patch("lib.upstream.update_upstream")
+    @mock.patch("lib.upstream.rollout_service")
     @mock.patch("lib.upstream.run_command")
     @mock.patch("lib.upstream.get_project", return_value=_ret_projects[0])
-    def test_update_upstreams(self, _: Mock, _2: Mock, mock_update_upstream: Mock, mock_scandir: Mock) -> None:
-        mock_scandir.return_value = [DirEntry("upstream/my-project")]
+    def test_update_service_without_image(
+        self, _: Mock, mock_run_command: Mock, mock_rollout_service: Mock, mock_update_upstream: Mock
+    ) -> None:
 
+        # Call the function under test
+        update_service("my-project", "service1")
+
+        # Assert that we fall back to updating the project
+        mock_run_command.assert_not_called()
+        mock_rollout_service.assert_not_called()
+        mock_update_upstream.assert_called_once_with("my-project", "service1", rollout=True)
+
+    def test_get_service_hashes(self) -> None:
+        compose = "services:\n  p-a:\n    image: a:1\n  p-b:\n    image: b:1\n"
+
+        # Call the function under test
+        hashes = get_service_hashes(compose)
+        changed = get_service_hashes(compose.replace("b:1", "b:2"))
+        env_changed = get_service_hashes(compose, "TZ=UTC")
+
+        # Only the service whose block changed gets another fingerprint, while the project env affects all
+        self.assertEqual(hashes["p-a"], changed["p-a"])
+        self.assertNotEqual(hashes["p-b"], changed["p-b"])
+        self.assertTrue(all(env_changed[s] != hashes[s] for s in hashes))
+
+    @mock.patch(
+        "lib.upstream.diff_services",
+        return_value={"changed": ["my-project-service2"], "unchanged": ["my-project-service1"], "removed": []},
+    )
+    @mock.patch("lib.upstream.rollout_service")
+    @mock.patch("lib.upstream.run_command")
+    @mock.patch("lib.upstream.get_project", return_value=_ret_projects[0])
+    def test_update_upstream_changed_only(
+        self, _: Mock, mock_run_command: Mock, mock_rollout_service: Mock, _2: Mock
+    ) -> None:
+        # Call the function under test
+        updated = update_upstream("my-project", rollout=True, changed_only=True)
+
+        # Only the changed service is pulled, recreated and rolled out
+        self.assertEqual(updated, ["service2"])
+        mock_run_command.assert_has_calls(
+            [
+                call(["docker", "compose", "pull", "my-project-service2"], cwd="upstream/my-project"),
+                call(
+                    ["docker", "compose", "up", "-d", "--remove-orphans", "my-project-service2"],
+                    cwd="upstream/my-project",
+                ),
+            ]
+        )
+        mock_rollout_service.assert_called_once_with("my-project", "service2")
+
+    @mock.patch(
+        "lib.upstream.diff_services",
+        return_value={"changed": [], "unchanged": ["my-project-service1"], "removed": ["my-project-old"]},
+    )
+    @mock.patch("lib.upstream.rollout_service")
+    @mock.patch("lib.upstream.run_command")
+    @mock.patch("lib.upstream.get_project", return_value=_ret_projects[0])
+    def test_update_upstream_only_removed(
+        self, _: Mock, mock_run_command: Mock, mock_rollout_service: Mock, _2: Mock
+    ) -> None:
+        # Call the function under test
+        updated = update_upstream("my-project", rollout=True, changed_only=True)
+
+        # Nothing is pulled or recreated, only the removed service is taken down
+        self.assertEqual(updated, [])
+        mock_run_command.assert_called_once_with(
+            ["docker", "compose", "up", "-d", "--no-recreate", "--remove-orphans"], cwd="upstream/my-project"
+        )
+        mock_rollout_service.assert_not_called()
+
+    @mock.patch("os.path.isdir", side_effect=lambda path: path == "upstream/another-project")
+    @mock.patch("lib.upstream.update_upstream")
+    @mock.patch("lib.upstream.get_projects", return_value=_ret_projects)
+    def test_update_upstreams(self, _: Mock, mock_update_upstream: Mock, _2: Mock) -> None:
         # Call the function under test
         update_upstreams()
 
-        mock_update_upstream.assert_called_once_with(
-            "my-project",
-            rollout=False,
+        # The projects come from the db, and disabled ones are only taken down when they were deployed
+        mock_update_upstream.assert_has_calls(
+            [call("my-project", rollout=False), call("another-project", rollout=False)]
+        )
+
+    @mock.patch.dict(os.environ, {"TLS_SHARED_CERTS": "san"})
+    def test_render_upstream_two_zones(self) -> None:
+        project = Project(
+            name="zones",
+            services=[
+                Service(
+                    host="web",
+                    image="zones/web:1",
+                    ingress=[Ingress(domain="a.example.com", port=80), Ingress(domain="b.other.org", port=80)],
+                )
+            ],
+        )
+        certs = plan_certs(["a.example.com", "b.example.com", "b.other.org"])
+
+        # Call the function under test
+        compose = render_upstream(project, certs)["upstream/zones/docker-compose.yml"]
+
+        # The ingresses share one router, which lists the certificate of both zones
+        prefix = "traefik.http.routers.zones-web-80"
+        self.assertIn(f"{prefix}.rule=Host(`a.example.com`) || Host(`b.other.org`)", compose)
+        self.assertIn(f"{prefix}.tls.domains[0].main=a.example.com", compose)
+        self.assertIn(f"{prefix}.tls.domains[0].sans[0]=b.example.com", compose)
+        self.assertIn(f"{prefix}.tls.domains[1].main=b.other.org", compose)
+
+    def test_emit_compose(self) -> None:
+        rich = Project(
+            name="rich",
+            services=[
+                Service(
+                    host="web.app",
+                    image="rich/web:1",
+                    command="serve --port 80",
+                    depends_on={"db": {"condition": "service_healthy"}},
+                    env=Env(**{"A": "it's", "B": 1, "C": None}),
+                    ingress=[
+                        Ingress(domain="a.example.com,b.example.com", port=80, path_prefix="/api", path_remove=True),
+                        Ingress(tls=TLS(main="c.example.com", sans=["d.example.com"]), port=81, router=Router.tcp),
+                        Ingress(domain="e.example.com", port=82, hostport=8082),
+                        Ingress(domain="u.example.com", port=53, protocol=Protocol.udp, router=Router.udp),
+                        Ingress(domain="f.example.com", port=83),
+                        Ingress(domain="g.example.com", port=83),
+                        Ingress(domain="h.example.com", port=84),
+                        Ingress(domain="i.other.org", port=84),
+                    ],
+                    labels=["x=y"],
+                    volumes=["/data", "./conf:/conf:ro"],
+                    additional_properties={"cap_add": ["NET_ADMIN"], "healthcheck": {"test": "true"}},
+                ),
+                Service(host="db", image="postgres", depends_on=["web.app"], restart="always"),
+            ],
         )
+        certs = {
+            "f.example.com": TLS(main="example.com", sans=["*.example.com"]),
+            "h.example.com": TLS(main="h.example.com"),
+            "i.other.org": TLS(main="i.other.org", sans=["j.other.org"]),
+        }
+
+        for project in [rich, Project(name="empty"), *test_projects]:
+            with self.subTest(project=project.name):
+                # Call the function under test
+                emitted = render_upstream(project, certs)
+                with mock.patch("lib.upstream.STOCK_COMPOSE_TEMPLATE_HASH", ""):
+                    rendered = render_upstream(project, certs)
+
+                # The emitter writes the same bytes as the template
+                self.assertEqual(emitted, rendered)
+
+        # A change to the template needs the same change to the emitter, and the new hash
+        with open(COMPOSE_TEMPLATE, "rb") as f:
+            self.assertEqual(hashlib.sha256(f.read()).hexdigest(), STOCK_COMPOSE_TEMPLATE_HASH)
 
 
 if __name__ == "__main__":
@@ -1,6 +1,24 @@
 import os
 import subprocess
-from typing import Dict, List
+import time
+from functools import cache, lru_cache
+from typing import TYPE_CHECKING, Dict, List
+
+from lib.metrics import artifact_writes, command_duration
+from lib.trace import span
+
+if TYPE_CHECKING:
+    from jinja2 import Template
+
+
+@cache
+def load_env() -> None:
+    """Load the .env file into the environment, once, from the entry points"""
+    # only the entry points load it, so importing lib.utils does not pull in dotenv
+    # pylint: disable-next=import-outside-toplevel
+    from dotenv import load_dotenv
+
+    load_dotenv()
 
 
 # func that reads .env file into a dictionary
@@ -9,16 +27,88 @@ def read_env_file(file: str) -> Dict[str, str]:
         return dict(line.strip().split("=", 1) for line in f if not line.strip().startswith("#") and "=" in line)
 
 
-def run_command(command: List[str], cwd: str = None) -> int:
+def get_command_env(cwd: str = None) -> Dict[str, str]:
     env_file = f"{cwd}/.env" if cwd else ""
-    env = read_env_file(env_file) if env_file != "" and os.path.exists(env_file) else {}
-    with open("logs/error.log", "w", encoding="utf-8") as f:
-        process = subprocess.run(
-            command,
-            check=True,
-            cwd=cwd,
-            env=env,
-            stdout=f,
-            stderr=f,
-        )
+    return read_env_file(env_file) if env_file != "" and os.path.exists(env_file) else {}
+
+
+def get_command_name(command: List[str]) -> str:
+    """Get a short name for a command, such as "docker compose pull", to label its metrics with"""
+    words = [c for c in command if not c.startswith("-")]
+    return " ".join(words[: 3 if words[1:2] == ["compose"] else 2])
+
+
+def run_command(command: List[str], cwd: str = None, log_file: str = "logs/error.log") -> int:
+    """Run a command, writing its output to a log file (logs/error.log unless given)"""
+    env = get_command_env(cwd)
+    start = time.perf_counter()
+    try:
+        with span(get_command_name(command), cwd=cwd), open(log_file, "w", encoding="utf-8") as f:
+            process = subprocess.run(
+                command,
+                check=True,
+                cwd=cwd,
+                env=env,
+                stdout=f,
+                stderr=f,
+            )
+    finally:
+        command_duration.observe(time.perf_counter() - start, command=get_command_name(command))
     return process.returncode
+
+
+def run_command_output(command: List[str], cwd: str = None) -> str:
+    """Run a command and return its output"""
+    env = get_command_env(cwd)
+    start = time.perf_counter()
+    try:
+        with span(get_command_name(command), cwd=cwd):
+            process = subprocess.run(
+                command,
+                capture_output=True,
+                check=True,
+                cwd=cwd,
+                env=env,
+                text=True,
+            )
+    finally:
+        command_duration.observe(time.perf_counter() - start, command=get_command_name(command))
+    return process.stdout
+
+
+@lru_cache(maxsize=64)
+def _compile_template(source: str) -> "Template":
+    # jinja2 is slow to import and only needed when a template is rendered
+    # pylint: disable-next=import-outside-toplevel
+    from jinja2 import Template
+
+    return Template(source)
+
+
+def load_template(path: str) -> "Template":
+    """Load a jinja template, compiling it only when its source changed"""
+    with open(path, encoding="utf-8") as f:
+        return _compile_template(f.read())
+
+
+def is_unchanged(path: str, content: str) -> bool:
+    """Check if an artifact on disk already has the given content"""
+    if not os.path.exists(path):
+        return False
+    with open(path, encoding="utf-8") as f:
+        return f.read() == content
+
+
+def write_file(path: str, content: str) -> bool:
+    """Write a generated artifact, unless it is unchanged. Returns whether it was written."""
+    if is_unchanged(path, content):
+        return False
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(content)
+    artifact_writes.inc(artifact=path)
+    return True
+
+
+def write_files(artifacts: Dict[str, str]) -> List[str]:
+    """Write generated artifacts by path, returning the paths that changed"""
+    return [path for path, content in artifacts.items() if write_file(path, content)]
@@ -6,7 +6,7 @@ from unittest.mock import Mock
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
-from lib.utils import run_command
+from lib.utils import run_command, write_file
 
 
 class TestRunCommand(unittest.TestCase):
@@ -33,5 +33,32 @@ class TestRunCommand(unittest.TestCase):
         )
 
 
+class TestWriteFile(unittest.TestCase):
+
+    # Unchanged artifacts are not written again
+    @mock.patch("os.path.exists", return_value=True)
+    @mock.patch("builtins.open", new_callable=mock.mock_open, read_data="content")
+    def test_write_file_unchanged(self, mock_open: Mock, _: Mock) -> None:
+
+        # Call the function under test
+        written = write_file("proxy/nginx/proxy.conf", "content")
+
+        self.assertFalse(written)
+        mock_open.assert_called_once_with("proxy/nginx/proxy.conf", encoding="utf-8")
+        mock_open.return_value.write.assert_not_called()
+
+    # Changed artifacts are written
+    @mock.patch("os.path.exists", return_value=True)
+    @mock.patch("builtins.open", new_callable=mock.mock_open, read_data="old content")
+    def test_write_file_changed(self, mock_open: Mock, _: Mock) -> None:
+
+        # Call the function under test
+        written = write_file("proxy/nginx/proxy.conf", "content")
+
+        self.assertTrue(written)
+        mock_open.assert_called_with("proxy/nginx/proxy.conf", "w", encoding="utf-8")
+        mock_open.return_value.write.assert_called_once_with("content")
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,142 @@
+import os
+import time
+from logging import error, info
+from typing import Dict, Iterator, List, Set, Tuple
+
+from lib.artifacts import record_revision
+from lib.data import get_project, validate_db
+from lib.proxy import restart_proxy, update_proxy, write_proxies
+from lib.storage import SplitYamlStorage, YamlStorage, get_storage
+from lib.trace import deploy
+from lib.upstream import get_upstream_projects, update_upstream, write_upstreams
+
+TEMPLATE_PATHS = ["tpl", "proxy/tpl"]
+# seconds without changes before a burst of saves is applied
+DEBOUNCE = 1.0
+# seconds between polls when watchfiles (inotify) is not installed
+POLL_INTERVAL = 0.5
+
+
+def get_watch_paths() -> List[str]:
+    """Get the inputs to watch: the templates and the db, unless it lives in sqlite, which only the api writes"""
+    paths = list(TEMPLATE_PATHS)
+    storage = get_storage()
+    if isinstance(storage, (YamlStorage, SplitYamlStorage)):
+        paths.append(storage.path)
+    return paths
+
+
+def _is_watched(path: str) -> bool:
+    # skip the temp files the storage writes before replacing a file
+    return not path.endswith(".tmp")
+
+
+def _snapshot(paths: List[str]) -> Dict[str, Tuple[int, int]]:
+    """Get the modification time and size of all files in the paths"""
+    files = {}
+    for path in paths:
+        if os.path.isfile(path):
+            candidates = [path]
+        else:
+            candidates = [os.path.join(root, f) for root, _, names in os.walk(path) for f in names]
+        for f in filter(_is_watched, candidates):
+            try:
+                stat = os.stat(f)
+            except FileNotFoundError:
+                continue
+            files[f] = (stat.st_mtime_ns, stat.st_size)
+    return files
+
+
+def poll_changes(paths: List[str], debounce: float = DEBOUNCE, interval: float = POLL_INTERVAL) -> Iterator[Set[str]]:
+    """Poll the paths for changes, yielding the changed files once a burst of saves settled"""
+    previous = _snapshot(paths)
+    while True:
+        time.sleep(interval)
+        current = _snapshot(paths)
+        if current == previous:
+            continue
+        # wait for the burst to settle
+        while True:
+            time.sleep(debounce)
+            latest = _snapshot(paths)
+            if latest == current:
+                break
+            current = latest
+        yield {f for f in previous.keys() | current.keys() if previous.get(f) != current.get(f)}
+        previous = current
+
+
+def watch_changes(paths: List[str], debounce: float = DEBOUNCE) -> Iterator[Set[str]]:
+    """Yield the changed files once a burst of saves settled, using inotify when watchfiles is installed"""
+    try:
+        # an optional dependency, so only imported when watching
+        # pylint: disable-next=import-outside-toplevel
+        from watchfiles import watch
+    except ImportError:
+        info("watchfiles is not installed, polling for changes")
+        yield from poll_changes(paths, debounce)
+        return
+    for changes in watch(*paths, debounce=int(debounce * 1000), watch_filter=lambda _, path: _is_watched(path)):
+        yield {os.path.relpath(path) for _, path in changes}
+
+
+class Watcher:
+    """Applies changes to the db and templates as they are saved, only touching what they affect"""
+
+    def __init__(self, paths: List[str] = None, debounce: float = DEBOUNCE) -> None:
+        self.paths = paths or get_watch_paths()
+        self.debounce = debounce
+        self.upstreams = {p.name for p in get_upstream_projects()}
+        # projects whose update failed, to retry on the next change as their artifacts are already written
+        self.pending: Set[str] = set()
+
+    def apply(self) -> Dict[str, List[str]]:
+        """
+        Validate the db and write the artifacts, then update only the projects whose artifacts changed
+        (or that were disabled or failed before), and restart only the parts of the proxy whose config changed.
+        Traefik picks up its dynamic router config by itself. Returns what was updated.
+        """
+        validate_db()
+        written_proxy = write_proxies()
+        written_upstreams = write_upstreams()
+        if written_proxy or written_upstreams:
+            record_revision()
+        upstreams = {p.name for p in get_upstream_projects()}
+        # projects that are no longer upstreams get taken down when they were disabled
+        gone = {name for name in self.upstreams - upstreams if get_project(name, throw=False)}
+        projects = sorted({path.split("/")[1] for path in written_upstreams} | gone | self.pending)
+        self.upstreams = upstreams
+        self.pending = set()
+        for project in projects:
+            try:
+                update_upstream(project, changed_only=True)
+            except Exception as e:  # pylint: disable=broad-except
+                error(f"Updating project {project} failed: {e}")
+                self.pending.add(project)
+        proxy = []
+        if "proxy/docker-compose.yml" in written_proxy:
+            update_proxy()
+            proxy.append("update")
+        elif "proxy/traefik/traefik.yml" in written_proxy:
+            restart_proxy("traefik")
+            proxy.append("restart traefik")
+        return {
+            "artifacts": written_proxy + written_upstreams,
+            "projects": projects,
+            "failed": sorted(self.pending),
+            "proxy": proxy,
+        }
+
+    def run(self) -> None:
+        info(f"Watching {', '.join(self.paths)} for changes")
+        for changed in watch_changes(self.paths, self.debounce):
+            info(f"Changed: {', '.join(sorted(changed))}")
+            try:
+                with deploy("watch", files=sorted(changed)):
+                    result = self.apply()
+            except Exception as e:  # pylint: disable=broad-except
+                # keep watching, the next save may fix it
+                error(f"Applying changes failed: {e}")
+                continue
+            info(f"Applied changes: {result}")
@@ -0,0 +1,93 @@
+import os
+import sys
+import tempfile
+import unittest
+from unittest import TestCase, mock
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from lib.watch import Watcher, poll_changes
+
+
+class TestWatch(TestCase):
+
+    def test_poll_changes(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "db.yml")
+            with open(path, "w", encoding="utf-8") as f:
+                f.write("a")
+            saves = iter(["ab", "abc", None, None])
+
+            def save(_: float) -> None:
+                content = next(saves)
+                if content:
+                    with open(path, "w", encoding="utf-8") as f:
+                        f.write(content)
+                    with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+                        f.write(content)
+
+            with mock.patch("lib.watch.time.sleep", side_effect=save) as mock_sleep:
+
+                # Call the function under test
+                changed = next(poll_changes([tmp]))
+
+            # The burst of saves is reported once it settled, without temp files
+            self.assertEqual(changed, {path})
+            self.assertEqual(mock_sleep.call_count, 3)
+
+    @mock.patch("lib.watch.validate_db", mock.Mock())
+    @mock.patch("lib.watch.write_proxies", mock.Mock(return_value=["proxy/traefik/dynamic/routers-http.yml"]))
+    @mock.patch("lib.watch.write_upstreams", mock.Mock(return_value=["upstream/whoami/docker-compose.yml"]))
+    @mock.patch("lib.watch.get_project")
+    @mock.patch("lib.watch.update_upstream")
+    @mock.patch("lib.watch.update_proxy")
+    @mock.patch("lib.watch.restart_proxy")
+    @mock.patch("lib.watch.record_revision")
+    def test_apply(
+        self,
+        mock_record_revision: mock.Mock,
+        mock_restart_proxy: mock.Mock,
+        mock_update_proxy: mock.Mock,
+        mock_update_upstream: mock.Mock,
+        mock_get_project: mock.Mock,
+    ) -> None:
+        whoami, disabled = mock.Mock(), mock.Mock()
+        whoami.name, disabled.name = "whoami", "disabled"
+        self.enterContext(mock.patch("lib.watch.get_upstream_projects", side_effect=[[whoami, disabled], [whoami]]))
+        watcher = Watcher(paths=["db.yml"])
+
+        # Call the function under test
+        result = watcher.apply()
+
+        # Only the changed and disabled projects are updated, and traefik reloads its dynamic config by itself
+        self.assertEqual(result["projects"], ["disabled", "whoami"])
+        mock_update_upstream.assert_has_calls(
+            [mock.call("disabled", changed_only=True), mock.call("whoami", changed_only=True)]
+        )
+        mock_get_project.assert_called_once_with("disabled", throw=False)
+        mock_update_proxy.assert_not_called()
+        mock_restart_proxy.assert_not_called()
+        mock_record_revision.assert_called_once()
+
+    @mock.patch("lib.watch.record_revision")
+    @mock.patch("lib.watch.validate_db")
+    @mock.patch("lib.watch.get_upstream_projects", return_value=[])
+    @mock.patch("lib.watch.write_proxies", return_value=[])
+    @mock.patch("lib.watch.write_upstreams", side_effect=[["upstream/whoami/docker-compose.yml"], []])
+    @mock.patch("lib.watch.update_upstream", side_effect=[ValueError("docker failed"), None])
+    def test_apply_retries_failed(self, mock_update_upstream: mock.Mock, *_: mock.Mock) -> None:
+        watcher = Watcher(paths=["db.yml"])
+
+        # Call the function under test
+        failed = watcher.apply()
+        retried = watcher.apply()
+
+        # The failed project is retried on the next change, although its artifacts did not change again
+        self.assertEqual(failed["failed"], ["whoami"])
+        self.assertEqual(retried["projects"], ["whoami"])
+        self.assertEqual(retried["failed"], [])
+        self.assertEqual(mock_update_upstream.call_count, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,19 @@
+from github_webhooks.schemas import WebhookCommonPayload
+from pydantic import BaseModel
+
+# github webhook payloads live apart from lib.models, as github_webhooks pulls in all of fastapi
+
+
+class PingPayload(WebhookCommonPayload):
+
+    zen: str
+
+
+class WorkflowJobPayload(WebhookCommonPayload):
+    class WorkflowJob(BaseModel):
+        id: int | None = None
+        name: str
+        status: str
+        conclusion: str | None = None
+
+    workflow_job: WorkflowJob